@@ -1,7 +1,9 @@
 from mercurial.context import memctx, memfilectx
 from mercurial.util import version as hg_version
-from distutils.version import StrictVersion
+from mercurial.node import hex as hghex
 from mercurial import extensions
+from mercurial import obsolete
+from mercurial.error import Abort, LookupError
 
 # Conditional imports depending on Mercurial version
 if hg_version() >= '3.7': 
@@ -38,6 +40,10 @@ def hg_readactive(repo):
     else: 
         return readcurrent(repo) 
 
+def hg_enable_extension(ui, name):
+    ui.setconfig('extensions', name, '')
+    extensions.loadall(ui)
+
 def hg_sha1(url):
     encoded = url.encode('utf-8')
 
@@ -54,16 +60,163 @@ def hg_memfilectx(repo, path, data, is_link=False, is_exec=False, copied=None):
     else:
         return memfilectx(path, data, is_link, is_exec, copied)
 
-def hg_strip(repo, processed_nodes):
-    class dummyui(object):
-        def debug(self, msg):
-            pass
+def hg_transaction(repo, desc):
+    '''Acquire the working copy and store locks and open a transaction on
+    repo. Returns a tuple of (transaction, lock, wlock) which should be handed
+    to mercurial.lock.release once the caller is done. Releasing a transaction
+    that has not been closed aborts it, truncating every revlog back to the
+    length it had when the transaction was opened.'''
+    wlock = repo.wlock()
+    lock = repo.lock()
+    return repo.transaction(desc), lock, wlock
+
+def hg_setbookmark(repo, tr, name, old, new):
+    '''Move the local bookmark name from old to new inside transaction tr.
+    Like mercurial.bookmarks.pushbookmark, but never opens (and therefore
+    never fails) a nested transaction. Returns False if the bookmark has
+    moved in the meantime.'''
+    marks = repo._bookmarks
+    existing = hghex(marks.get(name, ''))
+    if existing != old and existing != hghex(new):
+        return False
+    marks[name] = new
+    if hasattr(marks, 'recordchange'):
+        marks.recordchange(tr)
+    else:
+        marks.write()
+    return True
+
+def hg_deletebookmark(repo, tr, name):
+    '''Delete the local bookmark name inside transaction tr, if it exists.'''
+    marks = repo._bookmarks
+    if name not in marks:
+        return
+    del marks[name]
+    if hasattr(marks, 'recordchange'):
+        marks.recordchange(tr)
+    else:
+        marks.write()
+
+def hg_update_caches(repo):
+    '''Bring the branchmap, tags and revision branch caches of repo up to
+    date and write them to .hg/cache.'''
+    repo.branchmap()
+    repo.tags()
+    if hasattr(repo, 'revbranchcache'):
+        # Only written when the repository is closed, which we never do
+        repo.revbranchcache().write()
+
+def hg_clear_caches(repo):
+    '''Drop the revision and chunk caches of the changelog and manifest of
+    repo. The node map of the changelog, which marks are looked up in, is
+    kept.'''
+    changelog = repo.unfiltered().changelog
+    changelog._cache = None
+    changelog._chunkclear()
+    manifest = repo.manifest
+    if hasattr(manifest, 'clearcaches'):
+        manifest.clearcaches()
+    else:
+        manifest._cache = None
+        manifest._chunkclear()
+        if hasattr(manifest._mancache, 'clear'):
+            manifest._mancache.clear()
+        else:
+            manifest._mancache = None
+
+def hg_heads_and_known(peer, nodes):
+    '''Ask peer for its heads and which of nodes it knows in a single
+    round trip.'''
+    if hasattr(peer, 'iterbatch'):
+        batch = peer.iterbatch()
+        batch.heads()
+        batch.known(nodes)
+        batch.submit()
+        heads, known = batch.results()
+        return heads, known
+    batch = peer.batch()
+    heads = batch.heads()
+    known = batch.known(nodes)
+    batch.submit()
+    return heads.value, known.value
+
+def hg_enable_obsolescence(ui):
+    '''Let pulls with ui bring in the obsolescence markers of the remote,
+    which hide the changesets they obsolete in the filtered views.'''
+    if hg_version() >= '3.2':
+        ui.setconfig('experimental', 'evolution', 'createmarkers exchange')
+    else:
+        obsolete._enabled = True
+
+def hg_disable_obsolescence_exchange(ui):
+    '''Keep pushes with ui from sending obsolescence markers. The pulled
+    markers keep hiding the changesets they obsolete; Mercurial only reads
+    them without warnings while creating markers is enabled, which nothing
+    in gitifyhg does. Before 3.2, markers are exchanged whenever they are
+    enabled at all.'''
+    if hg_version() >= '3.2':
+        ui.setconfig('experimental', 'evolution', 'createmarkers')
+
+def hg_repo_view(repo, name):
+    '''Return the view name (visible or served) of repo.'''
+    if not hasattr(repo, 'filtered'):
+        return repo
+    repo = repo.unfiltered()
+    # The filtered revisions may have been computed before a pull brought
+    # in the obsolescence markers that hide more of them
+    repo.invalidatevolatilesets()
+    return repo.filtered(name)
+
+def hg_in_view(repo, node):
+    '''Return True if the changeset node exists in the view of repo.'''
+    try:
+        repo.changelog.rev(node)
+        return True
+    except LookupError:
+        return False
+
+def hg_store_path(repo, name):
+    '''Return the path of the file name in the store of repo.'''
+    return hg_store_vfs(repo).join(name)
 
-    if StrictVersion(hg_version()) >= StrictVersion('2.8'):
-        stripext = extensions.load(dummyui(), 'strip', '')
-        return stripext.strip(dummyui(), repo, processed_nodes)
+def hg_store_vfs(repo):
+    '''Return the opener of the store of repo.'''
+    if hg_version() >= '3.2':
+        return repo.svfs
+    else:
+        return repo.sopener
+
+# The store formats that make revisions cheaper to read, in the order
+# Mercurial introduced them. sparserevlog needs Mercurial 4.6.
+FAST_STORE_FORMATS = ('generaldelta',)
+
+def hg_fast_store_format(ui):
+    '''Let repositories created with ui use the fastest store format the
+    running Mercurial supports.'''
+    if hg_version() >= '3.7':
+        ui.setconfig('format', 'usegeneraldelta', True)
     else:
-        return repo.mq.strip(repo, processed_nodes)
+        ui.setconfig('format', 'generaldelta', True)
+
+def hg_addrevision(rlog, text, transaction, link, p1, p2, node, flags):
+    '''Add the revision node with the revision flags to the revlog rlog.'''
+    if hg_version() >= '4.1':
+        return rlog.addrevision(text, transaction, link, p1, p2, node=node,
+            flags=flags)
+    if flags:
+        # Only censored revisions have flags, which addrevision cannot add
+        raise Abort("%s: cannot copy revision %s with flags %x" % (
+            rlog.indexfile, hghex(node), flags))
+    return rlog.addrevision(text, transaction, link, p1, p2)
+
+def hg_manifest_diff(manifest1, manifest2):
+    '''Return the paths whose filenode or flags differ between the two
+    manifests.'''
+    if hasattr(manifest1, 'diff'):
+        return manifest1.diff(manifest2).keys()
+    return [path for path in set(manifest1) | set(manifest2)
+        if manifest1.get(path) != manifest2.get(path) or
+            manifest1.flags(path) != manifest2.flags(path)]
 
 # Helper Functions to help with changes to the mercurial API
 
@@ -0,0 +1,89 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+
+from mercurial.node import hex as hghex
+from mercurial.node import bin as hgbin
+
+
+def blob_hasher(size):
+    '''Return a sha1 object that yields the git object name of a blob of
+    size bytes once it has been fed the contents of the blob.'''
+    return hashlib.sha1('blob %d\0' % size)
+
+
+def hashed_chunks(hasher, chunks):
+    '''Feed chunks to hasher while passing them on.'''
+    for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+
+class BlobIndex(object):
+    '''Remembers which hg file revisions the blobs pushed from git became.
+
+    git fast-export sends every blob of a push again, even if an earlier
+    push already sent it, so the index is keyed by the git object name of
+    the blob and the path it was committed to. The file is only appended
+    to, one "sha filenode path" line per file revision, and read the first
+    time a push looks something up. Entries of a push are written once the
+    push succeeded, so they never refer to revisions that were rolled
+    back.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.filenodes = None  # (sha, path) to set of filenodes
+        self.pending = []
+
+    def load(self):
+        self.filenodes = {}
+        if not self.path.exists():
+            return
+        with self.path.open('rb') as file:
+            for line in file:
+                sha, filenode, path = line.rstrip('\n').split(' ', 2)
+                self.filenodes.setdefault(
+                    (sha, path.decode('string-escape')), set()).add(
+                    hgbin(filenode))
+
+    def get(self, sha, path):
+        '''Return the filenodes the blob sha was committed as at path.'''
+        if self.filenodes is None:
+            self.load()
+        return self.filenodes.get((sha, path), ())
+
+    def add(self, sha, path, filenode):
+        if filenode in self.get(sha, path):
+            return
+        self.filenodes.setdefault((sha, path), set()).add(filenode)
+        self.pending.append((sha, path, filenode))
+
+    def store(self):
+        '''Write the entries added since the last store.'''
+        if not self.pending:
+            return
+        with self.path.open('ab') as file:
+            for sha, path, filenode in self.pending:
+                file.write('%s %s %s\n' % (sha, hghex(filenode),
+                    path.encode('string-escape')))
+        self.pending = []
+
+    def discard(self):
+        '''Forget the entries added since the last store.'''
+        self.pending = []
+        self.filenodes = None
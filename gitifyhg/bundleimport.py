@@ -0,0 +1,122 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from mercurial.filelog import filelog
+from mercurial.store import decodedir
+
+from .util import log, output
+from .lfiles import is_standin
+
+
+class BundleBlobs(object):
+    '''Spools file revisions while a changegroup is being applied to the
+    local clone.
+
+    Every file revision a pull adds to the clone is read back right after
+    its filelog group has been written, while it is still in the revlog and
+    OS caches, and appended to a spool in remotedir. When HGImporter
+    imports a commit that refers to one of them, the revision is sent to
+    git as a blob from the spool, instead of opening every filelog again
+    for every revision that touches it. Revisions that no imported commit
+    refers to, like those of hidden changesets, never get a blob or a mark.
+    Files that path_filter hides from git are left out.'''
+
+    def __init__(self, spool_path, marks, path_filter):
+        self.spool_path = spool_path
+        self.marks = marks
+        self.path_filter = path_filter
+        self.spooled = {}  # (path, filenode) to offset and size in the spool
+        self.blob_marks = {}  # (path, filenode) to mark
+        self.spool = None
+        if self.spool_path.exists():
+            # Left over from a session that never got to import
+            self.spool_path.remove()
+
+    def start(self, clone_path):
+        '''Start spooling the file revisions that are added to the filelogs
+        of the clone at clone_path. Until stop() is called, every filelog in
+        the process goes through the hook, so this only wraps the pull.'''
+        if not self.spool_path.parent.exists():
+            self.spool_path.parent.makedirs()
+        self.spool = self.spool_path.open('wb')
+        store = os.path.join(os.path.realpath(clone_path), '.hg', 'store', '')
+        self.had_addgroup = 'addgroup' in filelog.__dict__
+        original = filelog.addgroup
+        bundle_blobs = self
+
+        def addgroup(self, *args, **kwargs):
+            start = len(self)
+            result = original(self, *args, **kwargs)
+            if os.path.realpath(self.opener.join(self.indexfile)).startswith(
+                    store):
+                bundle_blobs.add_revisions(self, start)
+            return result
+        filelog.addgroup = addgroup
+        self.original_addgroup = original
+
+    def stop(self):
+        if self.had_addgroup:
+            filelog.addgroup = self.original_addgroup
+        else:
+            del filelog.addgroup
+        self.spool.close()
+        self.spool = None
+        log("Spooled %d file revisions while pulling" % len(self.spooled))
+
+    def add_revisions(self, filelog, start):
+        path = decodedir(filelog.indexfile[len('data/'):-len('.i')])
+        if is_standin(path):
+            return  # HGImporter streams the largefile instead
+        if not self.path_filter(path):
+            return
+        for rev in xrange(start, len(filelog)):
+            node = filelog.node(rev)
+            data = filelog.read(node)
+            self.spooled[(path, node)] = (self.spool.tell(), len(data))
+            self.spool.write(data)
+
+    def mark(self, path, filenode):
+        '''Return the mark of the blob of filenode of path, sending the blob
+        to git the first time it is asked for, or None if the revision was
+        not part of the pull.'''
+        key = (path, filenode)
+        if key in self.blob_marks:
+            return self.blob_marks[key]
+        if key not in self.spooled:
+            return None
+        if self.spool is None:
+            self.spool = self.spool_path.open('rb')
+        offset, size = self.spooled.pop(key)
+        self.spool.seek(offset)
+        data = self.spool.read(size)
+        mark = self.marks.new_blob_mark()
+        output("blob")
+        output("mark :%d" % mark)
+        output("data %d" % size)
+        output(data)
+        self.blob_marks[key] = mark
+        return mark
+
+    def close(self):
+        '''Remove the spool once the import is done.'''
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        if self.spool_path.exists():
+            self.spool_path.remove()
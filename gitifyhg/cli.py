@@ -0,0 +1,290 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+# The gitifyhg command, for working with the gitifyhg remotes of the git
+# repository in the current directory outside of git fetch and git push.
+
+import os
+import sys
+import optparse
+import subprocess
+from multiprocessing import Pool, cpu_count
+
+from path import Path as p
+from mercurial import hg
+from mercurial.ui import ui
+from mercurial.node import hex as hghex
+
+# Imported first to run Mercurial in the same known state as the helper
+from .gitifyhg import HGRemote
+from .hgimporter import HGImporter
+from .util import die, git_config, git_config_list, GitMarks, HGMarks
+from .commitmap import CommitMap, TO_GIT, TO_HG
+from .prefetch import PendingImport, lock_prefetch, pending_refs
+from .verify import VerifyCache, start_worker, verify_commit
+from .storeformat import (missing_formats, store_size, read_throughput,
+    upgrade_store, recover_upgrade)
+from .metrics import format_size
+from .lfiles import requires_largefiles
+
+from apiwrapper import hg_sha1, hg_enable_extension
+
+
+class Remote(object):
+    '''The files the helper keeps in .git/hg for the gitifyhg remote
+    alias of the git repository in the current directory.'''
+
+    def __init__(self, alias):
+        url = git_config(alias, 'url')
+        if not url or '::' not in url:
+            die("%s is not a gitifyhg remote" % alias)
+        url = url.split('::', 1)[1].decode('utf-8')
+        if hg.islocal(url.encode('utf-8')):
+            url = p(url).abspath()
+        process = subprocess.Popen(['git', 'rev-parse', '--git-dir'],
+            stdout=subprocess.PIPE)
+        git_dir = p(process.communicate()[0].strip().decode('utf-8'))
+        self.alias = alias
+        self.url = url
+        self.git_dir = git_dir.abspath()
+        self.remotedir = self.git_dir.joinpath('hg', hg_sha1(url))
+        if not self.remotedir.joinpath('clone').exists():
+            die("%s has not been fetched yet" % alias)
+
+    def repo(self):
+        clone = self.remotedir.joinpath('clone')
+        myui = ui()
+        if requires_largefiles(clone):
+            hg_enable_extension(myui, 'largefiles')
+        repo = hg.repository(myui, clone.encode('utf-8'))
+        if recover_upgrade(repo):
+            repo = hg.repository(myui, clone.encode('utf-8'))
+        return repo
+
+    def marks(self):
+        '''Return the HGMarks and GitMarks of the remote.'''
+        marks = HGMarks(self.remotedir.joinpath('marks-hg'))
+        if marks.marks_version < 3:
+            # Upgrading needs the helper, which knows the ref prefix
+            die("marks-hg of %s uses an old format, run git fetch %s to "
+                "upgrade it" % (self.alias, self.alias))
+        marks.attach(self.repo())
+        return marks, GitMarks(self.remotedir.joinpath('marks-git'))
+
+    def commit_map(self):
+        '''Return the CommitMap of the remote, brought up to date.'''
+        commit_map = CommitMap(self.remotedir.joinpath('commit-map.db'))
+        marks, git_marks = self.marks()
+        if not commit_map.is_current(marks, git_marks):
+            commit_map.update(marks, git_marks)
+        return commit_map
+
+
+def do_map(args):
+    parser = optparse.OptionParser(
+        usage="usage: %prog map [options] [hash ...]",
+        description="Print the Mercurial changeset of every git commit and "
+            "the git commit of every Mercurial changeset given as a full or "
+            "abbreviated hash, one per line as the hash and what it maps to. "
+            "The hashes are read from stdin if none are given.")
+    parser.add_option("-r", "--remote", default="origin",
+        help="The gitifyhg remote to use (default: %default)")
+    parser.add_option("--to-hg", dest="directions", action="store_const",
+        const=[TO_HG], default=[TO_HG, TO_GIT],
+        help="Only look up git commits")
+    parser.add_option("--to-git", dest="directions", action="store_const",
+        const=[TO_GIT], help="Only look up Mercurial changesets")
+    opts, args = parser.parse_args(args)
+
+    commit_map = Remote(opts.remote).commit_map()
+    missing = 0
+    for line in args or sys.stdin:
+        prefix = line.strip()
+        if not prefix:
+            continue
+        found = []
+        for direction in opts.directions:
+            found = commit_map.lookup(prefix, direction)
+            if found:
+                break
+        if len(found) == 1:
+            sys.stdout.write("%s %s\n" % (prefix, found[0]))
+        else:
+            if found:
+                sys.stderr.write("%s is ambiguous\n" % prefix)
+            sys.stdout.write("%s -\n" % prefix)
+            missing += 1
+    commit_map.close()
+    return 1 if missing else 0
+
+
+def do_prefetch(args):
+    parser = optparse.OptionParser(
+        usage="usage: %prog prefetch [options]",
+        description="Pull new changesets into the clone gitifyhg keeps of "
+            "a remote and render the commits of the refs that changed, so "
+            "that the next git fetch only has to send them to git. Meant "
+            "to be run from cron or a timer; does nothing if another "
+            "prefetch of the remote is still running.")
+    parser.add_option("-r", "--remote", default="origin",
+        help="The gitifyhg remote to prefetch (default: %default)")
+    opts, args = parser.parse_args(args)
+
+    remote = Remote(opts.remote)
+    os.environ['GIT_DIR'] = remote.git_dir.encode('utf-8')
+    lock = lock_prefetch(remote.remotedir)
+    if lock is None:
+        sys.stderr.write("%s is being prefetched already\n" % opts.remote)
+        return 0
+    with lock:
+        # Blobs rendered while pulling would get marks that the prefetched
+        # commits cannot be adopted on top of.
+        hgremote = HGRemote(remote.alias, remote.url, bundle_import=False)
+        with hgremote.metrics.phase('prefetch'):
+            importer = HGImporter(hgremote, None)
+            refs = pending_refs(hgremote, importer)
+            count = PendingImport(hgremote).render(importer, refs)
+    sys.stdout.write("prefetched %d commits of %d refs\n" % (count, len(refs)))
+    return 0
+
+
+def do_verify(args):
+    parser = optparse.OptionParser(
+        usage="usage: %prog verify [options]",
+        description="Check that the git commits of a remote have the same "
+            "files, modes and contents as the Mercurial changesets they "
+            "correspond to. Commits that were verified before are not "
+            "checked again.")
+    parser.add_option("-r", "--remote", default="origin",
+        help="The gitifyhg remote to verify (default: %default)")
+    parser.add_option("--rev", default="all()",
+        help="Mercurial revset of the changesets to verify "
+            "(default: %default)")
+    parser.add_option("-j", "--jobs", type="int", default=cpu_count(),
+        help="Number of processes to compare trees in (default: %default)")
+    parser.add_option("--force", action="store_true",
+        help="Verify commits again even if they were verified before")
+    opts, args = parser.parse_args(args)
+
+    remote = Remote(opts.remote)
+    marks, git_marks = remote.marks()
+    selected = set(hghex(node) for node in
+        (marks.repo.changelog.node(rev) for rev in marks.repo.revs(opts.rev)))
+    cache = VerifyCache(remote.remotedir.joinpath('verify.db'))
+    verified = {} if opts.force else cache.verified()
+    jobs = []
+    cached = 0
+    for mark, revision, alias in marks.mappings_since(0):
+        if alias or revision not in selected or not git_marks.has_mark(mark):
+            continue
+        commit = git_marks.mark_to_hash(mark)
+        if verified.get(revision) == commit:
+            cached += 1
+        else:
+            jobs.append((revision, commit))
+
+    worker = (remote.remotedir.joinpath('clone'), remote.git_dir,
+        (git_config_list(remote.alias, 'hgInclude'),
+         git_config_list(remote.alias, 'hgExclude')), cache.digests())
+    if opts.jobs > 1 and len(jobs) > 1:
+        pool = Pool(opts.jobs, start_worker, worker)
+        results = pool.imap_unordered(verify_commit, jobs, chunksize=16)
+    else:
+        pool = None
+        start_worker(*worker)
+        results = (verify_commit(job) for job in jobs)
+    failed = 0
+    for revision, commit, problems, digests in results:
+        if problems:
+            failed += 1
+            for problem in problems:
+                sys.stdout.write("%s %s: %s\n" % (revision, commit, problem))
+        else:
+            cache.add(revision, commit, digests)
+    if pool:
+        pool.close()
+        pool.join()
+    cache.close()
+    sys.stdout.write("%d verified, %d failed, %d verified before\n" % (
+        len(jobs) - failed, failed, cached))
+    return 1 if failed else 0
+
+
+def report_throughput(phase, repo, sample):
+    size, seconds = read_throughput(repo, sample)
+    sys.stdout.write("%s: read %s in %.2fs (%s/s) from a store of %s\n" % (
+        phase, format_size(size), seconds,
+        format_size(size / max(seconds, 0.001)), format_size(store_size(repo))))
+
+
+def do_upgrade(args):
+    parser = optparse.OptionParser(
+        usage="usage: %prog upgrade [options]",
+        description="Rewrite the Mercurial clone gitifyhg keeps of a remote "
+            "in the fastest store format the installed Mercurial supports, "
+            "computing its deltas again, and report how fast the newest "
+            "changesets can be read before and after.")
+    parser.add_option("-r", "--remote", default="origin",
+        help="The gitifyhg remote whose clone to upgrade (default: %default)")
+    parser.add_option("--sample", type="int", default=1000,
+        help="Number of the newest changesets to read when measuring "
+            "(default: %default)")
+    parser.add_option("--check", action="store_true",
+        help="Only report the store format and read throughput")
+    parser.add_option("--force", action="store_true",
+        help="Rewrite the store even if it uses the fastest format already")
+    opts, args = parser.parse_args(args)
+
+    remote = Remote(opts.remote)
+    repo = remote.repo()
+    missing = missing_formats(repo)
+    if missing:
+        sys.stdout.write("The clone does not use the %s store format\n" %
+            ', '.join(missing))
+    else:
+        sys.stdout.write("The clone uses the fastest store format\n")
+    report_throughput("before", repo, opts.sample)
+    if opts.check or not (missing or opts.force):
+        return 0
+    added = upgrade_store(repo)
+    if added:
+        sys.stdout.write("Upgraded the clone to %s\n" % ', '.join(added))
+    report_throughput("after", remote.repo(), opts.sample)
+    return 0
+
+
+COMMANDS = {
+    'map': do_map,
+    'prefetch': do_prefetch,
+    'upgrade': do_upgrade,
+    'verify': do_verify,
+}
+
+
+def main():
+    '''Main entry point for the gitifyhg command.'''
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        sys.stderr.write("usage: gitifyhg <command> [options]\n\n"
+            "commands:\n")
+        for name in sorted(COMMANDS):
+            sys.stderr.write("  %s\n" % name)
+        return 1
+    return COMMANDS[sys.argv[1]](sys.argv[2:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
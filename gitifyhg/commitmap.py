@@ -0,0 +1,118 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+
+# Both directions of a lookup
+TO_GIT = 'git'
+TO_HG = 'hg'
+
+
+class CommitMap(object):
+    '''An indexed mapping between git commits and Mercurial changesets,
+    kept in a sqlite database in remotedir.
+
+    git writes the hashes of the commits it imported or exported to
+    marks-git only after the helper is done, so the mapping is brought up
+    to date from marks-git and marks-hg by update(), which adds the marks
+    git wrote and the changesets the clone got since the last update.
+    Changesets that a path filter hid from git map to the commit of the
+    changeset they were aliased to; git commits map back to the changeset
+    they were imported from.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS commits (
+                    hg TEXT PRIMARY KEY, git TEXT NOT NULL,
+                    alias INTEGER NOT NULL);
+                CREATE INDEX IF NOT EXISTS commits_git ON commits (git);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            ''')
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def meta(self, key):
+        row = self.connect().execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def last_mark(self):
+        return self.meta('git-mark')
+
+    def is_current(self, hg_marks, git_marks):
+        '''Return True if neither git wrote marks nor were changesets added
+        to the clone since the last update.'''
+        return (self.meta('hg-revs') == hg_marks.rev_count() and
+            next(git_marks.marks_since(self.last_mark()), None) is None)
+
+    def update(self, hg_marks, git_marks):
+        '''Add the commits git wrote marks for since the last update, and
+        the changesets added to the clone since then that a path filter
+        aliased to a commit that is already mapped. Returns the number of
+        changesets added.'''
+        last_mark = self.last_mark()
+        last_rev = self.meta('hg-revs')
+        # Marks beyond those of marks-hg belong to a rejected push and are
+        # removed again before git can reuse them
+        hashes = dict((mark, sha1)
+            for mark, sha1 in git_marks.marks_since(last_mark)
+            if mark <= hg_marks.last_mark)
+        rows = [(revision, hashes[mark], int(alias))
+            for mark, revision, alias in hg_marks.mappings_since(last_mark)
+            if mark in hashes]
+        # Later fetches alias filtered out changesets to older marks, which
+        # mappings_since does not see
+        rows.extend((revision, git_marks.mark_to_hash(mark), 1)
+            for mark, revision, alias in hg_marks.mappings_from_rev(last_rev)
+            if alias and mark <= last_mark and git_marks.has_mark(mark))
+        with self.connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO commits VALUES (?, ?, ?)", rows)
+            if hashes:
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('git-mark', ?)",
+                    (max(hashes),))
+            connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('hg-revs', ?)",
+                (hg_marks.rev_count(),))
+        return len(rows)
+
+    def lookup(self, prefix, direction):
+        '''Return the hashes that the commits whose git (for TO_HG) or hg
+        (for TO_GIT) hash starts with prefix map to. More than one result
+        means the prefix is ambiguous.'''
+        prefix = prefix.lower()
+        if direction == TO_HG:
+            # Aliases of a git commit are left out, only the changeset it
+            # was made from is returned.
+            query = ("SELECT hg FROM commits WHERE git >= ? AND git < ? "
+                "AND alias = 0 LIMIT 2")
+        else:
+            query = "SELECT git FROM commits WHERE hg >= ? AND hg < ? LIMIT 2"
+        return [row[0] for row in
+            self.connect().execute(query, (prefix, prefix + 'g'))]
@@ -0,0 +1,119 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from contextlib import contextmanager
+
+from mercurial import setdiscovery
+from mercurial.node import hex as hghex, bin as hgbin
+
+from .util import log
+
+from apiwrapper import hg_heads_and_known, hg_in_view
+
+
+class DiscoveryCache(object):
+    '''Remembers the heads of the changesets the local clone and the remote
+    repository had in common after the last successful pull or push, in
+    the JSON file discovery in remotedir.
+
+    Mercurial discovers the common changesets by sampling the local history
+    and asking the remote which of them it knows, which takes many round
+    trips in repositories with many heads. Inside seeded(), discovery
+    asks the remote for its heads and whether it still knows the cached
+    common heads and the local heads in a single round trip, and only falls
+    back to sampling when the remote no longer has the cached heads, for
+    example after a strip. Without a path, nothing is cached.'''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.common = []
+        self.remote_heads = None
+        if self.path is not None and self.path.exists():
+            with self.path.open() as file:
+                self.common = [hgbin(node) for node in json.load(file)]
+
+    def store(self, common):
+        '''Remember the nodes in common as known to both sides.'''
+        self.common = list(common)
+        if self.path is None:
+            return
+        if not self.path.parent.exists():
+            self.path.parent.makedirs()
+        with self.path.open('w') as file:
+            file.write(json.dumps([hghex(node) for node in self.common]
+                ).decode('UTF-8'))
+
+    def store_pulled(self):
+        '''Remember the remote heads seen by the last discovery, which a
+        pull of every head brought into the local clone.'''
+        if self.remote_heads is not None:
+            self.store(self.remote_heads)
+
+    def store_pushed(self, repo):
+        '''Remember that a push of repo brought every changeset of repo that
+        can be pushed to the remote, which still has the heads it had
+        before. repo is the view that was pushed, whose hidden changesets
+        the remote does not necessarily have.'''
+        pushed = [ctx.node() for ctx in repo.set('heads(not secret())')]
+        repo = repo.unfiltered()
+        nodemap = repo.changelog.nodemap
+        nodes = [node for node in self.remote_heads or () if node in nodemap]
+        self.store([ctx.node() for ctx in
+            repo.set('heads(%ln)', nodes + pushed)])
+
+    @contextmanager
+    def seeded(self):
+        '''Seed the discoveries of the pulls and pushes in the body of the
+        with statement from the cache.'''
+        if self.path is None:
+            yield self
+            return
+        findcommonheads = setdiscovery.findcommonheads
+
+        def seeded_findcommonheads(ui, local, remote, *args, **kwargs):
+            result = self.findcommonheads(local, remote)
+            if result is None:
+                result = findcommonheads(ui, local, remote, *args, **kwargs)
+            self.remote_heads = result[2]
+            return result
+
+        setdiscovery.findcommonheads = seeded_findcommonheads
+        try:
+            yield self
+        finally:
+            setdiscovery.findcommonheads = findcommonheads
+
+    def findcommonheads(self, local, remote):
+        '''Return what setdiscovery.findcommonheads does, or None if the
+        cache does not help. Like setdiscovery, this only returns changesets
+        in the view of local.'''
+        known = [node for node in self.common if hg_in_view(local, node)]
+        if not known:
+            return None
+        own_heads = [node for node in local.heads() if node not in known]
+        remote_heads, yesno = hg_heads_and_known(remote, known + own_heads)
+        if not all(yesno[:len(known)]):
+            log("Cached common heads are gone from the remote")
+            return None
+        log("Seeded discovery with %d cached common heads" % len(known))
+        common = known + [node for node, found in
+            zip(own_heads, yesno[len(known):]) if found]
+        common += [node for node in remote_heads if hg_in_view(local, node)]
+        incoming = not all(hg_in_view(local, node) for node in remote_heads)
+        return ([ctx.node() for ctx in local.set('heads(%ln)', common)],
+            incoming, remote_heads)
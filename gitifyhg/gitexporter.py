@@ -22,15 +22,21 @@ from mercurial.context import memctx
 from mercurial.error import Abort
 from mercurial.node import hex as hghex  # What idiot overrode a builtin?
 from mercurial.node import short as hgshort
-from mercurial.bookmarks import pushbookmark
+from mercurial.lock import release
 from mercurial.scmutil import revsingle
 from mercurial.util import version as hg_version
 from mercurial import encoding
 
-from .util import (die, output, git_to_hg_spaces, hgmode, branch_tip,
-    ref_to_name_reftype, BRANCH, BOOKMARK, TAG, user_config)
+from .util import (die, output, progress, git_to_hg_spaces, hgmode,
+    branch_tip, ref_to_name_reftype, BRANCH, BOOKMARK, TAG, user_config)
 
-from apiwrapper import (hg_strip, hg_memfilectx, hg_push, handle_deleted_file)
+from .lfiles import (SpooledBlob, blob_data, blob_size, is_largefiles_repo,
+    standin, min_largefile_size, write_largefile, CHUNK_SIZE)
+from .parallel import ParallelCompressor
+from .blobindex import BlobIndex, blob_hasher, hashed_chunks
+
+from apiwrapper import (hg_memfilectx, hg_push, hg_transaction,
+    hg_setbookmark, hg_manifest_diff, hg_in_view, handle_deleted_file)
 
 class GitExporter(object):
 
@@ -49,13 +55,67 @@ class GitExporter(object):
         self.repo = self.hgremote.repo
         self.parser = parser
         self.processed_marks = set()
-        self.processed_nodes = []
         self.hgrc = user_config()
+        self.largefiles = is_largefiles_repo(self.repo)
+        self.spool_dir = self.hgremote.remotedir.joinpath('spool')
+        self.metrics = self.hgremote.metrics
+        self.memory = self.hgremote.memory
+        self.memory.register('pushed blobs', self.spill_blobs)
+        self.compressor = ParallelCompressor.from_git_config(self.repo,
+            self.hgremote.alias)
+        self.blob_shas = {}  # blob marks to git object names
+        self.blob_index = BlobIndex(
+            self.hgremote.remotedir.joinpath('blob-index'))
 
     def process(self):
         self.marks.store()  # checkpoint
+        # Every commit, tag and bookmark of this export is written inside a
+        # single transaction, which is closed before pushing. If the push
+        # fails, rolling that transaction back truncates the revlogs to
+        # where they were, which only costs as much as the data written by
+        # this export. The locks are held until then, so the transaction
+        # rolled back is always this one.
+        tr, lock, wlock = hg_transaction(self.repo, 'gitifyhg-export')
+        try:
+            try:
+                new_branch, push_bookmarks, updated_refs = \
+                    self.process_transaction(tr)
+                tr.close()
+            finally:
+                release(tr)
+                if self.spool_dir.exists():
+                    self.spool_dir.rmtree()
+            success = self.push(new_branch, push_bookmarks)
+        finally:
+            release(lock, wlock)
+
+        for ref, node in updated_refs.items():
+            if success:
+                status = ""
+                name, reftype = ref_to_name_reftype(ref)
+                gitify_ref = self.hgremote.make_gitify_ref(name, reftype)
+                last_known_rev = self.marks.tips.get(gitify_ref)
+                new_rev = self.repo[node].rev()
+                if last_known_rev is not None and last_known_rev == new_rev:
+                    # up to date status tells git that nothing has changed
+                    # during the push for this ref, which prevents it from
+                    # printing pointless status info to the user such as:
+                    #  * [new branch]      master -> master
+                    status = " up to date"
+                output("ok %s%s" % (ref, status))
+            else:
+                output("error %s non-fast forward" % ref)  # TODO: other errors as well
+        output()
+
+        if not success:
+            # wait until fast-export finishes to muck with the marks file
+            self.hgremote.git_marks.remove_marks(self.processed_marks)
+        self.hgremote.update_commit_map()
+
+    def process_transaction(self, tr):
         new_branch = False
         push_bookmarks = []
+        pending_tags = {}  # branch to list of (name, node) tuples
         self.parser.read_line()
         for line in self.parser.read_block('done'):
             command = line.split()[0]
@@ -76,71 +136,65 @@ class GitExporter(object):
             elif reftype == BOOKMARK:
                 old = self.hgremote.bookmarks.get(name)
                 old = old.hex() if old else ''
-                if not pushbookmark(self.repo, name, old, node):
+                if not hg_setbookmark(self.repo, tr, name, old, node):
                     continue
                 push_bookmarks.append((name, old, hghex(node)))
             elif reftype == TAG:
-                self.write_tag(name, node)
+                branch = self.repo[node].branch()
+                pending_tags.setdefault(branch, []).append((name, node))
             else:
                 assert False, "unexpected reftype: %s" % reftype
             updated_refs[ref] = node
 
-        success = False
+        for branch, tags in pending_tags.iteritems():
+            self.write_tags(branch, tags)
+        return new_branch, push_bookmarks, updated_refs
+
+    def push(self, new_branch, push_bookmarks):
+        '''Push the committed export to the remote. Returns False if the
+        remote rejected it, after rolling the export back.'''
         try:
-            hg_push(self.repo, self.hgremote.peer, False, new_branch)
+            with self.hgremote.discovery.seeded() as discovery:
+                hg_push(self.repo, self.hgremote.peer, False, new_branch)
+            discovery.store_pushed(self.repo)
 
             for bookmark, old, new in push_bookmarks:
                 self.hgremote.peer.pushkey('bookmarks', bookmark, old, new)
             self.marks.store()
-            success = True
+            self.blob_index.store()
+            return True
         except Abort as e:
             # mercurial.error.Abort: push creates new remote head f14531ca4e2d!
             if e.message.startswith("push creates new remote head"):
+                self.repo.rollback()
                 self.marks.load()  # restore from checkpoint
-                # strip revs, implementation finds min revision from list
-                if self.processed_nodes:
-                    hg_strip(self.repo, self.processed_nodes)
-            else:
-                die("unknown hg exception: %s" % e)
-        # TODO: handle network/other errors?
-
-        for ref, node in updated_refs.items():
-            if success:
-                status = ""
-                name, reftype = ref_to_name_reftype(ref)
-                gitify_ref = self.hgremote.make_gitify_ref(name, reftype)
-                last_known_rev = self.marks.tips.get(gitify_ref)
-                new_rev = self.repo[node].rev()
-                if last_known_rev is not None and last_known_rev == new_rev:
-                    # up to date status tells git that nothing has changed
-                    # during the push for this ref, which prevents it from
-                    # printing pointless status info to the user such as:
-                    #  * [new branch]      master -> master
-                    status = " up to date"
-                output("ok %s%s" % (ref, status))
-            else:
-                output("error %s non-fast forward" % ref)  # TODO: other errors as well
-        output()
-
-        if not success:
-            # wait until fast-export finishes to muck with the marks file
-            self.remove_processed_git_marks()
-
-    def remove_processed_git_marks(self):
-        with self.hgremote.marks_git_path.open() as fread:
-            with self.hgremote.marks_git_path.open('r+') as fwrite:
-                for line in fread:
-                    if not line.startswith(':'):
-                        die("invalid line in marks-git: " + line)
-                    mark = line[1:].split()[0]
-                    if mark not in self.processed_marks:
-                        fwrite.write(line)
-                fwrite.truncate()
+                self.blob_index.discard()
+                return False
+            # TODO: handle network/other errors?
+            die("unknown hg exception: %s" % e)
 
     def do_blob(self):
         mark = self.parser.read_mark()
-        self.blob_marks[mark] = self.parser.read_data()
+        size = self.parser.read_data_size()
+        self.metrics.add_bytes(size)
+        hasher = blob_hasher(size)
+        if size > self.memory.spool_size:
+            self.blob_marks[mark] = SpooledBlob.spool(self.spool_dir, mark,
+                size, hashed_chunks(hasher,
+                    self.parser.read_data_chunks(size, CHUNK_SIZE)))
+        else:
+            self.blob_marks[mark] = self.parser.read_bytes(size)
+            hasher.update(self.blob_marks[mark])
+        self.blob_shas[mark] = hasher.hexdigest()
         self.parser.read_line()
+        self.memory.check()
+
+    def spill_blobs(self):
+        '''Move the blobs kept in memory to the spool directory.'''
+        for mark, blob in self.blob_marks.items():
+            if not isinstance(blob, SpooledBlob):
+                self.blob_marks[mark] = SpooledBlob.spool(self.spool_dir,
+                    mark, len(blob), [blob])
 
     def do_reset(self):
         ref = self.parser.line.split()[1]
@@ -180,12 +234,17 @@ class GitExporter(object):
             if line.startswith('M'):
                 t, mode, mark_ref, path = line.split(' ', 3)
                 mark = int(mark_ref[1:])
-                filespec = {'mode': hgmode(mode), 'data': self.blob_marks[mark]}
+                filespec = {'mode': hgmode(mode), 'data': self.blob_marks[mark],
+                    'sha': self.blob_shas[mark]}
             elif line.startswith('D'):
                 t, path = line.split(' ', 1)
                 filespec = {'deleted': True}
             if path[0] == '"' and path[-1] == '"':
                 path = path.decode('string-escape')[1:-1]
+            if not self.hgremote.path_filter(path):
+                die("%s is outside of the paths imported from this remote "
+                    "(see remote.%s.hgInclude and hgExclude)" % (
+                        path, self.hgremote.alias))
             files[path] = filespec
 
         user, date, tz = author
@@ -194,22 +253,26 @@ class GitExporter(object):
             extra['committer'] = "%s %u %u" % committer
 
         if from_mark:
-            parent_from = self.marks.mark_to_revision(from_mark)
+            parent_from = self.parent_revision(from_mark)
         else:
             parent_from = self.NULL_PARENT
 
         if merge_mark:
-            parent_merge = self.marks.mark_to_revision(merge_mark)
+            parent_merge = self.parent_revision(merge_mark)
         else:
             parent_merge = self.NULL_PARENT
 
+        # Largefiles are replaced by their standins first, which are never
+        # reused because their contents are not the pushed blobs
+        if self.largefiles:
+            files = self.largefile_standins(files, (parent_from, parent_merge))
+
+        self.reuse_file_revisions(files, (parent_from, parent_merge))
+
         # hg needs to know about files that changed from either parent
         # whereas git only cares if it changed from the first parent.
         if merge_mark:
-            for file in self.repo[parent_from].files():
-                if file not in files and file in\
-                        self.repo[parent_from].manifest():
-                    files[file] = {'ctx': self.repo[parent_from][file]}
+            self.add_merged_files(files, parent_from, parent_merge)
 
         name, reftype = ref_to_name_reftype(ref)
         if reftype == BRANCH:
@@ -226,20 +289,127 @@ class GitExporter(object):
             is_link = filespec['mode'] == 'l'
             rename = filespec.get('rename', None)
 
-            return hg_memfilectx(repo,file, filespec['data'],is_link, is_exec, rename)
+            return hg_memfilectx(repo, file, blob_data(filespec['data']),
+                is_link, is_exec, rename)
 
         ctx = memctx(self.repo, (parent_from, parent_merge), data,
             files.keys(), get_filectx, user, (date, tz), extra)
 
         tmp = encoding.encoding
         encoding.encoding = 'utf-8'
-        node = self.repo.commitctx(ctx)
+        with self.compressor.precompress(files, (parent_from, parent_merge)):
+            node = self.repo.commitctx(ctx)
         encoding.encoding = tmp
 
+        self.index_blobs(node, files)
+        self.metrics.add_commit(len(files))
+        self.memory.check()
+        if self.metrics.due():
+            progress("exported %s" % self.metrics.status())
         self.parsed_refs[ref] = node
         self.marks.new_mark(node, commit_mark)
         self.processed_marks.add(str(commit_mark))
-        self.processed_nodes.append(node)
+
+    def parent_revision(self, mark):
+        '''Return the changeset of the parent with mark, which has to be in
+        the view of the clone to commit on top of it.'''
+        node = self.marks.mark_to_revision(mark)
+        if not hg_in_view(self.repo, node):
+            die("%s is obsolete or hidden in Mercurial. Fetch and rebase "
+                "onto its successor before pushing." % hgshort(node))
+        return node
+
+    def reuse_file_revisions(self, files, parents):
+        '''Replace the files whose blob was pushed before as the very file
+        revision one of the parents has with a reference to that revision.
+        Mercurial reuses referenced parent revisions as they are, instead
+        of comparing and hashing the contents again. This mostly happens
+        for merges, where git lists the files taken from the second parent
+        as modified. Like a merge committed by Mercurial, the revision of
+        the second parent is only reused if the first parent does not have
+        the file or has an ancestor of that revision; otherwise a new file
+        revision has to record both parents.
+
+        Mercurial only takes a referenced revision as it is if it is the
+        revision of a parent. Reverts and cherry-picks get a new file
+        revision whose parents differ from those of the earlier one, and
+        a file revision belongs to the history of a single path, so these
+        are committed from the blob like any other change.'''
+        candidates = [path for path, filespec in files.iteritems()
+            if 'sha' in filespec and
+            self.blob_index.get(filespec['sha'], path)]
+        if not candidates:
+            return
+        ctxs = [self.repo[parent] for parent in parents]
+        manifests = [ctx.manifest() for ctx in ctxs]
+        for path in candidates:
+            filespec = files[path]
+            filenodes = self.blob_index.get(filespec['sha'], path)
+            for ctx, manifest in zip(ctxs, manifests):
+                filenode = manifest.get(path)
+                if (filenode in filenodes and
+                        manifest.flags(path) == filespec['mode'] and
+                        self.descends_from(path, filenode,
+                            manifests[0].get(path))):
+                    files[path] = {'ctx': ctx[path]}
+                    break
+
+    def descends_from(self, path, filenode, ancestor):
+        '''Return True if the revision filenode of path is, or descends
+        from, the revision ancestor, which may be None.'''
+        if ancestor is None or ancestor == filenode:
+            return True
+        filelog = self.repo.file(path)
+        return filelog.ancestor(ancestor, filenode) == ancestor
+
+    def add_merged_files(self, files, parent_from, parent_merge):
+        '''Add the files that differ between the parents of a merge but that
+        git did not list because they did not change from the first parent.
+        They keep the file revision of the first parent. The files come from
+        a single manifest diff and are referenced by their filenodes through
+        one changectx, so merges of long-lived branches that touch many files
+        do not look up the parent and its manifest again for every file.'''
+        ctx = self.repo[parent_from]
+        manifest = ctx.manifest()
+        for path in hg_manifest_diff(manifest,
+                self.repo[parent_merge].manifest()):
+            if path not in files and path in manifest:
+                files[path] = {'ctx': ctx.filectx(path, fileid=manifest[path])}
+
+    def index_blobs(self, node, files):
+        '''Record which file revisions of the commit node the pushed blobs
+        became.'''
+        manifest = None
+        for path, filespec in files.iteritems():
+            if 'sha' not in filespec:
+                continue
+            if manifest is None:
+                manifest = self.repo[node].manifest()
+            if path in manifest:
+                self.blob_index.add(filespec['sha'], path, manifest[path])
+
+    def largefile_standins(self, files, parents):
+        '''Replace the paths in files that are, or should become, largefiles
+        with their standins, moving the contents into the largefiles store.
+        A file is a largefile if either parent tracks it as one, or if it is
+        new and at least as large as the configured largefiles minsize.'''
+        manifests = [self.repo[parent].manifest() for parent in parents]
+        min_size = min_largefile_size(self.repo)
+        standins = {}
+        for path, filespec in files.iteritems():
+            name = standin(path)
+            tracked = any(name in manifest for manifest in manifests)
+            if 'deleted' in filespec:
+                if tracked:
+                    path = name
+            elif tracked or (
+                    not any(path in manifest for manifest in manifests) and
+                    blob_size(filespec['data']) >= min_size):
+                filespec = {'mode': filespec['mode'],
+                    'data': write_largefile(self.repo, filespec['data'])}
+                path = name
+            standins[path] = filespec
+        return standins
 
     def do_tag(self):
         name = self.parser.line.split()[1]
@@ -252,8 +422,9 @@ class GitExporter(object):
     def do_feature(self):
         pass  # Ignore
 
-    def write_tag(self, name, node):
-        branch = self.repo[node].branch()
+    def write_tags(self, branch, tags):
+        '''Add all tags, a list of (name, node) tuples, to the .hgtags file
+        of branch in a single commit.'''
         # Calling self.repo.tag() doesn't append the tag to the correct
         # commit. So I copied some of localrepo._tag into here.
         # But that method, like much of mercurial's code, is ugly.
@@ -264,32 +435,51 @@ class GitExporter(object):
             old_tags = tags_revision['.hgtags'].data()
         else:
             old_tags = ''
+        existing = set(old_tags.splitlines())
+
+        new_lines = []
+        new_tags = []
+        for name, node in sorted(tags):
+            tag_line = '%s %s' % (hghex(node), encoding.fromlocal(name))
+            if tag_line in existing:
+                continue  # Don't commit a tag that was previously committed
+            existing.add(tag_line)
+            new_lines.append(tag_line)
+            new_tags.append((name, node))
+        if not new_tags:
+            return
+
         newtags = [old_tags]
         if old_tags and old_tags[-1] != '\n':
             newtags.append('\n')
-
-        encoded_tag = encoding.fromlocal(name)
-        tag_line = '%s %s' % (hghex(node), encoded_tag)
-        if tag_line in old_tags:
-            return  # Don't commit a tag that was previously committed
-        newtags.append(tag_line)
+        newtags.append('\n'.join(new_lines))
 
         def get_filectx(repo, memctx, file):
             return hg_memfilectx(repo, file, ''.join(newtags))
 
-        if name in self.parsed_tags:
-            author, message = self.parsed_tags[name]
-            user, date, tz = author
+        # The commit is attributed to the first annotated tag in the batch;
+        # lightweight tags fall back to the configured hg username.
+        tagger = None
+        messages = []
+        for name, node in new_tags:
+            if name in self.parsed_tags:
+                author, message = self.parsed_tags[name]
+                tagger = tagger or author
+            else:
+                message = "Added tag %s for changeset %s" % (name, hgshort(node))
+            messages.append(message)
+        if tagger:
+            user, date, tz = tagger
             date_tz = (date, tz)
         else:
-            message = "Added tag %s for changeset %s" % (name, hgshort(node))
             user = self.hgrc.get("ui", "username", None)
             date_tz = None  # XXX insert current date here
         ctx = memctx(self.repo,
-            (branch_tip(self.repo, branch), self.NULL_PARENT), message,
-            ['.hgtags'], get_filectx, user, date_tz, {'branch': branch})
+            (branch_tip(self.repo, branch), self.NULL_PARENT),
+            '\n'.join(messages), ['.hgtags'], get_filectx, user, date_tz,
+            {'branch': branch})
 
         tmp = encoding.encoding
         encoding.encoding = 'utf-8'
-        node = self.repo.commitctx(ctx)
+        self.repo.commitctx(ctx)
         encoding.encoding = tmp
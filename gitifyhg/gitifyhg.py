@@ -34,7 +34,7 @@ os.environ['HGRCPATH'] = ''
 
 from .util import (log, die, output, branch_head, GitMarks,
     HGMarks, hg_to_git_spaces, name_reftype_to_ref, BRANCH, BOOKMARK, TAG,
-    version, deactivate_stdout)
+    version, deactivate_stdout, git_config, git_config_bool)
 
 # Version specific libraries from the Mercurial API
 from mercurial import hg
@@ -42,13 +42,28 @@ from mercurial import encoding
 from mercurial.bookmarks import listbookmarks
 from mercurial.ui import ui
 from mercurial.error import Abort, RepoError
+from mercurial.node import bin as hgbin
 from mercurial.util import version as hg_version
 
 from .util import (log, die, output, branch_head, GitMarks,
     HGMarks, hg_to_git_spaces, name_reftype_to_ref, BRANCH, BOOKMARK, TAG,
     version, deactivate_stdout)
 
-from apiwrapper import (hg_sha1, hg_readactive, hg_pull)
+from apiwrapper import (hg_sha1, hg_readactive, hg_pull, hg_enable_extension,
+    hg_clear_caches, hg_enable_obsolescence,
+    hg_disable_obsolescence_exchange, hg_repo_view, hg_in_view,
+    hg_fast_store_format)
+from .lfiles import requires_largefiles
+from .narrow import PathFilter
+from .reffilter import RefFilter
+from .bundleimport import BundleBlobs
+from .warmcache import CacheWarmer
+from .metrics import Metrics
+from .memory import MemoryGovernor
+from .discovery import DiscoveryCache
+from .commitmap import CommitMap
+from .storeformat import missing_formats, recover_upgrade
+from .harness import SessionRecorder
 from .hgimporter import HGImporter
 from .gitexporter import GitExporter
 
@@ -82,11 +97,32 @@ class GitRemoteParser(object):
 
     def read_data(self):
         '''Read all data following a data line for the given number of bytes'''
+        size = self.read_data_size()
+        if size is None:
+            return None
+        return self.read_bytes(size)
+
+    def read_bytes(self, size):
+        '''Read exactly size bytes of raw data from the standard input.'''
+        return sys.stdin.read(size)
+
+    def read_data_size(self):
+        '''Read a data line and return the number of bytes that follow it,
+        leaving the bytes themselves on stdin.'''
         self.read_line()
         if not self.line.startswith('data'):
             return None
-        size = int(self.line.partition(' ')[-1])
-        return sys.stdin.read(size)
+        return int(self.line.partition(' ')[-1])
+
+    def read_data_chunks(self, size, chunk_size):
+        '''Yield size bytes of data from stdin in chunks of at most
+        chunk_size bytes.'''
+        while size > 0:
+            chunk = self.read_bytes(min(size, chunk_size))
+            if not chunk:
+                die("unexpected end of data")
+            size -= len(chunk)
+            yield chunk
 
     def read_author(self):
         '''Read and parse an author string. Return a tuple of
@@ -115,8 +151,8 @@ class GitRemoteParser(object):
             self.line = self.read_line()
 
 class HGRemote(object):
-    def __init__(self, alias, url):
-        if hg.islocal(url.encode('utf-8')):
+    def __init__(self, alias, url, bundle_import=True):
+        if hg.islocal(url.encode('utf-8')) and url != p(url).abspath():
             url = p(url).abspath()
             # Force git to use an absolute path in the future
             remote_name = os.path.basename(sys.argv[0]).replace("git-remote-", "")
@@ -144,24 +180,62 @@ class HGRemote(object):
         self.prefix = 'refs/hg/%s' % alias
         self.alias = alias
         self.url = url
-        self.build_repo(url)
+        self.bundle_import = bundle_import
+        self.memory = MemoryGovernor.from_git_config(alias)
+        self.metrics = Metrics(alias, self.remotedir, self.memory)
+        if git_config_bool(alias, 'hgDiscoveryCache', True):
+            self.discovery = DiscoveryCache(
+                self.remotedir.joinpath('discovery'))
+        else:
+            self.discovery = DiscoveryCache()
+        # Needed by build_repo to leave filtered out files out of the blobs
+        # rendered while pulling
+        self.path_filter = PathFilter.from_git_config(alias,
+            self.remotedir.joinpath('clone').realpath().encode('utf-8'))
+        self.marks.check_path_filter(self.path_filter.config())
+        with self.metrics.phase('pull'):
+            self.build_repo(url)
+        self.ref_filter = RefFilter(alias, self.remotedir.joinpath('ref-dates'))
 
     def build_repo(self, url):
         '''Make the Mercurial repo object self.repo available. If the local
         clone does not exist, clone it, otherwise, ensure it is fetched.'''
         myui = ui()
         myui.setconfig('ui', 'interactive', 'off')
-        myui.setconfig('extensions', 'mq', '')
         # FIXME: the following is a hack to achieve hg-git / remote-git compatibility
         # at least for *local* operations. still need to figure out what the right
         # thing to do is.
         myui.setconfig('phases', 'publish', False)
+        hg_enable_obsolescence(myui)
+        hg_fast_store_format(myui)
+
+        # The stream cache replays commits that refer to blobs inline, so
+        # it cannot be combined with rendering blobs during the pull.
+        self.bundle_blobs = None
+        if (self.bundle_import and
+                git_config_bool(self.alias, 'hgBundleImport') and
+                not git_config(self.alias, 'hgStreamCache')):
+            self.bundle_blobs = BundleBlobs(
+                self.remotedir.joinpath('blobs'), self.marks, self.path_filter)
 
         local_path = self.remotedir.joinpath('clone')
-        if not local_path.exists():
+        start = 0
+        cloned = not local_path.exists()
+        if cloned:
             try:
-                self.peer, dstpeer = hg.clone(myui, {}, url.encode('utf-8'),
-                    local_path.encode('utf-8'), update=False, pull=True)
+                if self.uses_largefiles(myui, url, local_path):
+                    hg_enable_extension(myui, 'largefiles')
+                if self.bundle_blobs:
+                    self.bundle_blobs.start(local_path)
+                try:
+                    with self.discovery.seeded():
+                        self.peer, dstpeer = hg.clone(myui, {},
+                            url.encode('utf-8'), local_path.encode('utf-8'),
+                            update=False, pull=True)
+                    self.discovery.store_pulled()
+                finally:
+                    if self.bundle_blobs:
+                        self.bundle_blobs.stop()
             except (RepoError, Abort) as e:
                 sys.stderr.write("abort: %s\n" % e)
                 if e.hint:
@@ -170,11 +244,71 @@ class HGRemote(object):
 
             self.repo = dstpeer.local()
         else:
+            if self.uses_largefiles(myui, url, local_path):
+                hg_enable_extension(myui, 'largefiles')
             self.repo = hg.repository(myui, local_path.encode('utf-8'))
+            if recover_upgrade(self.repo):
+                self.repo = hg.repository(myui, local_path.encode('utf-8'))
             self.peer = hg.peer(myui, {}, url.encode('utf-8'))
-            hg_pull(self.repo, self.peer, None, True)
+            if missing_formats(self.repo):
+                log("The local clone does not use the %s store format, "
+                    "run gitifyhg upgrade to read it faster" %
+                    ', '.join(missing_formats(self.repo)))
+            if self.bundle_blobs:
+                self.bundle_blobs.start(local_path)
+            start = len(self.repo)
+            try:
+                with self.discovery.seeded():
+                    hg_pull(self.repo, self.peer, None, True)
+                self.discovery.store_pulled()
+            finally:
+                if self.bundle_blobs:
+                    self.bundle_blobs.stop()
+
+        # Obsolescence markers are pulled to hide what they obsolete, but
+        # pushes leave them out
+        hg_disable_obsolescence_exchange(self.repo.ui)
+
+        # Hidden (obsolete) changesets, and secret ones in the served view,
+        # are left out of listing and importing.
+        view = git_config(self.alias, 'hgRepoView', 'visible')
+        if view not in ('visible', 'served'):
+            die("remote.%s.hgRepoView must be visible or served" % self.alias)
+        self.repo = hg_repo_view(self.repo, view)
+
+        self.metrics.add_commits(len(self.repo) - start)
+        # A fresh clone has just written every revlog and its caches, and
+        # the import reads all of it anyway
+        if (not cloned and len(self.repo) > start and
+                git_config_bool(self.alias, 'hgWarmCaches', True)):
+            CacheWarmer(self.repo, start).warm()
 
         self.marks.upgrade_marks(self)
+        self.marks.attach(self.repo)
+        self.memory.register('Mercurial caches',
+            lambda: hg_clear_caches(self.repo))
+
+    def uses_largefiles(self, myui, url, local_path):
+        '''Return True if the local clone, or the repository at url if it
+        has not been cloned yet, stores files with the largefiles extension.'''
+        if local_path.exists() and requires_largefiles(local_path):
+            return True
+        if hg.islocal(url.encode('utf-8')):
+            return requires_largefiles(p(url))
+        if local_path.exists():
+            return False
+        return bool(hg.peer(myui, {}, url.encode('utf-8')).capable('largefiles'))
+
+    def update_commit_map(self):
+        '''Bring the commit map up to date once gitifyhg map has created
+        it. Commits that git writes marks for after this session are added
+        by the next update.'''
+        path = self.remotedir.joinpath('commit-map.db')
+        if path.exists():
+            commit_map = CommitMap(path)
+            if not commit_map.is_current(self.marks, self.git_marks):
+                commit_map.update(self.marks, self.git_marks)
+            commit_map.close()
 
     def make_gitify_ref(self, name, reftype):
         if not isinstance(name, unicode):
@@ -203,9 +337,13 @@ class HGRemote(object):
 
         for line in parser.read_block(''):
             command = line.split()[0]
-            if command not in ('capabilities', 'list', 'import', 'export'):
+            if command == 'capabilities':
+                self.do_capabilities(parser)
+            elif command in ('list', 'import', 'export'):
+                with self.metrics.phase(command):
+                    getattr(self, 'do_%s' % command)(parser)
+            else:
                 die('unhandled command: %s' % line)
-            getattr(self, 'do_%s' % command)(parser)
 
         try:
             self.marks.store()
@@ -235,9 +373,9 @@ class HGRemote(object):
         output()
 
     def _change_hash(self, changectx):
-        node = changectx.node()
-        if node and self.marks.is_marked(node):
-            mark = self.marks.revision_to_mark(node)
+        rev = changectx.rev()
+        if rev is not None and self.marks.rev_is_marked(rev):
+            mark = self.marks.rev_to_mark(rev)
             if self.git_marks.has_mark(mark):
                 return self.git_marks.mark_to_hash(mark)
         return '?'
@@ -246,6 +384,8 @@ class HGRemote(object):
         '''List all references in the mercurial repository. This includes
         the current head, all branches, tags, and bookmarks.'''
 
+        self.git_marks.remove_marks_after(self.marks.last_mark)
+
         current_branch = self.repo.dirstate.branch()
 
         # Update the head reference
@@ -272,10 +412,16 @@ class HGRemote(object):
 
         # Update the bookmark references
         for bookmark, node in listbookmarks(self.repo).iteritems():
-            self.bookmarks[bookmark] = self.repo[node]
+            if hg_in_view(self.repo, hgbin(node)):
+                self.bookmarks[bookmark] = self.repo[node]
 
         # update the named branch references
-        for branch in self.repo.branchmap():
+        changelog = self.repo.changelog
+        for branch, heads in self.repo.branchmap().iteritems():
+            newest = max(heads, key=changelog.rev)
+            if branch != current_branch and not self.ref_filter(
+                    self.repo, BRANCH, branch, newest):
+                continue
             # FIXME: Probably a git config instead of an env var would make
             # people happier here.
             clone_closed = os.environ.get("GITIFYHG_ALLOW_CLOSED_BRANCHES") != None
@@ -294,18 +440,22 @@ class HGRemote(object):
 
         # list the bookmark references
         for bookmark, changectx in self.bookmarks.items():
-            if bookmark != "master":
+            if bookmark != "master" and (bookmark == self.headnode[0] or
+                    self.ref_filter(self.repo, BOOKMARK, bookmark,
+                        changectx.node())):
                 output("%s %s" %
                         (self._change_hash(changectx),
                          name_reftype_to_ref(hg_to_git_spaces(bookmark), BOOKMARK)))
 
         # list the tags
         for tag, node in self.repo.tagslist():
-            if tag != "tip":
+            if (tag != "tip" and hg_in_view(self.repo, node) and
+                    self.ref_filter(self.repo, TAG, tag, node)):
                 output("%s %s" %
                         (self._change_hash(self.repo[node]),
                          name_reftype_to_ref(hg_to_git_spaces(tag), TAG)))
 
+        self.ref_filter.store()
         output()
 
     def do_import(self, parser):
@@ -344,7 +494,13 @@ def main():
         sys.exit(0)
 
     deactivate_stdout()
-    HGRemote(*[x.decode('utf-8') for x in args]).process()
+    remote = HGRemote(*[x.decode('utf-8') for x in args])
+    recorder = SessionRecorder.from_environment(remote)
+    try:
+        remote.process()
+    finally:
+        if recorder:
+            recorder.close()
     try:
         sys.stderr.close()
     except:
@@ -0,0 +1,289 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+# Recording helper sessions and replaying them without git, to measure the
+# helper on its own.
+#
+# If the environment variable GITIFYHG_RECORD names a directory, every
+# session of the helper is recorded into a new subdirectory of it: the
+# protocol input git sent, the output the helper sent back, the files of
+# the remote's directory in .git/hg as they were when the session started
+# and the remote's git configuration. gitifyhg-replay runs the helper on a
+# recorded input again, against throwaway copies of the Mercurial clone,
+# with the output going to a sink instead of git, and reports how much CPU
+# time and memory the helper needed and how fast it was.
+
+import os
+import sys
+import json
+import time
+import shutil
+import optparse
+import resource
+import tempfile
+import subprocess
+
+from path import Path as p
+from mercurial import hg
+from mercurial.ui import ui
+from mercurial.node import hex as hghex
+from mercurial.util import version as hg_version
+
+from . import util
+from .util import log, die, version, deactivate_stdout, remote_config
+
+from apiwrapper import hg_sha1
+
+
+class TeeInput(object):
+    '''Reads from stream and copies everything that was read to copy.'''
+
+    def __init__(self, stream, copy):
+        self.stream = stream
+        self.copy = copy
+
+    def readline(self):
+        line = self.stream.readline()
+        self.copy.write(line)
+        return line
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.copy.write(data)
+        return data
+
+
+class TeeOutput(object):
+    '''Writes to stream and to copy.'''
+
+    def __init__(self, stream, copy):
+        self.stream = stream
+        self.copy = copy
+
+    def write(self, data):
+        self.stream.write(data)
+        self.copy.write(data)
+
+    def flush(self):
+        self.stream.flush()
+        self.copy.flush()
+
+
+class CountingSink(object):
+    '''Stands in for git, counting what the helper writes.'''
+
+    def __init__(self):
+        self.bytes = 0
+        self.writes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        self.writes += 1
+
+    def flush(self):
+        pass
+
+
+class NullSink(object):
+    '''Stands in for git, throwing away what the helper writes.'''
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+class SessionRecorder(object):
+    '''Records a session of hgremote into directory.'''
+
+    def __init__(self, hgremote, directory):
+        self.directory = directory
+        directory.makedirs()
+        state = directory.joinpath('state')
+        state.makedirs()
+        if hgremote.remotedir.exists():
+            for path in hgremote.remotedir.files():
+                path.copy2(state.joinpath(path.name))
+        session = {
+            'alias': hgremote.alias,
+            'url': hgremote.url,
+            'clone': hgremote.repo.root,
+            'heads': [hghex(node) for node in hgremote.repo.heads()],
+            'config': remote_config(hgremote.alias),
+            'time': int(time.time()),
+            'gitifyhg': version(),
+            'mercurial': hg_version(),
+        }
+        with directory.joinpath('session.json').open('w') as file:
+            file.write(json.dumps(session, indent=2).decode('UTF-8'))
+        self.input = directory.joinpath('input').open('wb')
+        self.output = directory.joinpath('output').open('wb')
+        sys.stdin = TeeInput(sys.stdin, self.input)
+        util.actual_stdout = TeeOutput(util.actual_stdout, self.output)
+
+    @classmethod
+    def from_environment(cls, hgremote):
+        '''Start recording the session of hgremote if GITIFYHG_RECORD is
+        set, and return the recorder or None.'''
+        directory = os.environ.get('GITIFYHG_RECORD')
+        if not directory:
+            return None
+        name = 'session-%s-%d' % (time.strftime('%Y%m%d%H%M%S'), os.getpid())
+        return cls(hgremote, p(directory).abspath().joinpath(name))
+
+    def close(self):
+        sys.stdin = sys.stdin.stream
+        util.actual_stdout = util.actual_stdout.stream
+        self.input.close()
+        self.output.close()
+        log("Recorded session in %s" % self.directory)
+
+
+def prepare_replay(session, recording, workdir):
+    '''Set up workdir for replaying session: a throwaway upstream
+    repository and a git directory whose remote has the recorded
+    configuration, state and a clone of the upstream. Returns the url of
+    the upstream.'''
+    upstream = workdir.joinpath('upstream')
+    # Only what the clone had when the session was recorded
+    hg.clone(ui(), {}, session['clone'].encode('utf-8'),
+        upstream.encode('utf-8'), update=False,
+        rev=[head.encode('ascii') for head in session['heads']])
+
+    git_dir = workdir.joinpath('git')
+    subprocess.check_call(['git', 'init', '--quiet', '--bare', git_dir])
+    os.environ['GIT_DIR'] = git_dir
+    for key, value in session['config']:
+        # The url points at the real upstream and a shared stream cache
+        # would be written to by the replay.
+        if key.split('.')[-1].lower() not in ('url', 'hgstreamcache'):
+            subprocess.check_call(['git', 'config', '--add', key, value])
+
+    remotedir = git_dir.joinpath('hg', hg_sha1(upstream))
+    remotedir.makedirs()
+    for path in recording.joinpath('state').files():
+        path.copy2(remotedir.joinpath(path.name))
+    # Local clones hardlink the revlogs, which Mercurial breaks up before
+    # writing, so pushes in the replay only change the upstream copy.
+    hg.clone(ui(), {}, upstream.encode('utf-8'),
+        remotedir.joinpath('clone').encode('utf-8'), update=False)
+    return upstream
+
+
+def replay(recording, sink, profile=None):
+    '''Replay the session recorded in the directory recording against
+    sink and return a dict describing the run.'''
+    from .gitifyhg import HGRemote  # which records sessions using us
+
+    with recording.joinpath('session.json').open() as file:
+        session = json.load(file)
+    workdir = p(tempfile.mkdtemp(prefix='gitifyhg-replay-'))
+    git_dir = os.environ.get('GIT_DIR')
+    stdin, stdout = sys.stdin, util.actual_stdout
+    try:
+        upstream = prepare_replay(session, recording, workdir)
+        sys.stdin = recording.joinpath('input').open('rb')
+        util.actual_stdout = sink
+
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.time()
+        hgremote = HGRemote(session['alias'], upstream)
+        if profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.runcall(hgremote.process)
+            profiler.dump_stats(profile)
+        else:
+            hgremote.process()
+        wall = time.time() - started
+        after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        if sys.stdin is not stdin:
+            sys.stdin.close()
+        sys.stdin, util.actual_stdout = stdin, stdout
+        if git_dir is None:
+            del os.environ['GIT_DIR']
+        else:
+            os.environ['GIT_DIR'] = git_dir
+        shutil.rmtree(workdir)
+
+    user = after.ru_utime - before.ru_utime
+    system = after.ru_stime - before.ru_stime
+    commits = sum(record['commits'] for record in hgremote.metrics.history
+        if record['phase'] in ('import', 'export'))
+    result = {
+        'wall_seconds': wall,
+        'user_seconds': user,
+        'system_seconds': system,
+        'max_rss_kib': after.ru_maxrss,
+        'commits': commits,
+        'commits_per_cpu_second': commits / max(user + system, 1e-6),
+        'phases': hgremote.metrics.history,
+    }
+    if isinstance(sink, CountingSink):
+        result['output_bytes'] = sink.bytes
+        result['output_bytes_per_cpu_second'] = (
+            sink.bytes / max(user + system, 1e-6))
+    return result
+
+
+def main():
+    '''Main entry point for the gitifyhg-replay command.'''
+    parser = optparse.OptionParser(
+        usage="usage: %prog [options] <recorded session directory>",
+        description="Replay a helper session recorded with GITIFYHG_RECORD "
+            "without git and report the resources the helper used.")
+    parser.add_option("--sink", default="count", choices=["count", "null"],
+        help="What to send the helper's output to: count (the default) "
+            "or null")
+    parser.add_option("--profile", metavar="FILE",
+        help="Write cProfile statistics of the session to FILE")
+    parser.add_option("--json", default=False, action="store_true",
+        help="Print the report as JSON")
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    recording = p(args[0]).abspath()
+    if not recording.joinpath('session.json').exists():
+        die("%s is not a recorded session" % recording)
+
+    report = sys.stdout
+    deactivate_stdout()
+    sink = CountingSink() if opts.sink == 'count' else NullSink()
+    result = replay(recording, sink, opts.profile)
+    if opts.json:
+        report.write(json.dumps(result, indent=2, sort_keys=True) + '\n')
+        return
+    report.write("wall time:   %.3fs\n" % result['wall_seconds'])
+    report.write("cpu time:    %.3fs user, %.3fs system\n" % (
+        result['user_seconds'], result['system_seconds']))
+    report.write("max rss:     %d KiB\n" % result['max_rss_kib'])
+    report.write("commits:     %d (%.1f per cpu second)\n" % (
+        result['commits'], result['commits_per_cpu_second']))
+    if 'output_bytes' in result:
+        report.write("output:      %d bytes (%.1f per cpu second)\n" % (
+            result['output_bytes'], result['output_bytes_per_cpu_second']))
+    for record in result['phases']:
+        report.write("%-12s %.3fs, %d commits, %d files, %d bytes\n" % (
+            record['phase'] + ':', record['seconds'], record['commits'],
+            record['files'], record['bytes']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,9 +23,12 @@ import re
 
 from mercurial import encoding
 
-from .util import (log, output, gittz, gitmode,
+from .util import (log, output, output_stream, gittz, gitmode,
     git_to_hg_spaces, hg_to_git_spaces, branch_head, ref_to_name_reftype,
     BRANCH, BOOKMARK, TAG, relative_path)
+from .lfiles import is_largefiles_repo, is_standin, split_standin, read_largefile
+from .streamcache import StreamCache
+from .prefetch import PendingImport
 
 AUTHOR = re.compile(r'^([^<>]+)?(<(?:[^<>]*)>| [^ ]*@.*|[<>].*)$')
 
@@ -66,6 +69,15 @@ class HGImporter(object):
         self.repo = self.hgremote.repo
         self.parser = parser
         self.notes_committed = 0
+        self.largefiles = is_largefiles_repo(self.repo)
+        self.path_filter = self.hgremote.path_filter
+        self.metrics = self.hgremote.metrics
+        self.memory = self.hgremote.memory
+        self.commit_count = 0
+        self.stream_cache = None
+        self.bundle_blobs = self.hgremote.bundle_blobs
+        # Progress lines are for git, not for commits rendered ahead of time
+        self.show_progress = True
 
     def process(self):
         output("feature done")
@@ -73,42 +85,55 @@ class HGImporter(object):
             output("feature import-marks=%s" % self.hgremote.marks_git_path)
         output("feature export-marks=%s" % self.hgremote.marks_git_path)
         output("feature notes")
+        # A ref whose changesets became obsolete moves to their successors
+        output("feature force")
 
         tmp = encoding.encoding
         encoding.encoding = 'utf-8'
 
-        self.commit_count = 0
+        # Adopting prefetched commits keeps the stream cache from replaying
+        # and from being added to with marks it does not know
+        self.commit_count += PendingImport(self.hgremote).adopt(self.marks)
+        self.stream_cache = StreamCache.from_git_config(self.hgremote)
+        if self.stream_cache:
+            self.commit_count += self.stream_cache.replay(self.marks)
+
         while self.parser.line.startswith('import'):
             ref = self.parser.line.split()[1]
 
-            if ref == 'HEAD':
-                self.process_ref(
-                    self.hgremote.headnode[0],
-                    BOOKMARK,
-                    self.hgremote.headnode[1])
-            else:
-                name, reftype = ref_to_name_reftype(ref)
-                if reftype == BRANCH:
-                    head = branch_head(self.hgremote, git_to_hg_spaces(name))
-                elif reftype == BOOKMARK:
-                    head = self.hgremote.bookmarks[git_to_hg_spaces(name)]
-                elif reftype == TAG:
-                    head = self.repo[git_to_hg_spaces(name)]
-                else:
-                    assert False, "unexpected reftype: %s" % reftype
-                self.process_ref(name, reftype, head)
+            self.process_ref(*self.ref_head(ref))
 
             self.process_notes()
 
             self.parser.read_line()
 
+        if self.stream_cache:
+            self.stream_cache.finish(self.marks)
+        if self.bundle_blobs:
+            self.bundle_blobs.close()
         encoding.encoding = tmp
         output('done')
+        self.hgremote.update_commit_map()
+
+    def ref_head(self, ref):
+        '''Return the name, reftype and head changectx of the listed ref.'''
+        if ref == 'HEAD':
+            return (self.hgremote.headnode[0], BOOKMARK,
+                self.hgremote.headnode[1])
+        name, reftype = ref_to_name_reftype(ref)
+        if reftype == BRANCH:
+            head = branch_head(self.hgremote, git_to_hg_spaces(name))
+        elif reftype == BOOKMARK:
+            head = self.hgremote.bookmarks[git_to_hg_spaces(name)]
+        elif reftype == TAG:
+            head = self.repo[git_to_hg_spaces(name)]
+        else:
+            assert False, "unexpected reftype: %s" % reftype
+        return name, reftype, head
 
     def process_notes(self):
         last_notes_mark = self.marks.notes_mark if self.marks.notes_mark is not None else 0
-        mark_to_hgsha1 = [(mark, self.repo[rev].hex()) for rev, mark in
-                          self.marks.revisions_to_marks.iteritems() if mark > last_notes_mark]
+        mark_to_hgsha1 = list(self.marks.marked_since(last_notes_mark))
         if not mark_to_hgsha1 or self.commit_count < 1:
             return
         output("commit refs/notes/hg-%s" % (self.hgremote.uuid))
@@ -128,18 +153,30 @@ class HGImporter(object):
 
     def process_ref(self, name, reftype, head):
         gitify_ref = self.hgremote.make_gitify_ref(name, reftype)
-        tip = self.marks.tips.get(gitify_ref, 0)
+        self.process_revisions(name, reftype, head)
+
+        # make sure the ref is updated
+        output("reset %s" % gitify_ref)
+        output("from :%u" % self.marks.rev_to_mark(head.rev()))
+        output()
+
+        self.marks.tips[gitify_ref] = head.rev()
+
+    def process_revisions(self, name, reftype, head):
+        '''Output the commits of the unmarked ancestors of head. Returns
+        the number of commits output.'''
+        gitify_ref = self.hgremote.make_gitify_ref(name, reftype)
 
-        revs = xrange(tip, head.rev() + 1)
+        revs = self.unmarked_ancestors(head.rev())
         count = 0
 
         for rev in revs:
-            node = self.repo[rev].node()
-            if self.marks.is_marked(node):
+            if self.marks.rev_is_marked(rev):
                 continue
 
+            node = self.repo.changelog.node(rev)
             (manifest, user, (time, tz), files, description, extra
-                ) = self.repo.changelog.read(self.repo[rev].node())
+                ) = self.repo.changelog.read(node)
 
             user = sanitize_author(user)
             author = "%s %d %s" % (user, time, gittz(tz))
@@ -159,6 +196,29 @@ class HGImporter(object):
             else:
                 modified, removed = self.repo[rev].manifest().keys(), []
 
+            if self.path_filter:
+                modified = [f for f in modified if self.is_visible(f)]
+                removed = [f for f in removed if self.is_visible(f)]
+                if self.is_filtered_out(rev, parents, modified, removed):
+                    mark = self.marks.rev_to_mark(parents[0])
+                    self.marks.alias_mark(node, mark)
+                    if self.stream_cache:
+                        self.stream_cache.end(node, mark, alias=True)
+                    continue
+
+            # Blobs from the pull spool have to reach git before the commit
+            blob_marks = {}
+            if self.bundle_blobs:
+                for file in modified:
+                    if self.largefiles and is_standin(file):
+                        continue
+                    blob_marks[file] = self.bundle_blobs.mark(
+                        file, self.repo[rev].filenode(file))
+
+            if self.stream_cache:
+                self.stream_cache.begin()
+            size = 0
+
             if not parents and rev:
                 output('reset %s' % gitify_ref)
 
@@ -170,34 +230,87 @@ class HGImporter(object):
             output(description)
 
             if parents:
-                output("from :%s" % (self.marks.revision_to_mark(self.repo[parents[0]].node())))
+                output("from :%s" % (self.marks.rev_to_mark(parents[0])))
                 if len(parents) > 1:
-                    output("merge :%s" % (self.marks.revision_to_mark(self.repo[parents[1]].node())))
+                    output("merge :%s" % (self.marks.rev_to_mark(parents[1])))
 
             for file in modified:
                 filecontext = self.repo[rev].filectx(file)
+                if self.largefiles and is_standin(file):
+                    # git gets the real contents, streamed from the store
+                    path, largefile_size, chunks = read_largefile(
+                        self.repo, filecontext)
+                    output("M %s inline %s" % (
+                        gitmode(filecontext.flags()), relative_path(path)))
+                    output_stream(largefile_size, chunks)
+                    size += largefile_size
+                    continue
+                mark = blob_marks.get(file)
+                if mark:
+                    output("M %s :%d %s" % (
+                        gitmode(filecontext.flags()), mark, relative_path(file)))
+                    continue
                 data = filecontext.data()
                 output("M %s inline %s" % (
                     gitmode(filecontext.flags()), relative_path(filecontext.path())))
                 output("data %d" % len(data))
                 output(data)
+                size += len(data)
             for file in removed:
+                if self.largefiles:
+                    file = split_standin(file)
                 output("D %s" % (relative_path(file)))
             output()
+            if self.stream_cache:
+                self.stream_cache.end(node, self.marks.rev_to_mark(rev))
 
             count += 1
-            if (count % 100 == 0):
-                output("progress revision %d '%s' (%d/%d)" % (
-                    rev, name, count, len(revs)))
-                output("#############################################################")
-
-        # make sure the ref is updated
-        output("reset %s" % gitify_ref)
-        output("from :%u" % self.marks.revision_to_mark(head.node()))
-        output()
+            self.metrics.add_commit(len(modified) + len(removed), size)
+            self.memory.check()
+            if self.show_progress and self.metrics.due():
+                output("progress revision %d '%s' (%d/%d): %s" % (
+                    rev, name, count, len(revs),
+                    self.metrics.status(count, len(revs))))
 
-        self.marks.tips[gitify_ref] = head.rev()
         self.commit_count += count
+        return count
+
+    def unmarked_ancestors(self, head):
+        '''Return head and those of its ancestors that have no mark yet as
+        revision numbers, oldest first. The walk stops at marked revisions,
+        so a ref pointing at a commit git already has costs nothing, and
+        any other ref only costs as much as the commits that are new to
+        git, rather than a scan of the history from its last known tip or
+        from revision 0.'''
+        parentrevs = self.repo.changelog.parentrevs
+        unmarked = set()
+        pending = [head]
+        while pending:
+            rev = pending.pop()
+            if rev in unmarked or self.marks.rev_is_marked(rev):
+                continue
+            unmarked.add(rev)
+            pending.extend(parent for parent in parentrevs(rev) if parent >= 0)
+        return sorted(unmarked)
+
+    def is_visible(self, path):
+        if self.largefiles:
+            path = split_standin(path)
+        return self.path_filter(path)
+
+    def is_filtered_out(self, rev, parents, modified, removed):
+        '''A changeset whose changes are all hidden by the path filter is not
+        imported as long as it stays on the branch of its first parent and,
+        for merges, both parents are the same git commit.'''
+        if modified or removed or not parents:
+            return False
+        context = self.repo[rev]
+        first = self.repo[parents[0]]
+        if context.branch() != first.branch():
+            return False
+        first_mark = self.marks.rev_to_mark(parents[0])
+        return all(self.marks.rev_to_mark(parent) == first_mark
+            for parent in parents[1:])
 
     def get_filechanges(self, context, parent):
         modified = set()
@@ -0,0 +1,142 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+# Mercurial hooks that update git mirrors of a repository as soon as
+# changesets or bookmarks arrive, instead of polling it with git fetch.
+# Enable them in the hgrc of the repository that is pushed to:
+#
+#   [hooks]
+#   changegroup.gitifyhg = python:gitifyhg.hook.mirror
+#   pushkey.gitifyhg = python:gitifyhg.hook.mirror
+#
+#   [gitifyhg]
+#   mirrors = /srv/git/project.git
+#
+# Every mirror is a bare git repository whose origin remote is the
+# repository itself; missing mirrors are set up like gitifyhg-mirror does.
+# The hook fetches origin through the remote helper, so the marks are the
+# same ones a git fetch uses and both can be mixed. git only asks the
+# helper to import the refs that the push moved, and the helper pulls from
+# the local repository.
+
+import os
+import fcntl
+import subprocess
+
+from mercurial import hg
+from mercurial.lock import release
+
+from .util import hg_to_git_spaces, name_reftype_to_ref, BOOKMARK
+from .mirror import MirrorJob, REMOTE
+
+from apiwrapper import hg_transaction, hg_deletebookmark
+
+
+def mirror(ui, repo, hooktype, node=None, namespace=None, key=None,
+        new=None, **kwargs):
+    '''changegroup and pushkey hook fetching the changes into the git
+    mirrors listed in gitifyhg.mirrors. Set gitifyhg.background to update
+    them without making the push wait.'''
+    git_dirs = ui.configlist('gitifyhg', 'mirrors')
+    if not git_dirs:
+        return False
+    deleted = []
+    if hooktype == 'pushkey':
+        if namespace != 'bookmarks':
+            return False
+        if not new:
+            deleted.append(key)
+    scheme = ui.config('gitifyhg', 'scheme', 'gitifyhg')
+    jobs = [MirrorJob(repo.root.decode('utf-8'),
+        os.path.join(repo.root, os.path.expanduser(git_dir)))
+        for git_dir in git_dirs]
+    if ui.configbool('gitifyhg', 'background'):
+        in_background(update_mirrors, repo.baseui, jobs, scheme, deleted)
+    else:
+        update_mirrors(repo.baseui, jobs, scheme, deleted)
+    return False
+
+
+def update_mirrors(ui, jobs, scheme, deleted):
+    for job in jobs:
+        try:
+            update_mirror(ui, job, scheme, deleted)
+        except OSError as e:
+            ui.warn("gitifyhg: could not update %s: %s\n" % (job.git_dir, e))
+        except subprocess.CalledProcessError as e:
+            ui.warn("gitifyhg: could not update %s: %s\n%s" % (
+                job.git_dir, e, e.output or ''))
+
+
+def update_mirror(ui, job, scheme, deleted):
+    '''Fetch into the mirror of job, removing the bookmarks in deleted.
+    Pushes that arrive while the mirror is set up or fetched wait for it.'''
+    # The lock lives in the mirror, which may not have been created yet
+    job.git_dir.makedirs_p()
+    with open(job.git_dir.joinpath('gitifyhg-hook.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        job.setup(scheme)
+        if deleted:
+            delete_bookmarks(ui, job, deleted)
+        run(job.git('fetch', '--quiet', REMOTE))
+
+
+def delete_bookmarks(ui, job, names):
+    '''Delete the bookmarks names from the mirror. Pulling never deletes
+    bookmarks, so they are removed from the helper's clone as well, which
+    would list them again otherwise.'''
+    clone = job.remotedir.joinpath('clone')
+    if clone.exists():
+        repo = hg.repository(ui, clone.encode('utf-8'))
+        tr, lock, wlock = hg_transaction(repo, 'gitifyhg-hook')
+        try:
+            for name in names:
+                hg_deletebookmark(repo, tr, name)
+            tr.close()
+        finally:
+            release(tr, lock, wlock)
+    for name in names:
+        name = hg_to_git_spaces(name)
+        run(job.git('update-ref', '-d', name_reftype_to_ref(name, BOOKMARK)))
+        # The private ref of the helper
+        run(job.git('update-ref', '-d',
+            'refs/hg/%s/bookmarks/%s' % (REMOTE, name)))
+
+
+def run(args):
+    '''Run the git command args, keeping its output away from the client
+    of the push.'''
+    process = subprocess.Popen(args, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args, output)
+
+
+def in_background(function, *args):
+    '''Run function in a detached grandchild process, so neither the push
+    waits for it nor does it linger as a zombie of a long running server.'''
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        if not os.fork():
+            os.setsid()
+            function(*args)
+    finally:
+        os._exit(0)
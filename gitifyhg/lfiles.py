@@ -0,0 +1,156 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+# Support for large blobs in both directions. Blobs above SPOOL_SIZE are
+# never held in memory as a whole while they travel between git and hg, and
+# repositories using the largefiles extension exchange the real file
+# contents with git while Mercurial only ever sees the standins.
+
+import os
+import hashlib
+
+from mercurial.util import makedirs, atomictempfile
+from hgext.largefiles import lfutil, lfcommands
+
+from .util import die
+
+# Size of the chunks data is copied in.
+CHUNK_SIZE = 128 * 1024
+# Blobs coming from git that are larger than this are spooled to disk.
+SPOOL_SIZE = 4 * 1024 * 1024
+
+
+class SpooledBlob(object):
+    '''A blob from the fast-export stream that was written to a file in the
+    spool directory instead of being kept in memory.'''
+
+    def __init__(self, path, size, sha1):
+        self.path = path
+        self.size = size
+        self.sha1 = sha1
+
+    @classmethod
+    def spool(cls, directory, mark, size, chunks):
+        '''Write chunks to a file named after mark in directory and return
+        the SpooledBlob describing it.'''
+        if not directory.exists():
+            directory.makedirs()
+        path = directory.joinpath('%d' % mark)
+        hasher = hashlib.sha1()
+        with path.open('wb') as file:
+            for chunk in chunks:
+                hasher.update(chunk)
+                file.write(chunk)
+        return cls(path, size, hasher.hexdigest())
+
+    def read(self):
+        with self.path.open('rb') as file:
+            return file.read()
+
+    def chunks(self):
+        return file_chunks(self.path)
+
+
+def file_chunks(path):
+    '''Yield the contents of the file at path in chunks of CHUNK_SIZE.'''
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def blob_data(blob):
+    '''Return the contents of a blob, which is either a string or a
+    SpooledBlob. A SpooledBlob is read into memory as a whole, so this is
+    only used where Mercurial needs the full text of a file revision.'''
+    if isinstance(blob, SpooledBlob):
+        return blob.read()
+    return blob
+
+
+def blob_size(blob):
+    if isinstance(blob, SpooledBlob):
+        return blob.size
+    return len(blob)
+
+
+def requires_largefiles(repo_path):
+    '''Return True if the hg repository at the local repo_path uses the
+    largefiles extension.'''
+    requires = repo_path.joinpath('.hg', 'requires')
+    if not requires.exists():
+        return False
+    return lfutil.longname in requires.text().split()
+
+
+def is_largefiles_repo(repo):
+    return lfutil.longname in repo.requirements
+
+
+def is_standin(path):
+    return lfutil.isstandin(path)
+
+
+def standin(path):
+    return lfutil.standin(path)
+
+
+def split_standin(path):
+    '''Return the path of the largefile belonging to the standin path, or
+    path itself if it is not a standin.'''
+    return lfutil.splitstandin(path) or path
+
+
+def read_largefile(repo, filectx):
+    '''Return a tuple of (path, size, chunks) for the largefile that the
+    standin filectx refers to, downloading it into the local store first if
+    necessary. chunks is an iterator over the contents of the largefile.'''
+    path = lfutil.splitstandin(filectx.path())
+    hash = filectx.data().strip()
+    store_path = lfutil.findfile(repo, hash)
+    if store_path is None:
+        lfcommands.cachelfiles(repo.ui, repo, filectx.changectx().node(),
+            [path])
+        store_path = lfutil.findfile(repo, hash)
+    if store_path is None:
+        die("largefile %s (%s) is not available" % (path, hash))
+    return path, os.path.getsize(store_path), file_chunks(store_path)
+
+
+def min_largefile_size(repo):
+    '''New files at least this many bytes large are committed as largefiles.'''
+    return int(float(lfutil.getminsize(repo.ui, True, None)) * 1024 * 1024)
+
+
+def write_largefile(repo, blob):
+    '''Put blob into the largefiles store of repo and return the contents
+    of the standin that refers to it.'''
+    if isinstance(blob, SpooledBlob):
+        hash = blob.sha1
+        if not lfutil.instore(repo, hash):
+            lfutil.copytostoreabsolute(repo, blob.path, hash)
+    else:
+        hash = hashlib.sha1(blob).hexdigest()
+        if not lfutil.instore(repo, hash):
+            store_path = lfutil.storepath(repo, hash)
+            makedirs(os.path.dirname(store_path))
+            file = atomictempfile(store_path)
+            file.write(blob)
+            file.close()
+            lfutil.linktousercache(repo, hash)
+    return hash + '\n'
@@ -0,0 +1,150 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import resource
+
+from .util import log, die, git_config
+from .lfiles import SPOOL_SIZE
+
+# Multipliers of the suffixes the budget may be given with
+SIZE_UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+# Smallest blob that is spooled to disk however small the budget is
+MIN_SPOOL_SIZE = 64 * 1024
+# Number of calls to check() that share one measurement of the process
+CHECK_INTERVAL = 32
+
+
+class MemoryGovernor(object):
+    '''Keeps the memory a helper session uses within the budget set with
+    remote.<alias>.hgMemoryBudget, a number of bytes optionally followed
+    by k, m or g.
+
+    Blobs pushed from git that are larger than a sixteenth of the budget
+    are spooled to disk instead of being read into memory. The caches that
+    can give memory back register an evict function, and check(), called
+    as commits are imported and exported, evicts them in the order they
+    were registered while the resident set of the process is above the
+    budget. Without a budget, check() only keeps track of the peak.
+
+    Only those caches and blobs are governed. The marks, the commands read
+    from git and the stream cache index cannot be evicted, so they count
+    towards the resident set without ever being reduced.
+
+    Measuring the process on every call would cost more than most commits,
+    so only every CHECK_INTERVAL-th call does. When evicting everything
+    does not bring the process under the budget, the caches are only
+    evicted again once it has grown by a sixteenth of what it used right
+    after. A budget below what the interpreter and Mercurial need by
+    themselves therefore degrades to evicting now and then rather than
+    after every commit.'''
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.caches = []  # tuples of (name, evict function)
+        self.evictions = 0
+        self.peak = 0
+        self.calls = 0
+        self.floor = 0  # usage right after the last eviction
+
+    @classmethod
+    def from_git_config(cls, alias):
+        budget = git_config(alias, 'hgMemoryBudget')
+        if budget is None:
+            return cls()
+        try:
+            return cls(parse_size(budget))
+        except ValueError:
+            die("remote.%s.hgMemoryBudget is not a size: %s" % (alias, budget))
+
+    def __nonzero__(self):
+        return self.budget is not None
+
+    @property
+    def spool_size(self):
+        '''Size above which blobs are spooled to disk.'''
+        if self.budget is None:
+            return SPOOL_SIZE
+        return max(min(SPOOL_SIZE, self.budget // 16), MIN_SPOOL_SIZE)
+
+    def reset_peak(self):
+        '''Start measuring the peak of a new phase, whose first check()
+        measures and may evict again.'''
+        self.peak = current_rss()
+        self.calls = 0
+        self.floor = 0
+
+    def measure(self):
+        '''Update the peak without evicting anything.'''
+        self.peak = max(self.peak, current_rss())
+
+    def register(self, name, evict):
+        '''Register a cache that frees its memory when evict is called.'''
+        self.caches.append((name, evict))
+
+    def check(self):
+        '''Evict caches until the process fits into the budget again. Most
+        calls return without measuring.'''
+        calls, self.calls = self.calls, self.calls + 1
+        if calls % CHECK_INTERVAL:
+            return
+        usage = current_rss()
+        self.peak = max(self.peak, usage)
+        if self.budget is None or usage <= self.limit():
+            return
+        for name, evict in self.caches:
+            evict()
+            self.evictions += 1
+            log("Evicted %s, %d bytes were in use" % (name, usage))
+            usage = current_rss()
+            if usage <= self.budget:
+                break
+        if usage > self.budget and self.floor <= self.budget:
+            log("Using %d bytes without caches, more than the memory budget"
+                % usage, "WARNING")
+        self.floor = usage
+
+    def limit(self):
+        '''Return the usage above which caches are evicted.'''
+        if self.floor <= self.budget:
+            return self.budget
+        return self.floor + self.floor // 16
+
+
+def parse_size(size):
+    '''Return the number of bytes in a size like 512m.'''
+    size = size.strip().lower().rstrip('b')
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def current_rss():
+    '''Return the resident set size of the process in bytes.'''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # Without procfs, the peak is the best there is
+        return peak_rss()
+
+
+def peak_rss():
+    '''Return the largest resident set size the process had in bytes.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, OS X bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
@@ -0,0 +1,142 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+from contextlib import contextmanager
+
+from .util import git_config, git_config_bool
+
+# Seconds between two progress reports unless configured otherwise.
+PROGRESS_INTERVAL = 5
+
+
+class Metrics(object):
+    '''Measures the throughput of the phases of a helper session.
+
+    A phase is one of pull, list, import or export. While it runs,
+    importers and exporters count the commits, files and bytes they
+    handle, and ask due() whether it is time to report progress, which
+    happens every remote.<alias>.hgProgressInterval seconds. If
+    remote.<alias>.hgMetricsLog is true, a JSON line with the totals of
+    every phase is appended to metrics.jsonl in remotedir. The records of
+    the phases that have finished are kept in history as well. If a
+    MemoryGovernor is given, the records include the peak resident set
+    size of the phase and the caches it evicted.'''
+
+    def __init__(self, alias, remotedir, memory=None):
+        self.alias = alias
+        self.memory = memory
+        self.interval = float(git_config(alias, 'hgProgressInterval',
+            PROGRESS_INTERVAL))
+        self.log_path = None
+        if git_config_bool(alias, 'hgMetricsLog'):
+            self.log_path = remotedir.joinpath('metrics.jsonl')
+        self.name = None
+        self.history = []
+
+    @contextmanager
+    def phase(self, name):
+        '''Measure the body of the with statement as the phase name.'''
+        self.name = name
+        self.commits = self.files = self.bytes = 0
+        self.started = self.last_report = time.time()
+        if self.memory is not None:
+            self.memory.reset_peak()
+            self.evictions = self.memory.evictions
+        try:
+            yield self
+        finally:
+            self.finish()
+            self.name = None
+
+    def add_commit(self, files, size=0):
+        if self.name is not None:
+            self.commits += 1
+            self.files += files
+            self.bytes += size
+
+    def add_commits(self, count):
+        '''Count commits that were handled without looking at their files.'''
+        if self.name is not None:
+            self.commits += count
+
+    def add_bytes(self, size):
+        if self.name is not None:
+            self.bytes += size
+
+    def due(self):
+        '''Return True if the interval since the last report has passed.'''
+        now = time.time()
+        if self.name is None or now - self.last_report < self.interval:
+            return False
+        self.last_report = now
+        return True
+
+    def rates(self):
+        seconds = max(time.time() - self.started, 1e-6)
+        return {
+            'commits_per_second': self.commits / seconds,
+            'bytes_per_second': self.bytes / seconds,
+            'files_per_commit': float(self.files) / max(self.commits, 1),
+        }
+
+    def status(self, done=None, total=None):
+        '''Return a progress report. If the number of commits done out of a
+        total is given, include an estimate of the remaining time.'''
+        rates = self.rates()
+        message = "%d commits, %.1f commits/s, %s/s, %.1f files/commit" % (
+            self.commits, rates['commits_per_second'],
+            format_size(rates['bytes_per_second']),
+            rates['files_per_commit'])
+        if total and rates['commits_per_second']:
+            message += ", ETA %ds" % (
+                (total - done) / rates['commits_per_second'])
+        return message
+
+    def finish(self):
+        record = {
+            'time': int(time.time()),
+            'remote': self.alias,
+            'phase': self.name,
+            'seconds': round(time.time() - self.started, 3),
+            'commits': self.commits,
+            'files': self.files,
+            'bytes': self.bytes,
+        }
+        record.update((key, round(value, 3))
+            for key, value in self.rates().iteritems())
+        if self.memory is not None:
+            self.memory.measure()
+            record['peak_rss'] = self.memory.peak
+            record['evictions'] = self.memory.evictions - self.evictions
+        self.history.append(record)
+        if self.log_path is None:
+            return
+        if not self.log_path.parent.exists():
+            self.log_path.parent.makedirs()
+        with self.log_path.open('a') as file:
+            file.write(json.dumps(record, sort_keys=True).decode('UTF-8'))
+            file.write(u'\n')
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f GiB" % size
@@ -0,0 +1,246 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+# Mirroring many Mercurial repositories into bare git repositories.
+#
+# gitifyhg-mirror reads a list of Mercurial urls, each followed by the bare
+# git repository it is mirrored into, and fetches them in a bounded pool of
+# processes. Every fetch goes through git and the remote helper, since git
+# has to run fast-import and update the refs, so mirrors stay ordinary
+# gitifyhg remotes that git fetch can update as well. Repositories are
+# started stalest or largest first, and a summary of the time every fetch
+# took, the commits it pulled and imported and its errors is printed and
+# optionally written as JSON.
+
+import sys
+import json
+import time
+import signal
+import optparse
+import subprocess
+from multiprocessing import Pool, cpu_count
+
+from path import Path as p
+from mercurial import hg
+
+from .util import die
+
+from apiwrapper import hg_sha1
+
+# The name of the remote in every mirror
+REMOTE = 'origin'
+
+
+class MirrorJob(object):
+    '''A Mercurial repository at url mirrored into the bare git repository
+    git_dir.'''
+
+    def __init__(self, url, git_dir):
+        if hg.islocal(url.encode('utf-8')):
+            # The helper does the same, and names remotedir after it
+            url = p(url).abspath()
+        self.url = url
+        self.git_dir = p(git_dir).abspath()
+        self.remotedir = self.git_dir.joinpath('hg', hg_sha1(url))
+
+    def last_fetch(self):
+        '''Return the time the mirror was last fetched, or 0 if never.'''
+        fetch_head = self.git_dir.joinpath('FETCH_HEAD')
+        return fetch_head.mtime if fetch_head.exists() else 0
+
+    def size(self):
+        '''Return the size of the store of the mirror's Mercurial clone.'''
+        store = self.remotedir.joinpath('clone', '.hg', 'store')
+        if not store.exists():
+            return 0
+        return sum(path.size for path in store.walkfiles())
+
+    def git(self, *args):
+        return ['git', '--git-dir=%s' % self.git_dir] + list(args)
+
+    def setup(self, scheme):
+        '''Create the bare repository and its remote if they are missing.'''
+        if not self.git_dir.joinpath('HEAD').exists():
+            subprocess.check_call(['git', 'init', '--quiet', '--bare',
+                self.git_dir])
+        process = subprocess.Popen(self.git('config', 'remote.%s.url' % REMOTE),
+            stdout=subprocess.PIPE)
+        if process.communicate()[0].strip():
+            return
+        config = [
+            ('url', '%s::%s' % (scheme, self.url)),
+            ('fetch', '+refs/heads/*:refs/heads/*'),
+            ('fetch', '+refs/tags/*:refs/tags/*'),
+            ('hgMetricsLog', 'true'),
+        ]
+        for key, value in config:
+            subprocess.check_call(self.git('config', '--add',
+                'remote.%s.%s' % (REMOTE, key), value))
+
+    def fetch(self, scheme):
+        '''Fetch the mirror and return a dict describing how it went.'''
+        result = {'url': self.url, 'git_dir': self.git_dir, 'pulled': 0,
+            'imported': 0}
+        started = time.time()
+        try:
+            self.setup(scheme)
+            metrics = self.remotedir.joinpath('metrics.jsonl')
+            offset = metrics.size if metrics.exists() else 0
+            process = subprocess.Popen(self.git('fetch', '--quiet', REMOTE),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            errors = process.communicate()[0]
+        except (OSError, subprocess.CalledProcessError) as e:
+            result.update(status='failed', seconds=time.time() - started,
+                error=str(e))
+            return result
+        result['seconds'] = time.time() - started
+        if process.returncode:
+            result.update(status='failed',
+                error='\n'.join(errors.splitlines()[-5:]))
+            return result
+        result['status'] = 'ok'
+        if metrics.exists():
+            with metrics.open('rb') as file:
+                file.seek(offset)
+                for line in file:
+                    record = json.loads(line)
+                    if record['phase'] == 'pull':
+                        result['pulled'] += record['commits']
+                    elif record['phase'] == 'import':
+                        result['imported'] += record['commits']
+        return result
+
+
+def read_jobs(lines):
+    '''Parse the lines of a mirror list into MirrorJobs. Every line holds
+    a Mercurial url and a bare git repository separated by whitespace.
+    Empty lines and lines starting with # are ignored.'''
+    jobs = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.decode('utf-8').split()
+        if len(fields) != 2:
+            die("Line %d of the mirror list is not a url and a git "
+                "repository: %s" % (number, line))
+        jobs.append(MirrorJob(*fields))
+    return jobs
+
+
+def order_jobs(jobs, order):
+    '''Sort jobs in place: stalest first for staleness, so mirrors that were
+    never fetched go first, largest first for size, so the long fetches
+    do not end up last in the pool.'''
+    if order == 'staleness':
+        jobs.sort(key=lambda job: job.last_fetch())
+    elif order == 'size':
+        jobs.sort(key=lambda job: job.size(), reverse=True)
+
+
+def ignore_interrupts():
+    '''Leave KeyboardInterrupt to the parent, which terminates the pool.'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def fetch_job(args):
+    job, scheme = args
+    return job.fetch(scheme)
+
+
+def mirror(jobs, processes, scheme='gitifyhg', report=None):
+    '''Fetch all jobs in a pool of processes and return their results in
+    the order they finished. report is called with every result as soon as
+    it is available.'''
+    pool = Pool(processes, ignore_interrupts)
+    results = []
+    try:
+        for result in pool.imap_unordered(fetch_job,
+                [(job, scheme) for job in jobs]):
+            results.append(result)
+            if report:
+                report(result)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+def main():
+    '''Main entry point for the gitifyhg-mirror command.'''
+    parser = optparse.OptionParser(
+        usage="usage: %prog [options] <mirror list>",
+        description="Mirror the Mercurial repositories in the mirror list, "
+            "one url and bare git repository per line, or - to read it "
+            "from stdin.")
+    parser.add_option("-j", "--jobs", type="int", default=cpu_count(),
+        help="Number of repositories fetched at the same time "
+            "(default: %default)")
+    parser.add_option("--order", default="staleness",
+        choices=["staleness", "size", "list"],
+        help="Fetch the stalest (the default) or largest mirrors first, or "
+            "keep the order of the list")
+    parser.add_option("--summary", metavar="FILE",
+        help="Write the summary as JSON to FILE")
+    parser.add_option("--scheme", default="gitifyhg",
+        help="The remote helper new mirrors are set up with "
+            "(default: %default)")
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    if args[0] == '-':
+        jobs = read_jobs(sys.stdin)
+    else:
+        with open(args[0]) as file:
+            jobs = read_jobs(file)
+    order_jobs(jobs, opts.order)
+
+    def report(result):
+        sys.stdout.write("%-6s %8.1fs %7d pulled %7d imported  %s\n" % (
+            result['status'], result['seconds'], result['pulled'],
+            result['imported'], result['url']))
+        if result['status'] != 'ok':
+            for line in result['error'].splitlines():
+                sys.stdout.write("    %s\n" % line)
+        sys.stdout.flush()
+
+    started = time.time()
+    results = mirror(jobs, max(opts.jobs, 1), opts.scheme, report)
+    failed = [result for result in results if result['status'] != 'ok']
+    summary = {
+        'time': int(started),
+        'seconds': round(time.time() - started, 3),
+        'jobs': opts.jobs,
+        'ok': len(results) - len(failed),
+        'failed': len(failed),
+        'repositories': results,
+    }
+    sys.stdout.write("%d mirrored, %d failed in %.1fs\n" % (
+        summary['ok'], summary['failed'], summary['seconds']))
+    if opts.summary:
+        with open(opts.summary, 'w') as file:
+            file.write(json.dumps(summary, indent=2, sort_keys=True) + '\n')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
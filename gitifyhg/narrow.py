@@ -0,0 +1,53 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+from mercurial.match import match
+
+from .util import git_config_list
+
+
+class PathFilter(object):
+    '''Decides which paths of the mercurial repository are visible in git.
+
+    The filter is configured per remote with the multi-valued git config
+    variables remote.<alias>.hgInclude and remote.<alias>.hgExclude, which
+    take Mercurial patterns (glob by default, so a plain directory name
+    includes everything below it). A filter without any patterns lets
+    every path through.'''
+
+    def __init__(self, root, include, exclude):
+        self.include = include
+        self.exclude = exclude
+        if self:
+            self.matcher = match(root, '', [], include, exclude)
+
+    @classmethod
+    def from_git_config(cls, alias, root):
+        return cls(root, git_config_list(alias, 'hgInclude'),
+            git_config_list(alias, 'hgExclude'))
+
+    def __nonzero__(self):
+        return bool(self.include or self.exclude)
+
+    def __call__(self, path):
+        return not self or bool(self.matcher(path))
+
+    def config(self):
+        '''Return the patterns as they are recorded in the marks file.'''
+        if not self:
+            return None
+        return {'include': self.include, 'exclude': self.exclude}
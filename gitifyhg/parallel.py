@@ -0,0 +1,135 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from mercurial import mdiff
+from mercurial.node import nullid
+from mercurial.revlog import revlog
+
+from .util import git_config
+from .lfiles import SpooledBlob
+
+# Commits touching fewer files than this are written without the pool.
+MIN_FILES = 64
+
+# revlog.compress itself, which is replaced while a commit is written.
+revlog_compress = revlog.__dict__['compress']
+
+
+class ParallelCompressor(object):
+    '''Compresses the filelog revisions of large commits in a pool of
+    worker threads.
+
+    zlib and Mercurial's bdiff release the GIL, so the deltas and their
+    compressed form can be computed for many files at once. The workers
+    predict the delta base the revlog is going to pick, the same way
+    revlog._addrevision does, and compress the delta (or the full text of
+    new files). While repo.commitctx appends the revisions one at a time
+    in its usual order under the repo lock, revlog.compress hands out the
+    precomputed result if its input matches the prediction and compresses
+    the data itself otherwise.
+
+    The number of threads is set with remote.<alias>.hgExportThreads and
+    defaults to the number of CPUs; 1 disables the pool.'''
+
+    def __init__(self, repo, threads):
+        self.repo = repo
+        self.threads = threads
+
+    @classmethod
+    def from_git_config(cls, repo, alias):
+        threads = git_config(alias, 'hgExportThreads')
+        if threads is None:
+            threads = multiprocessing.cpu_count()
+        return cls(repo, int(threads))
+
+    @contextmanager
+    def precompress(self, files, parents):
+        '''Compress the revisions of files, a dict of paths to filespecs as
+        built by GitExporter.do_commit, for a commit on top of the parent
+        nodes while the body of the with statement commits them.'''
+        jobs = self.jobs(files, parents)
+        if self.threads <= 1 or len(jobs) < MIN_FILES:
+            yield
+            return
+
+        pool = ThreadPool(self.threads)
+        results = pool.imap_unordered(self.compress_file, jobs)
+        pending = set(indexfile for indexfile, path, text, fparents in jobs)
+        compressed = {}  # indexfile to dict of text to compressed text
+
+        def compress(self, text):
+            indexfile = self.indexfile
+            while indexfile in pending and indexfile not in compressed:
+                done, result = next(results)
+                compressed[done] = result
+            precomputed = compressed.get(indexfile, {}).pop(text, None)
+            if precomputed is not None:
+                return precomputed
+            return revlog_compress(self, text)
+
+        revlog.compress = compress
+        try:
+            yield
+        finally:
+            revlog.compress = revlog_compress
+            pool.terminate()
+            pool.join()
+
+    def jobs(self, files, parents):
+        manifests = [self.repo[parent].manifest() for parent in parents]
+        jobs = []
+        for path in sorted(files):
+            filespec = files[path]
+            if 'data' not in filespec:
+                continue  # deletions and unchanged merge files
+            if isinstance(filespec['data'], SpooledBlob):
+                continue  # not worth holding in memory twice
+            fparents = [manifest[path] for manifest in manifests
+                if path in manifest]
+            indexfile = 'data/%s.i' % path
+            jobs.append((indexfile, path, filespec['data'], fparents))
+        return jobs
+
+    def compress_file(self, job):
+        '''Return the indexfile of the job and a dict of the text the revlog
+        is expected to compress to its compressed form.'''
+        indexfile, path, text, fparents = job
+        if text.startswith('\1\n'):
+            return indexfile, {}  # filelog adds a metadata header
+        flog = self.repo.file(path)
+        base = self.delta_base(flog, fparents)
+        if base is None:
+            target = text
+        else:
+            target = mdiff.textdiff(flog.revision(flog.node(base)), text)
+        return indexfile, {target: revlog_compress(flog, target)}
+
+    def delta_base(self, flog, fparents):
+        '''Return the revision of flog a new revision with the file parents
+        fparents will most likely be stored as a delta against.'''
+        if not len(flog):
+            return None
+        if getattr(flog, '_generaldelta', False):
+            revs = [flog.rev(node) for node in fparents
+                if node != nullid and node in flog.nodemap]
+            if revs:
+                return max(revs)
+        return len(flog) - 1
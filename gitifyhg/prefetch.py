@@ -0,0 +1,199 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import gzip
+import fcntl
+from StringIO import StringIO
+
+from path import Path as p
+from mercurial import encoding
+from mercurial.node import hex as hghex
+from mercurial.node import bin as hgbin
+
+from . import util
+from .util import log, output_raw
+from .streamcache import CHUNK_SIZE
+
+
+def lock_prefetch(remotedir):
+    '''Take the prefetch.lock of remotedir and return the open lock file,
+    which releases the lock when it is closed. Returns None if another
+    process holds the lock.'''
+    lock = open(remotedir.joinpath('prefetch.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock.close()
+        return None
+    return lock
+
+
+class PendingImport(object):
+    '''Commits rendered by gitifyhg prefetch ahead of the next git fetch.
+
+    prefetch pulls into the local clone and renders the revisions of every
+    ref git does not have yet into a gzipped segment of fast-import commits
+    in remotedir, using the marks that the next import would assign. It does
+    not store those marks: they are listed in the index next to the
+    segment, together with the last mark the segment starts from. If no
+    import has happened since, the next import sends the segment to git as
+    it is, adopts its marks and only renders what is newer. Otherwise the
+    segment is stale and thrown away.
+
+    While rendering, HGImporter records every revision through begin() and
+    end(), the way it does for a StreamCache. A prefetch holds
+    prefetch.lock until the new segment is complete, and an import only
+    takes over a segment while holding the lock itself.'''
+
+    def __init__(self, hgremote):
+        self.remotedir = hgremote.remotedir
+        self.index_path = self.remotedir.joinpath('prefetch.json')
+        self.repo = hgremote.repo
+        self.key = {
+            'prefix': hgremote.prefix,
+            'path-filter': hgremote.path_filter.config(),
+        }
+        self.revisions = []
+
+    def load(self):
+        '''Return the index of the pending segment, or None if there is no
+        segment or it was rendered with different settings.'''
+        if not self.index_path.exists():
+            return None
+        with self.index_path.open() as file:
+            index = json.load(file)
+        if any(index.get(k) != v for k, v in self.key.iteritems()):
+            return None
+        return index
+
+    def adopt(self, marks):
+        '''Like replay, for an import. The pending segment is left alone
+        while a prefetch is rendering the next one; it is stale once the
+        import is done.'''
+        if not self.index_path.exists():
+            return 0
+        lock = lock_prefetch(self.remotedir)
+        if lock is None:
+            log("Skipping the prefetched commits, a prefetch is running")
+            return 0
+        try:
+            return self.replay(marks)
+        finally:
+            lock.close()
+
+    def replay(self, marks):
+        '''Send the pending segment to git and adopt its marks, if it was
+        rendered on top of the current marks. The segment is removed either
+        way. Returns the number of commits replayed.'''
+        index = self.load()
+        if index is None:
+            return 0
+        path = self.remotedir.joinpath(index['file'])
+        nodemap = self.repo.changelog.nodemap
+        count = 0
+        if index['base-mark'] != marks.last_mark:
+            log("Prefetched commits are stale, rendering them again")
+        elif not all(hgbin(hex) in nodemap
+                for hex, mark, alias in index['revisions']):
+            log("Prefetched commits are gone from the clone", "WARNING")
+        else:
+            with gzip.open(path, 'rb') as file:
+                while True:
+                    chunk = file.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    output_raw(chunk)
+            for hex, mark, alias in index['revisions']:
+                if alias:
+                    marks.alias_mark(hgbin(hex), mark)
+                else:
+                    marks.new_mark(hgbin(hex), mark)
+                    count += 1
+            marks.last_mark = index['last-mark']
+            self.revisions = [tuple(revision)
+                for revision in index['revisions']]
+            log("Replayed %d prefetched commits" % count)
+        self.discard(index)
+        return count
+
+    def discard(self, index):
+        self.index_path.remove_p()
+        self.remotedir.joinpath(index['file']).remove_p()
+
+    def render(self, importer, refs):
+        '''Render the revisions of refs, a list of (name, reftype, head)
+        tuples, on top of the pending segment into a new one. Returns the
+        number of commits rendered.'''
+        marks = importer.marks
+        base_mark = marks.last_mark
+        name = 'prefetch-%d-%d.gz' % (base_mark, os.getpid())
+        path = self.remotedir.joinpath(name)
+        stdout, tmp = util.actual_stdout, encoding.encoding
+        util.actual_stdout = gzip.open(path, 'wb')
+        encoding.encoding = 'utf-8'
+        try:
+            # The commits prefetched before are carried over into the new
+            # segment, the marks they use are taken
+            count = self.replay(marks)
+            importer.stream_cache = self
+            importer.show_progress = False
+            for ref_name, reftype, head in refs:
+                count += importer.process_revisions(ref_name, reftype, head)
+        except:
+            path.remove()
+            raise
+        finally:
+            util.actual_stdout.close()
+            util.actual_stdout, encoding.encoding = stdout, tmp
+        if not self.revisions:
+            path.remove()
+            return 0
+        index = dict(self.key)
+        index['file'] = name
+        index['base-mark'] = base_mark
+        index['last-mark'] = marks.last_mark
+        index['revisions'] = self.revisions
+        temp_index = p(self.index_path + '.%d' % os.getpid())
+        with temp_index.open('w') as file:
+            file.write(json.dumps(index).decode('UTF-8'))
+        temp_index.rename(self.index_path)
+        return count
+
+    def begin(self):
+        pass
+
+    def end(self, node, mark, alias=False):
+        self.revisions.append((hghex(node), mark, alias))
+
+
+def pending_refs(hgremote, importer):
+    '''Return the refs hgremote lists whose head git does not have, as
+    (name, reftype, head) tuples.'''
+    stdout = util.actual_stdout
+    util.actual_stdout = StringIO()
+    try:
+        hgremote.do_list(None)
+        listing = util.actual_stdout.getvalue()
+    finally:
+        util.actual_stdout = stdout
+    refs = []
+    for line in listing.splitlines():
+        if line.startswith('?'):
+            refs.append(importer.ref_head(line.split()[1]))
+    return refs
@@ -0,0 +1,107 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+from fnmatch import fnmatchcase
+
+from mercurial.node import hex as hghex
+
+from .util import git_config, git_config_list, BRANCH, BOOKMARK, TAG
+
+# The part of the git config variable names that refers to each ref type.
+REFTYPE_NAMES = {BRANCH: 'Branch', BOOKMARK: 'Bookmark', TAG: 'Tag'}
+
+
+class RefFilter(object):
+    '''Decides which branches, bookmarks and tags are listed to git.
+
+    Each ref type is configured with the multi-valued git config variables
+    remote.<alias>.hg<Type>Include and hg<Type>Exclude, which take shell
+    glob patterns matched against the Mercurial name, and with
+    hg<Type>MaxAge, the number of days after which a ref whose commit did
+    not change is no longer listed. <Type> is one of Branch, Bookmark and
+    Tag.
+
+    The commit date of every ref that has been checked against an age
+    cutoff is kept in a cache in remotedir together with the node it was
+    read from, so later fetches only look at refs that moved.'''
+
+    def __init__(self, alias, cache_path):
+        self.rules = {}
+        for reftype, name in REFTYPE_NAMES.iteritems():
+            include = git_config_list(alias, 'hg%sInclude' % name)
+            exclude = git_config_list(alias, 'hg%sExclude' % name)
+            max_age = git_config(alias, 'hg%sMaxAge' % name)
+            if include or exclude or max_age:
+                self.rules[reftype] = (include, exclude,
+                    float(max_age) * 24 * 60 * 60 if max_age else None)
+        self.cache_path = cache_path
+        self.dates = None  # "reftype name" to [hex node, commit date]
+        self.seen = set()
+        self.changed = False
+        self.now = time.time()
+
+    def __nonzero__(self):
+        return bool(self.rules)
+
+    def __call__(self, repo, reftype, name, node):
+        '''Return True if the ref name of reftype pointing at node should be
+        listed.'''
+        if reftype not in self.rules:
+            return True
+        include, exclude, max_age = self.rules[reftype]
+        if include and not any(fnmatchcase(name, p) for p in include):
+            return False
+        if any(fnmatchcase(name, p) for p in exclude):
+            return False
+        if max_age is not None:
+            return self.now - self.date(repo, reftype, name, node) <= max_age
+        return True
+
+    def date(self, repo, reftype, name, node):
+        if self.dates is None:
+            self.load()
+        key = '%s %s' % (reftype, name)
+        self.seen.add(key)
+        cached = self.dates.get(key)
+        if cached and cached[0] == hghex(node):
+            return cached[1]
+        date = repo[node].date()[0]
+        self.dates[key] = [hghex(node), date]
+        self.changed = True
+        return date
+
+    def load(self):
+        self.dates = {}
+        if self.cache_path.exists():
+            with self.cache_path.open() as file:
+                self.dates = json.load(file)
+
+    def store(self):
+        '''Write the commit dates of the refs checked since the cache was
+        loaded, dropping those of refs that are gone.'''
+        if self.dates is None:
+            return
+        if not self.changed and self.seen == set(self.dates):
+            return
+        self.dates = dict((key, self.dates[key]) for key in self.seen)
+        if not self.cache_path.parent.exists():
+            self.cache_path.parent.makedirs()
+        with self.cache_path.open('w') as file:
+            file.write(json.dumps(self.dates).decode('UTF-8'))
+        self.changed = False
@@ -0,0 +1,191 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+# Upgrading the store of gitifyhg's Mercurial clones to the format that is
+# fastest to read.
+
+import time
+
+from path import Path as p
+from mercurial import hg, revlog
+from mercurial.lock import release
+
+from .util import die, log
+
+from apiwrapper import (FAST_STORE_FORMATS, hg_fast_store_format,
+    hg_store_vfs, hg_addrevision)
+
+# Requirements that describe the layout of the store rather than features
+# of the repository; an upgraded clone gets those of a new repository
+STORE_REQUIREMENTS = set(('revlogv1', 'store', 'fncache', 'dotencode')) | \
+    set(FAST_STORE_FORMATS)
+# Requirements whose stores cannot be copied revlog by revlog
+UNSUPPORTED_REQUIREMENTS = set(('treemanifest', 'manifestv2'))
+
+
+def missing_formats(repo):
+    '''Return the store formats that make repo faster to read, are supported
+    by the running Mercurial and are not used by repo yet.'''
+    return [format for format in FAST_STORE_FORMATS
+        if format in repo.supportedformats and
+            format not in repo.requirements]
+
+
+def store_size(repo):
+    '''Return the number of bytes the revlogs of repo take up.'''
+    return sum(size for unencoded, encoded, size in repo.store.walk())
+
+
+def read_throughput(repo, sample):
+    '''Read the changelog entries, manifests and changed files of the last
+    sample changesets of repo the way HGImporter does, and return a tuple of
+    the number of bytes read and the seconds it took. Use a repository
+    object that was just opened so no revisions are cached yet.'''
+    repo = repo.unfiltered()
+    size = 0
+    start = time.time()
+    for rev in xrange(max(len(repo) - sample, 0), len(repo)):
+        ctx = repo[rev]
+        size += len(ctx.description())
+        manifest = ctx.manifest()
+        for path in ctx.files():
+            if path in manifest:
+                size += len(ctx.filectx(path).data())
+    return size, time.time() - start
+
+
+def upgrade_store(repo):
+    '''Rewrite the store of repo in the fastest format the running Mercurial
+    supports, computing every delta again.
+
+    The revlogs are copied revision by revision, in the same order, into
+    the store of a new repository in .hg/upgrade. That keeps the revision
+    numbers, which marks and caches are indexed by, while generaldelta
+    picks the parent each revision is stored against. The new store
+    replaces the old one under the working copy and store locks, once all
+    of it is written. Renaming the new requirements into place completes
+    the upgrade; recover_upgrade() finishes or rolls back an upgrade that
+    was interrupted before that.'''
+    unsupported = UNSUPPORTED_REQUIREMENTS & repo.requirements
+    if unsupported or 'store' not in repo.requirements:
+        die("Cannot upgrade a clone with the %s requirements" %
+            ', '.join(sorted(unsupported or ['no store'])))
+    hgdir = p(repo.path)
+    tempdir = hgdir.joinpath('upgrade')
+    myui = repo.ui.copy()
+    hg_fast_store_format(myui)
+    # Ignore the deltas of the old store, and try both parents of merges
+    myui.setconfig('format', 'generaldelta', True)
+    myui.setconfig('format', 'aggressivemergedeltas', True)
+
+    wlock = lock = None
+    try:
+        wlock = repo.wlock()
+        if recover_upgrade(repo):
+            die("Recovered an interrupted upgrade of the clone, run the "
+                "upgrade again")
+        lock = repo.lock()
+        if tempdir.exists():
+            tempdir.rmtree()
+        upgraded = hg.repository(myui, tempdir.encode('utf-8'), create=True)
+        transaction = upgraded.transaction('upgrade')
+        try:
+            for unencoded, encoded, size in repo.store.walk():
+                if unencoded.endswith('.i'):
+                    copy_revlog(hg_store_vfs(repo), hg_store_vfs(upgraded),
+                        unencoded, transaction)
+            transaction.close()
+        finally:
+            transaction.release()
+
+        # Phases and obsolescence markers live next to the revlogs. Rolling
+        # back the copy would empty the revlogs, so it cannot be undone.
+        store = p(repo.spath)
+        upgraded_store = p(upgraded.spath)
+        for path in upgraded_store.files('undo*'):
+            path.remove()
+        for path in store.files():
+            if (path.ext not in ('.i', '.d', '.ndb') and
+                    path.name not in ('fncache', 'lock') and
+                    not path.name.startswith(('undo', 'journal'))):
+                path.copy2(upgraded_store.joinpath(path.name))
+
+        requirements = (repo.requirements - STORE_REQUIREMENTS) | \
+            (upgraded.requirements & STORE_REQUIREMENTS)
+        new_requires = hgdir.joinpath('requires.upgrade')
+        with new_requires.open('wb') as file:
+            file.write(''.join('%s\n' % requirement
+                for requirement in sorted(requirements)))
+        backup = hgdir.joinpath('store.old')
+        if backup.exists():
+            backup.rmtree()
+        # The lock file moves away with the old store, releasing the lock
+        # afterwards finds nothing to remove
+        store.rename(backup)
+        try:
+            upgraded_store.rename(store)
+        except Exception:
+            backup.rename(store)
+            new_requires.remove()
+            raise
+        new_requires.rename(hgdir.joinpath('requires'))
+    finally:
+        release(lock, wlock)
+    backup.rmtree()
+    tempdir.rmtree()
+    return sorted(requirements - repo.requirements)
+
+
+def recover_upgrade(repo):
+    '''Finish or roll back an upgrade_store() of repo that was interrupted
+    while swapping the stores, under the working copy lock. If the new
+    store is in place the new requirements are too, otherwise the old
+    store is put back. Returns True if anything was recovered, in which
+    case repo has to be opened again.'''
+    hgdir = p(repo.path)
+    store = hgdir.joinpath('store')
+    backup = hgdir.joinpath('store.old')
+    new_requires = hgdir.joinpath('requires.upgrade')
+    if not (backup.exists() or new_requires.exists()):
+        return False
+    wlock = repo.wlock()
+    try:
+        if not store.exists() and backup.exists():
+            log("Restoring the store of an interrupted upgrade", "WARNING")
+            backup.rename(store)
+        elif new_requires.exists() and backup.exists():
+            log("Completing an interrupted upgrade", "WARNING")
+            new_requires.rename(hgdir.joinpath('requires'))
+        if new_requires.exists():
+            new_requires.remove()
+        if backup.exists():
+            backup.rmtree()
+    finally:
+        wlock.release()
+    return True
+
+
+def copy_revlog(source_vfs, target_vfs, path, transaction):
+    '''Add the revisions of the revlog path in source_vfs to the one in
+    target_vfs, letting it choose the deltas.'''
+    source = revlog.revlog(source_vfs, path)
+    target = revlog.revlog(target_vfs, path)
+    for rev in source:
+        node = source.node(rev)
+        p1, p2 = source.parents(node)
+        hg_addrevision(target, source.revision(node), transaction,
+            source.linkrev(rev), p1, p2, node, source.flags(rev))
@@ -0,0 +1,151 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import gzip
+
+from path import Path as p
+from mercurial.node import hex as hghex
+from mercurial.node import bin as hgbin
+
+from .util import log, git_config, copy_output, output_raw
+
+# Size of the chunks segments are replayed in.
+CHUNK_SIZE = 128 * 1024
+
+
+class StreamCache(object):
+    '''An on-disk cache of rendered fast-import commits for fresh clones.
+
+    The cache lives in the directory named by remote.<alias>.hgStreamCache,
+    in a subdirectory per remote url uuid. It holds gzipped segments of
+    commit records, exactly as HGImporter wrote them to git, plus an index
+    listing the hg node and mark of every revision in each segment.
+
+    A fresh clone replays the cached segments into fast-import, restores the
+    marks they used and only renders revisions that are not in the cache.
+    Those are written to a new segment, so the cache grows with the
+    repository. Only sessions that started from the complete cache may add
+    to it, which keeps the marks of all segments consistent.'''
+
+    def __init__(self, directory, hgremote):
+        self.directory = directory.joinpath(hgremote.uuid)
+        self.index_path = self.directory.joinpath('index.json')
+        self.repo = hgremote.repo
+        self.key = {
+            'prefix': hgremote.prefix,
+            'path-filter': hgremote.path_filter.config(),
+        }
+        self.segment = None
+        self.writable = False
+        self.load()
+
+    @classmethod
+    def from_git_config(cls, hgremote):
+        '''Return the StreamCache configured for hgremote or None.'''
+        directory = git_config(hgremote.alias, 'hgStreamCache')
+        if not directory:
+            return None
+        return cls(p(os.path.expanduser(directory)), hgremote)
+
+    def load(self):
+        self.segments = []
+        self.last_mark = 0
+        if self.index_path.exists():
+            with self.index_path.open() as file:
+                loaded = json.load(file)
+            if all(loaded.get(k) == v for k, v in self.key.iteritems()):
+                self.segments = loaded['segments']
+                self.last_mark = loaded['last-mark']
+
+    def replay(self, marks):
+        '''Send every cached segment whose revisions all exist in the local
+        clone to git and mark those revisions. Only done for fresh clones.
+        Returns the number of commits replayed.'''
+        self.writable = False
+        if marks.last_mark:
+            return 0
+        count = 0
+        for segment in self.segments:
+            nodemap = self.repo.changelog.nodemap
+            if not all(hgbin(hex) in nodemap for hex, mark, alias
+                       in segment['revisions']):
+                log("Stream cache is stale from %s on" % segment['file'],
+                    "WARNING")
+                return count
+            with gzip.open(self.directory.joinpath(segment['file']), 'rb') as file:
+                while True:
+                    chunk = file.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    output_raw(chunk)
+            for hex, mark, alias in segment['revisions']:
+                if alias:
+                    marks.alias_mark(hgbin(hex), mark)
+                else:
+                    marks.new_mark(hgbin(hex), mark)
+                    count += 1
+        marks.last_mark = self.last_mark
+        self.writable = True
+        log("Replayed %d commits from the stream cache" % count)
+        return count
+
+    def begin(self):
+        '''Start copying the output for a new revision into the segment.'''
+        if self.writable:
+            copy_output(self._segment_file())
+
+    def end(self, node, mark, alias=False):
+        '''Stop copying output and record that the revision node was
+        rendered with mark (or aliased to it, if alias is set).'''
+        if self.writable:
+            copy_output(None)
+            self._segment_file()
+            self.segment['revisions'].append((hghex(node), mark, alias))
+
+    def _segment_file(self):
+        if self.segment is None:
+            if not self.directory.exists():
+                self.directory.makedirs()
+            name = 'segment-%d-%d.gz' % (self.last_mark, os.getpid())
+            self.segment = {'file': name, 'revisions': []}
+            self.segment_file = gzip.open(
+                self.directory.joinpath(name + '.tmp'), 'wb')
+        return self.segment_file
+
+    def finish(self, marks):
+        '''Store the segment written during this session, unless another
+        session added to the cache in the meantime.'''
+        if self.segment is None:
+            return
+        self.segment_file.close()
+        temp_path = self.directory.joinpath(self.segment['file'] + '.tmp')
+        previous = self.last_mark
+        self.load()
+        if self.last_mark != previous or not self.segment['revisions']:
+            temp_path.remove()
+            return
+        temp_path.rename(self.directory.joinpath(self.segment['file']))
+        index = dict(self.key)
+        index['segments'] = self.segments + [self.segment]
+        index['last-mark'] = marks.last_mark
+        temp_index = p(self.index_path + '.%d' % os.getpid())
+        with temp_index.open('w') as file:
+            file.write(json.dumps(index).decode('UTF-8'))
+        temp_index.rename(self.index_path)
+        self.segment = None
@@ -1,6 +1,12 @@
 import os
 import sys
 import json
+import mmap
+import struct
+import hashlib
+import subprocess
+from array import array
+from path import Path as p
 
 from mercurial.node import hex as hghex  # What idiot overrode a builtin?
 from mercurial.node import bin as hgbin
@@ -16,6 +22,8 @@ BOOKMARK = 'bookmark'
 TAG = 'tag'
 
 actual_stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)  # Ensure stdout is unbuffered
+# A file that receives a copy of everything output to git, if set.
+output_copy = None
 
 
 def deactivate_stdout():
@@ -39,6 +47,12 @@ def log(msg, level="DEBUG"):
         sys.stderr.write(u'%s: %r\n' % (level, msg))
 
 
+def progress(msg):
+    '''Tell the user how far along we are, for commands whose output to git
+    cannot carry fast-import progress lines.'''
+    sys.stderr.write('progress: %s\n' % msg)
+
+
 def die(msg, *args):
     log(msg, 'ERROR', *args)
     sys.exit(1)
@@ -49,6 +63,31 @@ def output(msg=''):
         msg = msg.encode('utf-8')
     log("OUT: %s" % msg)
     print >> actual_stdout, msg
+    if output_copy is not None:
+        print >> output_copy, msg
+
+
+def output_stream(size, chunks):
+    '''Output a data command for size bytes whose contents are taken from
+    the chunks iterable, without ever joining them into one string.'''
+    output("data %d" % size)
+    for chunk in chunks:
+        output_raw(chunk)
+    output()
+
+
+def output_raw(data):
+    '''Output data exactly as given, without logging it.'''
+    actual_stdout.write(data)
+    if output_copy is not None:
+        output_copy.write(data)
+
+
+def copy_output(file):
+    '''Copy everything that is output from now on to file as well. Pass None
+    to stop copying.'''
+    global output_copy
+    output_copy = file
 
 
 def version():
@@ -160,6 +199,54 @@ def user_config():
     return hgrc
 
 
+# The configuration of each remote, read by remote_config() once per git
+# directory
+remote_configs = {}
+
+
+def remote_config(alias):
+    '''Return the git configuration of the remote alias as a list of
+    (key, value) tuples. git reports keys with the variable name in lower
+    case. The whole remote is read with one git config call the first time
+    and kept for the lifetime of the process.'''
+    cache_key = (os.environ.get('GIT_DIR'), alias)
+    if cache_key not in remote_configs:
+        process = subprocess.Popen(['git', 'config', '--null',
+            '--get-regexp', r'^remote\.%s\.' % alias.replace('.', r'\.')],
+            stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        config = []
+        for entry in output.split('\0'):
+            if entry:
+                key, _, value = entry.partition('\n')
+                config.append((key, value))
+        remote_configs[cache_key] = config
+    return remote_configs[cache_key]
+
+
+def git_config(alias, key, default=None):
+    '''Return the value of remote.<alias>.<key> from the git configuration
+    or default if it is not set.'''
+    values = git_config_list(alias, key)
+    return values[-1] if values else default
+
+
+def git_config_bool(alias, key, default=False):
+    '''Return remote.<alias>.<key> interpreted as a git boolean.'''
+    value = git_config(alias, key)
+    if value is None:
+        return default
+    return value.lower() in ('true', 'yes', 'on', '1')
+
+
+def git_config_list(alias, key):
+    '''Return all values of the multi-valued remote.<alias>.<key> git
+    configuration variable.'''
+    name = 'remote.%s.%s' % (alias, key.lower())
+    return [value for config_key, value in remote_config(alias)
+        if config_key == name]
+
+
 def relative_path(path):
     """Ensure path is relative"""
     return os.path.relpath(path, '/') if os.path.isabs(path) else path
@@ -168,12 +255,21 @@ def relative_path(path):
 class HGMarks(object):
     '''Maps integer marks to specific string mercurial revision identifiers.
     Identifiers are passed as binary nodes and converted to/from hex strings
-    before and after storage.'''
+    before and after storage.
+
+    Once a repository has been attached, the marks of its revisions are kept
+    in arrays indexed by local revision number and by mark rather than in
+    dicts keyed by hex strings, which makes lookups by revision number cheap
+    and takes a fraction of the memory. The arrays are built from the hex
+    strings whenever the marks are loaded, so load() brings them up to date
+    after the changelog was stripped or rolled back. Marks of revisions that
+    are not in the repository stay in the dicts.'''
 
     def __init__(self, storage_path):
         ''':param storage_path: The file that marks are stored in between calls.
         Marks are stored in json format.'''
         self.storage_path = storage_path
+        self.repo = None
         self.load()
 
     def load(self):
@@ -189,6 +285,10 @@ class HGMarks(object):
                     self.revisions_to_marks.iteritems()])
             self.notes_mark = loaded.get('notes-mark', None)
             self.marks_version = loaded.get('marks-version', 1)
+            self.aliases = loaded.get('aliases', {})
+            self.marks_to_revisions.update((int(k), v) for k, v in
+                    loaded.get('alias-heads', {}).iteritems())
+            self.path_filter = loaded.get('path-filter', None)
         else:
             self.tips = {}
             self.revisions_to_marks = {}
@@ -196,20 +296,74 @@ class HGMarks(object):
             self.last_mark = 0
             self.notes_mark = None
             self.marks_version = 3
+            self.aliases = {}
+            self.path_filter = None
+        # The mark of every local revision, negated for aliases, and the
+        # local revision plus one every mark resolves to. 0 means none.
+        self.rev_marks = array('i')
+        self.mark_revs = array('i')
+        if self.repo is not None:
+            self.attach(self.repo)
+
+    def attach(self, repo):
+        '''Keep the marks of the revisions in repo in the arrays indexed by
+        revision number from now on.'''
+        self.repo = repo
+        changelog = self.changelog()
+        self.rev_marks = array('i', [0]) * len(changelog)
+        self.mark_revs = array('i', [0]) * (self.last_mark + 1)
+        for revisions, sign in ((self.revisions_to_marks, 1),
+                (self.aliases, -1)):
+            for revision, mark in revisions.items():
+                rev = changelog.nodemap.get(hgbin(revision))
+                if rev is not None:
+                    self.rev_marks[rev] = sign * mark
+                    del revisions[revision]
+        for mark, revision in self.marks_to_revisions.items():
+            rev = changelog.nodemap.get(hgbin(revision))
+            if rev is not None:
+                self.mark_revs[mark] = rev + 1
+                del self.marks_to_revisions[mark]
+
+    def changelog(self):
+        return self.repo.unfiltered().changelog
 
     def store(self):
         '''Save marks to the storage file.'''
+        revisions_to_marks, aliases, marks_to_revisions = self.hex_marks()
         with self.storage_path.open('w') as file:
             file.write(
                 json.dumps({
                     'tips': self.tips,
-                    'revisions_to_marks': self.revisions_to_marks,
+                    'revisions_to_marks': revisions_to_marks,
                     'last-mark': self.last_mark,
                     'notes-mark': self.notes_mark,
                     'marks-version': self.marks_version,
+                    'aliases': aliases,
+                    'alias-heads': dict((mark, marks_to_revisions[mark])
+                        for mark in set(aliases.itervalues())),
+                    'path-filter': self.path_filter,
                 }).decode('UTF-8')
             )
 
+    def hex_marks(self):
+        '''Return all marks as the dicts revisions_to_marks, aliases and
+        marks_to_revisions keyed by hex strings.'''
+        revisions_to_marks = dict(self.revisions_to_marks)
+        aliases = dict(self.aliases)
+        marks_to_revisions = dict(self.marks_to_revisions)
+        if self.repo is not None:
+            node = self.changelog().node
+            for rev, mark in enumerate(self.rev_marks):
+                if mark > 0:
+                    revisions_to_marks[hghex(node(rev))] = mark
+                elif mark < 0:
+                    aliases[hghex(node(rev))] = -mark
+            for mark, rev in enumerate(self.mark_revs):
+                if rev:
+                    marks_to_revisions[mark] = hghex(node(rev - 1))
+        return revisions_to_marks, aliases, marks_to_revisions
+
     def upgrade_marks(self, hgremote):
         if self.marks_version == 1:  # Convert from integer reversions to hgsha1
             log("Upgrading marks-hg from hg sequence number to SHA1", "WARNING")
@@ -226,24 +380,148 @@ class HGMarks(object):
             self.marks_version = 3
             log("Upgrade complete", "WARNING")
 
+    def local_rev(self, revision):
+        '''Return the revision number of the binary node revision in the
+        attached repository, or None if it is not there.'''
+        if self.repo is None:
+            return None
+        rev = self.changelog().nodemap.get(revision)
+        if rev is not None and rev >= len(self.rev_marks):
+            # Committed since the repository was attached
+            self.rev_marks.extend(
+                array('i', [0]) * (rev + 1 - len(self.rev_marks)))
+        return rev
+
     def mark_to_revision(self, mark):
+        if mark < len(self.mark_revs) and self.mark_revs[mark]:
+            return self.changelog().node(self.mark_revs[mark] - 1)
         return hgbin(self.marks_to_revisions[mark])
 
     def revision_to_mark(self, revision):
-        return self.revisions_to_marks[hghex(revision)]
+        rev = self.local_rev(revision)
+        if rev is not None:
+            return self.rev_to_mark(rev)
+        revision = hghex(revision)
+        if revision in self.aliases:
+            return self.aliases[revision]
+        return self.revisions_to_marks[revision]
+
+    def rev_to_mark(self, rev):
+        '''Return the mark of the revision number rev of the attached
+        repository.'''
+        mark = rev < len(self.rev_marks) and self.rev_marks[rev]
+        if not mark:
+            raise KeyError(rev)
+        return abs(mark)
+
+    def set_mark(self, revision, mark, alias=False):
+        rev = self.local_rev(revision)
+        if rev is not None:
+            self.rev_marks[rev] = -mark if alias else mark
+        elif alias:
+            self.aliases[hghex(revision)] = mark
+        else:
+            self.revisions_to_marks[hghex(revision)] = mark
+
+    def set_mark_revision(self, mark, revision):
+        '''Make mark resolve to revision.'''
+        rev = self.local_rev(revision)
+        if rev is not None:
+            if mark >= len(self.mark_revs):
+                self.mark_revs.extend(
+                    array('i', [0]) * (mark + 1 - len(self.mark_revs)))
+            self.mark_revs[mark] = rev + 1
+            self.marks_to_revisions.pop(mark, None)
+        else:
+            if mark < len(self.mark_revs):
+                self.mark_revs[mark] = 0
+            self.marks_to_revisions[mark] = hghex(revision)
 
     def get_mark(self, revision):
         self.last_mark += 1
-        self.revisions_to_marks[hghex(revision)] = self.last_mark
+        self.set_mark(revision, self.last_mark)
+        self.set_mark_revision(self.last_mark, revision)
         return self.last_mark
 
     def new_mark(self, revision, mark):
-        self.revisions_to_marks[hghex(revision)] = mark
-        self.marks_to_revisions[mark] = hghex(revision)
+        self.set_mark(revision, mark)
+        self.set_mark_revision(mark, revision)
         self.last_mark = mark
 
+    def alias_mark(self, revision, mark):
+        '''Map revision to the existing mark of one of its ancestors. This is
+        used for changesets that are not imported into git because a path
+        filter hides all of their changes. The mark then resolves to the
+        newest aliased revision, so commits pushed on top of it are based on
+        the full hg manifest rather than on the ancestor's.'''
+        self.set_mark(revision, mark, alias=True)
+        self.set_mark_revision(mark, revision)
+
     def is_marked(self, revision):
-        return hghex(revision) in self.revisions_to_marks
+        rev = self.local_rev(revision)
+        if rev is not None:
+            return self.rev_is_marked(rev)
+        revision = hghex(revision)
+        return revision in self.revisions_to_marks or revision in self.aliases
+
+    def rev_is_marked(self, rev):
+        '''Like is_marked, for the revision number rev of the attached
+        repository.'''
+        return rev < len(self.rev_marks) and self.rev_marks[rev] != 0
+
+    def marked_since(self, mark):
+        '''Yield a tuple of (mark, hex revision) for every revision that got
+        a mark greater than mark, leaving out aliases.'''
+        for revision_mark, revision, alias in self.mappings_since(mark):
+            if not alias:
+                yield revision_mark, revision
+
+    def mappings_since(self, mark):
+        '''Yield a tuple of (mark, hex revision, alias) for every revision
+        that got a mark greater than mark, where alias tells whether the
+        revision is an alias of the mark.'''
+        for revisions, alias in ((self.revisions_to_marks, False),
+                (self.aliases, True)):
+            for revision, revision_mark in revisions.iteritems():
+                if revision_mark > mark:
+                    yield revision_mark, revision, alias
+        if self.repo is not None:
+            node = self.changelog().node
+            for rev, revision_mark in enumerate(self.rev_marks):
+                if abs(revision_mark) > mark:
+                    yield abs(revision_mark), hghex(node(rev)), revision_mark < 0
+
+    def mappings_from_rev(self, rev):
+        '''Like mappings_since, for every marked revision of the attached
+        repository whose revision number is rev or greater.'''
+        if self.repo is None:
+            return
+        node = self.changelog().node
+        for rev in xrange(rev, min(len(self.rev_marks), self.rev_count())):
+            revision_mark = self.rev_marks[rev]
+            if revision_mark:
+                yield (abs(revision_mark), hghex(node(rev)),
+                    revision_mark < 0)
+
+    def rev_count(self):
+        '''Return the number of revisions in the attached repository.'''
+        if self.repo is None:
+            return 0
+        return len(self.changelog())
+
+    def check_path_filter(self, path_filter):
+        '''Record the path filter configuration of the remote. Changing the
+        filter after the first import would leave git with a history that
+        matches neither configuration, so that is an error.'''
+        if self.last_mark and self.path_filter != path_filter:
+            die("The hgInclude/hgExclude configuration of this remote has "
+                "changed since it was first fetched. Clone it again to use "
+                "the new path filter.")
+        self.path_filter = path_filter
+
+    def new_blob_mark(self):
+        self.last_mark += 1
+        return self.last_mark
 
     def new_notes_mark(self):
         self.last_mark += 1
@@ -252,29 +530,252 @@ class HGMarks(object):
 
 
 class GitMarks(object):
-    '''Maps integer marks to git commit hashes.'''
+    '''Maps integer marks to git commit hashes.
+
+    marks-git is written by git and can grow to millions of lines, so it is
+    not read into memory. Instead a sidecar index (marks-git.idx) of fixed
+    width records sorted by mark is kept next to it and searched with a
+    binary search over an mmap. The index header remembers how much of
+    marks-git it covers, so when git has only appended to the file (as
+    fast-import does after a fetch) just the new lines are read.'''
+
+    # magic, hash width, size of marks-git covered, number of records,
+    # digest of its last bytes
+    HEADER = struct.Struct('>4sBQI20s')
+    MAGIC = 'GMX2'
+    MARK = struct.Struct('>I')
+    TAIL_SIZE = 4096
 
     def __init__(self, storage_path):
         ''':param storage_path: The file that marks are stored in between calls.'''
         self.storage_path = storage_path
-        self.load()
+        self.index_path = p(storage_path + '.idx')
+        self.index = None
+        self.count = 0
+        self.loaded = False
 
     def load(self):
-        '''Load the marks from the storage file.'''
-        # TODO: Combine remove_processed_git_marks with this, perhaps by using
-        # an OrderedDict to write entires back out in the order they came in.
-        self.marks_to_hashes = {}
-        if self.storage_path.exists():
-            with self.storage_path.open() as file:
-                for line in file:
-                    if not line.startswith(':'):
-                        die("invalid line in marks-git: " + line)
-                    mark, sha1 = line[1:].split()
-                    self.marks_to_hashes[mark] = sha1
+        '''Bring the index up to date with the marks file and map it.'''
+        self.close()
+        self.loaded = True
+        if not self.storage_path.exists():
+            return
+        with self.storage_path.open('rb') as file:
+            header = self._read_header()
+            if header and self._covers(file, header[2], header[4]):
+                if header[2] < self.storage_path.size:
+                    self._update_index(file, header)
+            else:
+                log("Rebuilding the index of marks-git")
+                self._write_index(file, self._parse(file, 0), 40)
+        self._map_index()
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+        self.index = None
+        self.count = 0
+        self.loaded = False
 
     def has_mark(self, mark):
-        return str(mark) in self.marks_to_hashes
+        return self._find(int(mark)) is not None
 
     def mark_to_hash(self, mark):
-        return self.marks_to_hashes[str(mark)]
-
+        sha1 = self._find(int(mark))
+        if sha1 is None:
+            raise KeyError(mark)
+        return sha1
+
+    def remove_marks(self, marks):
+        '''Remove marks from marks-git in place. Only the part of the file
+        after the first removed line is rewritten, so dropping marks from the
+        end of the file is a plain truncation. The index is rewritten from
+        its own records without the removed marks, rather than being built
+        from marks-git again on the next load.'''
+        marks = set(str(mark) for mark in marks)
+        # Index whatever git appended first, so the index covers the file
+        self.load()
+        self.close()
+        with self.storage_path.open('rb') as fread:
+            with self.storage_path.open('r+b') as fwrite:
+                removing = False
+                while True:
+                    position = fread.tell()
+                    line = fread.readline()
+                    if not line:
+                        break
+                    if not line.startswith(':'):
+                        die("invalid line in marks-git: " + line)
+                    if line[1:].split()[0] in marks:
+                        if not removing:
+                            fwrite.seek(position)
+                            removing = True
+                    elif removing:
+                        fwrite.write(line)
+                if removing:
+                    fwrite.truncate()
+        if not removing:
+            return
+        width = self._read_header()[1]
+        records = self._read_records(width)
+        for mark in marks:
+            records.pop(int(mark), None)
+        with self.storage_path.open('rb') as file:
+            self._write_index(file, records, width)
+
+    def remove_marks_after(self, mark):
+        '''Remove the marks greater than mark. git moves the marks of a
+        push into place after the helper has exited, so those of a rejected
+        push cannot be removed during the push itself.'''
+        stale = [stale_mark for stale_mark, sha1 in self.marks_since(mark)]
+        if stale:
+            log("Removing %d marks of a rejected push from marks-git" %
+                len(stale))
+            self.remove_marks(stale)
+
+    def marks_since(self, mark):
+        '''Yield a tuple of (mark, hash) for every mark greater than mark,
+        in ascending order.'''
+        if not self.loaded:
+            self.load()
+        for position in xrange(self._lower_bound(mark + 1), self.count):
+            yield self._record(position)
+
+    def _find(self, mark):
+        if not self.loaded:
+            self.load()
+        position = self._lower_bound(mark)
+        if position < self.count:
+            found, sha1 = self._record(position)
+            if found == mark:
+                return sha1
+        return None
+
+    def _lower_bound(self, mark):
+        '''Return the position of the first record whose mark is not less
+        than mark.'''
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[0] < mark:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _record(self, position):
+        offset = self.HEADER.size + position * (self.MARK.size + self.width)
+        mark = self.MARK.unpack_from(self.index, offset)[0]
+        offset += self.MARK.size
+        return mark, self.index[offset:offset + self.width]
+
+    def _parse(self, file, start):
+        '''Return a dict of marks to hashes for the lines of file from byte
+        offset start on.'''
+        file.seek(start)
+        marks = {}
+        for line in file:
+            if not line.startswith(':'):
+                die("invalid line in marks-git: " + line)
+            mark, sha1 = line[1:].split()
+            marks[int(mark)] = sha1
+        return marks
+
+    def _tail_digest(self, file, size):
+        start = max(0, size - self.TAIL_SIZE)
+        file.seek(start)
+        return hashlib.sha1(file.read(size - start)).digest()
+
+    def _covers(self, file, size, digest):
+        '''Return True if the first size bytes of file are still the ones the
+        index was built from.'''
+        return (size <= self.storage_path.size and
+            self._tail_digest(file, size) == digest)
+
+    def _read_header(self):
+        if not self.index_path.exists():
+            return None
+        with self.index_path.open('rb') as index:
+            header = index.read(self.HEADER.size)
+        if len(header) != self.HEADER.size:
+            return None
+        header = self.HEADER.unpack(header)
+        if header[0] != self.MAGIC:
+            return None
+        # A truncated or overlong index would silently lose or invent marks
+        if self.index_path.size != (self.HEADER.size +
+                header[3] * (self.MARK.size + header[1])):
+            return None
+        return header
+
+    def _read_records(self, width):
+        record_size = self.MARK.size + width
+        with self.index_path.open('rb') as index:
+            data = index.read()
+        marks = {}
+        for offset in xrange(self.HEADER.size, len(data), record_size):
+            mark = self.MARK.unpack_from(data, offset)[0]
+            offset += self.MARK.size
+            marks[mark] = data[offset:offset + width]
+        return marks
+
+    def _update_index(self, file, header):
+        '''Index the lines git appended to marks-git since the index was
+        last written. Marks appended in ascending order beyond the last
+        indexed mark are appended to the index, anything else causes the
+        index to be rewritten from its own records and the new lines.'''
+        magic, width, covered, count, digest = header
+        new_marks = self._parse(file, covered)
+        size = self.storage_path.size
+        if not new_marks:
+            self._write_header(width, size, count,
+                self._tail_digest(file, size))
+            return
+        record_size = self.MARK.size + width
+        last_mark = None
+        if count:
+            with self.index_path.open('rb') as index:
+                index.seek(self.HEADER.size + (count - 1) * record_size)
+                last_mark = self.MARK.unpack(index.read(self.MARK.size))[0]
+        widths = set(len(sha1) for sha1 in new_marks.itervalues())
+        if widths == set([width]) and (
+                last_mark is None or min(new_marks) > last_mark):
+            log("Appending %d marks to the index of marks-git" %
+                len(new_marks))
+            with self.index_path.open('r+b') as index:
+                index.seek(0, os.SEEK_END)
+                for mark in sorted(new_marks):
+                    index.write(self.MARK.pack(mark) + new_marks[mark])
+            self._write_header(width, size, count + len(new_marks),
+                self._tail_digest(file, size))
+        else:
+            marks = self._read_records(width)
+            marks.update(new_marks)
+            self._write_index(file, marks, width)
+
+    def _write_header(self, width, size, count, digest):
+        with self.index_path.open('r+b') as index:
+            index.write(self.HEADER.pack(self.MAGIC, width, size, count,
+                digest))
+
+    def _write_index(self, file, marks, width):
+        '''Write marks to a fresh index covering all of file.'''
+        if marks:
+            width = len(next(marks.itervalues()))
+        size = self.storage_path.size
+        temp_path = p(self.index_path + '.tmp')
+        with temp_path.open('wb') as index:
+            index.write(self.HEADER.pack(self.MAGIC, width, size,
+                len(marks), self._tail_digest(file, size)))
+            for mark in sorted(marks):
+                index.write(self.MARK.pack(mark) + marks[mark])
+        temp_path.rename(self.index_path)
+
+    def _map_index(self):
+        header = self._read_header()
+        self.width = header[1]
+        self.count = header[3]
+        if self.count:
+            with self.index_path.open('rb') as index:
+                self.index = mmap.mmap(index.fileno(), 0,
+                    access=mmap.ACCESS_READ)
@@ -0,0 +1,171 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checking that the git commits of a remote have the same trees as the
+# Mercurial changesets they were imported from or exported to.
+
+import sqlite3
+import subprocess
+
+from mercurial import hg
+from mercurial.ui import ui
+from mercurial.node import hex as hghex
+
+from .util import gitmode, relative_path
+from .narrow import PathFilter
+from .lfiles import (requires_largefiles, is_largefiles_repo, is_standin,
+    split_standin, read_largefile)
+from .blobindex import blob_hasher
+
+from apiwrapper import hg_enable_extension
+
+
+class VerifyCache(object):
+    '''The changesets whose git commit was found to match, and the git blob
+    hashes of the file revisions that were read to find out, kept in a
+    sqlite database in remotedir. A file revision's filenode determines its
+    contents, so its blob hash never has to be computed twice.'''
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS verified (
+                hg TEXT PRIMARY KEY, git TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS digests (
+                filenode TEXT PRIMARY KEY, blob TEXT NOT NULL);
+        ''')
+
+    def close(self):
+        self.connection.close()
+
+    def verified(self):
+        '''Return a dict of the verified changesets to their git commits.'''
+        return dict(self.connection.execute("SELECT hg, git FROM verified"))
+
+    def digests(self):
+        return dict(self.connection.execute(
+            "SELECT filenode, blob FROM digests"))
+
+    def add(self, revision, commit, digests):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO verified VALUES (?, ?)",
+                (revision, commit))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?)",
+                digests.iteritems())
+
+
+class TreeVerifier(object):
+    '''Compares the tree of a git commit with the manifest of a changeset,
+    the way HGImporter would have rendered it.'''
+
+    def __init__(self, repo_path, git_dir, path_filter, digests):
+        myui = ui()
+        if requires_largefiles(repo_path):
+            hg_enable_extension(myui, 'largefiles')
+        self.repo = hg.repository(myui, repo_path.encode('utf-8'))
+        self.git_dir = git_dir
+        self.path_filter = PathFilter(self.repo.root, *path_filter)
+        self.largefiles = is_largefiles_repo(self.repo)
+        self.digests = digests  # filenodes to blob hashes
+
+    def expected_tree(self, revision, digests):
+        '''Return a dict of paths to the mode and blob hash git should have
+        for them in the commit of revision. Blob hashes that were not in
+        the cache are added to digests.'''
+        ctx = self.repo[revision]
+        manifest = ctx.manifest()
+        tree = {}
+        for path in manifest:
+            git_path = path
+            if self.largefiles:
+                git_path = split_standin(path)
+            if not self.path_filter(git_path):
+                continue
+            filenode = hghex(manifest[path])
+            blob = self.digests.get(filenode) or digests.get(filenode)
+            if blob is None:
+                blob = digests[filenode] = self.blob_hash(ctx, path)
+            tree[relative_path(git_path)] = (gitmode(manifest.flags(path)),
+                blob)
+        return tree
+
+    def blob_hash(self, ctx, path):
+        filectx = ctx.filectx(path)
+        if self.largefiles and is_standin(path):
+            path, size, chunks = read_largefile(self.repo, filectx)
+        else:
+            data = filectx.data()
+            size, chunks = len(data), [data]
+        hasher = blob_hasher(size)
+        for chunk in chunks:
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def git_tree(self, commit):
+        '''Return a dict of paths to mode and blob hash in commit.'''
+        process = subprocess.Popen(['git', '--git-dir=%s' % self.git_dir,
+            'ls-tree', '-r', '-z', '--full-tree', commit],
+            stdout=subprocess.PIPE)
+        listing = process.communicate()[0]
+        if process.returncode:
+            return None
+        tree = {}
+        for entry in listing.split('\0'):
+            if entry:
+                info, path = entry.split('\t', 1)
+                mode, kind, blob = info.split()
+                tree[path] = (mode, blob)
+        return tree
+
+    def verify(self, revision, commit):
+        '''Return a list of the differences between the trees and the
+        digests that were computed.'''
+        digests = {}
+        expected = self.expected_tree(revision, digests)
+        actual = self.git_tree(commit)
+        if actual is None:
+            return ["git commit %s is missing" % commit], digests
+        problems = []
+        for path in sorted(set(expected) | set(actual)):
+            if path not in actual:
+                problems.append("%s is missing in git" % path)
+            elif path not in expected:
+                problems.append("%s is not in Mercurial" % path)
+            elif expected[path][0] != actual[path][0]:
+                problems.append("%s has mode %s instead of %s" % (
+                    path, actual[path][0], expected[path][0]))
+            elif expected[path][1] != actual[path][1]:
+                problems.append("%s differs" % path)
+        return problems, digests
+
+
+verifier = None
+
+
+def start_worker(*args):
+    global verifier
+    verifier = TreeVerifier(*args)
+
+
+def verify_commit(job):
+    '''Verify one (revision, commit) tuple in a worker process. Returns the
+    revision, commit, problems and computed digests.'''
+    revision, commit = job
+    problems, digests = verifier.verify(revision, commit)
+    return revision, commit, problems, digests
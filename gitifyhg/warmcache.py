@@ -0,0 +1,96 @@
+# Copyright 2012-2013 Dusty Phillips
+
+# This file is part of gitifyhg.
+
+# gitifyhg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gitifyhg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gitifyhg.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import threading
+
+from .util import log
+from .lfiles import CHUNK_SIZE
+
+from apiwrapper import hg_update_caches, hg_store_path
+
+
+class CacheWarmer(object):
+    '''Warms the caches listing and importing need after a pull added the
+    revisions from start on.
+
+    The branchmap, tags and revision branch caches are updated right away
+    and written to disk, so do_list finds them ready in this process and
+    every later one. Mercurial's repository objects are not thread safe,
+    so the changelog and manifest entries of the new revisions are
+    prefetched by reading their part of the revlog files into the OS page
+    cache in a background thread, while git reads the list output. The
+    import then finds them in memory instead of on disk.'''
+
+    def __init__(self, repo, start):
+        self.repo = repo
+        self.start = start
+        self.stopped = threading.Event()
+
+    def warm(self):
+        hg_update_caches(self.repo)
+        ranges = list(self.revlog_ranges())
+        if not ranges:
+            return
+        thread = threading.Thread(target=self.prefetch, args=(ranges,),
+            name='gitifyhg-prefetch')
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            self.stopped.set()
+            thread.join()
+        atexit.register(stop)
+
+    def revlog_ranges(self):
+        '''Yield a tuple of (path, offset) for the changelog and the
+        manifest, where offset is the position in the file at which the data
+        of the new revisions starts.'''
+        # Hidden revisions are in the files all the same
+        repo = self.repo.unfiltered()
+        for revlog in (repo.changelog, repo.manifest):
+            first = self.first_new_revision(revlog)
+            if first == len(revlog):
+                continue
+            if revlog._inline:
+                # Small enough to keep index and data in one file
+                path, offset = revlog.indexfile, 0
+            else:
+                path, offset = revlog.datafile, revlog.start(first)
+            log("Prefetching %s from revision %d" % (path, first))
+            yield hg_store_path(self.repo, path), offset
+
+    def first_new_revision(self, revlog):
+        '''Return the first revision of revlog that belongs to a changeset
+        from start on. Manifest revisions are numbered on their own, and a
+        pull adds them after the ones that were there, linked to the new
+        changesets.'''
+        rev = len(revlog)
+        while rev and revlog.linkrev(rev - 1) >= self.start:
+            rev -= 1
+        return rev
+
+    def prefetch(self, ranges):
+        for path, offset in ranges:
+            try:
+                with open(path, 'rb') as file:
+                    file.seek(offset)
+                    while not self.stopped.is_set():
+                        if not file.read(CHUNK_SIZE):
+                            break
+            except IOError as e:
+                log("Could not prefetch %s: %s" % (path, e), "WARNING")
@@ -32,6 +32,9 @@ setup(
     entry_points={
         'console_scripts': [
             'git-remote-gitifyhg = gitifyhg.gitifyhg:main',
+            'gitifyhg-replay = gitifyhg.harness:main',
+            'gitifyhg-mirror = gitifyhg.mirror:main',
+            'gitifyhg = gitifyhg.cli:main',
         ],
     },
     classifiers=[
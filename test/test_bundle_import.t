@@ -0,0 +1,106 @@
+#!/bin/sh
+
+test_description='Test gitifyhg rendering blobs during pull'
+
+. ./test-lib.sh
+
+make_branchy_repo() {
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    make_hg_commit c other_file &&
+    hg branch feature &&
+    make_hg_commit d test_file &&
+    hg update default &&
+    hg rm other_file &&
+    hg commit -m e --user="$HG_USER"
+}
+
+test_expect_success 'clone with blobs rendered during pull' '
+    test_when_finished "rm -rf hg_repo git_clone git_plain" &&
+
+    make_branchy_repo &&
+    cd .. &&
+    git clone "testgitifyhg::hg_repo" git_plain &&
+    git clone -c remote.origin.hgBundleImport=true "testgitifyhg::hg_repo" git_clone &&
+    test ! -f git_clone/.git/hg/*/blobs &&
+    test "`git -C git_clone rev-parse origin/master origin/branches/feature`" = \
+        "`git -C git_plain rev-parse origin/master origin/branches/feature`"
+'
+
+test_expect_success 'pull with blobs rendered during pull' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    cd .. &&
+    git clone -c remote.origin.hgBundleImport=true "testgitifyhg::hg_repo" git_clone &&
+    cd hg_repo &&
+    make_hg_commit b test_file &&
+    make_hg_commit c new_file &&
+    cd ../git_clone &&
+    git pull &&
+    assert_git_messages "c${NL}b${NL}a" &&
+    test "`cat new_file`" = "c" &&
+    (cd ../hg_repo && hg cat -r tip test_file) > expected &&
+    test_cmp expected test_file &&
+
+    cd ..
+'
+
+test_expect_success 'clone from a bundle file' '
+    test_when_finished "rm -rf hg_repo git_clone all.hg" &&
+
+    make_branchy_repo &&
+    hg bundle --all ../all.hg &&
+    cd .. &&
+    git clone -c remote.origin.hgBundleImport=true "testgitifyhg::all.hg" git_clone &&
+    cd git_clone &&
+    assert_git_messages "e${NL}c${NL}b${NL}a" &&
+    test ! -f other_file &&
+
+    cd ..
+'
+
+test_expect_success 'blobs rendered during pull honour hgExclude' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    mkdir docs &&
+    echo "do not export" > docs/secret &&
+    hg add docs/secret &&
+    hg commit -m secret --user="$HG_USER" &&
+    make_hg_commit b test_file &&
+    cd .. &&
+    git clone -c remote.origin.hgBundleImport=true \
+        -c remote.origin.hgExclude=docs "testgitifyhg::hg_repo" git_clone &&
+    cd git_clone &&
+    test ! -d docs &&
+    (cd ../hg_repo && hg cat -r tip test_file) > expected &&
+    test_cmp expected test_file &&
+    secret=`echo "do not export" | git hash-object --stdin` &&
+    test_must_fail git cat-file -e $secret &&
+
+    cd ..
+'
+
+test_expect_success 'blobs of changesets that are not imported get no marks' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    hg branch hidden &&
+    echo secret > secret_file &&
+    hg add secret_file &&
+    hg commit -m secret --user="$HG_USER" &&
+    hg update default &&
+    make_hg_commit b test_file &&
+    cd .. &&
+    git clone -c remote.origin.hgBundleImport=true \
+        -c remote.origin.hgBranchExclude=hidden "testgitifyhg::hg_repo" git_clone &&
+    cd git_clone &&
+    assert_git_messages "b${NL}a" &&
+    secret=`echo secret | git hash-object --stdin` &&
+    test_must_fail git cat-file -e $secret &&
+
+    cd ..
+'
+
+test_done
@@ -143,4 +143,23 @@ test_expect_success 'no implicit clone close branch' '
     cd ..
 '
 
-test_done
\ No newline at end of file
+test_expect_success 'clone reports progress and metrics' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    cd .. &&
+    git clone -c remote.origin.hgProgressInterval=0 \
+        -c remote.origin.hgMetricsLog=true \
+        "testgitifyhg::hg_repo" git_clone > output 2>&1 &&
+    grep "progress revision 1 .default. (2/2): 2 commits" output &&
+    cd git_clone &&
+    grep "\"phase\": \"pull\"" .git/hg/*/metrics.jsonl | grep -q "\"commits\": 2" &&
+    grep "\"phase\": \"import\"" .git/hg/*/metrics.jsonl | grep -q "\"commits\": 2" &&
+    grep -q "\"phase\": \"list\"" .git/hg/*/metrics.jsonl &&
+    rm ../output &&
+
+    cd ..
+'
+
+test_done
@@ -0,0 +1,77 @@
+#!/bin/sh
+
+test_description='Test the mapping between git commits and hg changesets'
+
+. ./test-lib.sh
+
+map() {
+    PYTHONPATH="$SHARNESS_BUILD_DIRECTORY" python -m gitifyhg.cli map "$@"
+}
+
+test_expect_success 'map fetched commits in both directions' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    hg_first=`hg log -r 0 --template "{node}"` &&
+    hg_tip=`hg log -r tip --template "{node}"` &&
+    clone_repo &&
+    git_first=`git rev-parse HEAD^` &&
+    git_tip=`git rev-parse HEAD` &&
+    test "`map $git_tip`" = "$git_tip $hg_tip" &&
+    test "`map --to-git $hg_first`" = "$hg_first $git_first" &&
+    short=`echo $hg_tip | cut -c1-12` &&
+    test "`map $short`" = "$short $git_tip" &&
+    test -f .git/hg/*/commit-map.db &&
+
+    printf "$git_first\n$hg_tip\n" | map > output &&
+    echo "$git_first $hg_first" > expected &&
+    echo "$hg_tip $git_tip" >> expected &&
+    test_cmp expected output &&
+
+    test_expect_code 1 map --to-hg $hg_tip > output &&
+    test "`cat output`" = "$hg_tip -" &&
+    rm expected output &&
+
+    cd ..
+'
+
+test_expect_success 'map pushed commits' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    clone_repo &&
+    make_git_commit b test_file &&
+    git push &&
+    git_tip=`git rev-parse HEAD` &&
+    hg_tip=`cd ../hg_repo && hg log -r tip --template "{node}"` &&
+    test "`map $git_tip`" = "$git_tip $hg_tip" &&
+    test "`map $hg_tip`" = "$hg_tip $git_tip" &&
+
+    cd ..
+'
+
+test_expect_success 'map changesets aliased by a later fetch' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    cd .. &&
+    git clone -c remote.origin.hgExclude=docs "testgitifyhg::hg_repo" git_clone &&
+    cd git_clone &&
+    git_first=`git rev-parse HEAD` &&
+    test "`map $git_first`" = "$git_first `cd ../hg_repo && hg log -r 0 --template "{node}"`" &&
+
+    cd ../hg_repo &&
+    make_hg_commit b docs &&
+    make_hg_commit c test_file &&
+    hg_b=`hg log -r 1 --template "{node}"` &&
+    hg_c=`hg log -r 2 --template "{node}"` &&
+    cd ../git_clone &&
+    git fetch &&
+    test "`map --to-git $hg_b`" = "$hg_b $git_first" &&
+    test "`map --to-git $hg_c`" = "$hg_c `git rev-parse origin/master`" &&
+
+    cd ..
+'
+
+test_done
@@ -0,0 +1,111 @@
+#!/bin/sh
+
+test_description='Test seeding discovery from the cached common heads'
+
+. ./test-lib.sh
+
+test_expect_success 'pull and push seed discovery from the cache' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    clone_repo &&
+    test -f .git/hg/*/discovery &&
+
+    cd ../hg_repo &&
+    make_hg_commit b test_file &&
+    hg_tip=`hg log -r tip --template "{node}"` &&
+    cd ../git_clone &&
+    git pull 2> error &&
+    grep -q "Seeded discovery" error &&
+    grep -q $hg_tip .git/hg/*/discovery &&
+
+    make_git_commit c test_file &&
+    git push 2> error &&
+    grep -q "Seeded discovery" error &&
+    cd ../hg_repo &&
+    assert_hg_messages "c${NL}b${NL}a" &&
+    hg_tip=`hg log -r tip --template "{node}"` &&
+    cd ../git_clone &&
+    grep -q $hg_tip .git/hg/*/discovery &&
+
+    cd ..
+'
+
+test_expect_success 'discovery falls back when the cached heads are stripped' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    hg branch feature &&
+    make_hg_commit b test_file &&
+    clone_repo &&
+    cd ../hg_repo &&
+    hg --config extensions.strip= strip --no-backup tip &&
+    hg update default &&
+    make_hg_commit c test_file &&
+    cd ../git_clone &&
+    git fetch 2> error &&
+    grep -q "Cached common heads are gone" error &&
+    test "`git log --format=%s origin/master`" = "c${NL}a" &&
+    hg_tip=`cd ../hg_repo && hg log -r tip --template "{node}"` &&
+    grep -q $hg_tip .git/hg/*/discovery &&
+
+    cd ..
+'
+
+test_expect_success 'push leaves hidden heads out of the cache' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    echo "[experimental]" >> .hg/hgrc &&
+    echo "evolution = all" >> .hg/hgrc &&
+    echo "[phases]" >> .hg/hgrc &&
+    echo "publish = False" >> .hg/hgrc &&
+    make_hg_commit b test_file &&
+    hg_b=`hg log -r tip --template "{node}"` &&
+    clone_repo &&
+    cd ../hg_repo &&
+    echo amended >> test_file &&
+    hg commit --amend --message="b amended" --user="$HG_USER" &&
+    hg --hidden --config extensions.strip= strip --no-backup -r "hidden()" &&
+    cd ../git_clone &&
+    git fetch &&
+    git reset --hard origin/master &&
+    make_git_commit c test_file &&
+    git push &&
+    ! grep -q $hg_b .git/hg/*/discovery &&
+    git fetch 2> error &&
+    grep -q "Seeded discovery" error &&
+    ! grep -q "Cached common heads are gone" error &&
+
+    cd ..
+'
+
+test_expect_success 'seeded discovery leaves out hidden changesets' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    echo "[experimental]" >> .hg/hgrc &&
+    echo "evolution = all" >> .hg/hgrc &&
+    echo "[phases]" >> .hg/hgrc &&
+    echo "publish = False" >> .hg/hgrc &&
+    make_hg_commit b test_file &&
+    clone_repo &&
+    cd ../hg_repo &&
+    echo amended >> test_file &&
+    hg commit --amend --message="b amended" --user="$HG_USER" &&
+    cd ../git_clone &&
+    git fetch &&
+    git reset --hard origin/master &&
+    # The remote shows b again, which stays hidden in the clone
+    rm ../hg_repo/.hg/store/obsstore &&
+    make_git_commit c test_file &&
+    git push 2> error &&
+    grep -q "Seeded discovery" error &&
+    ! grep -q Traceback error &&
+    cd ../hg_repo &&
+    test "`hg log -r "parents(tip)" --template "{desc}"`" = "b amended" &&
+
+    cd ..
+'
+
+test_done
@@ -0,0 +1,48 @@
+#!/bin/sh
+
+test_description='Test recording and replaying gitifyhg sessions'
+
+. ./test-lib.sh
+
+replay() {
+    PYTHONPATH="$SHARNESS_BUILD_DIRECTORY" python -m gitifyhg.harness "$@"
+}
+
+test_expect_success 'record and replay a clone' '
+    test_when_finished "rm -rf hg_repo git_clone sessions" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    cd .. &&
+    GITIFYHG_RECORD="$PWD/sessions" git clone "testgitifyhg::hg_repo" git_clone &&
+    session=`ls -d sessions/session-*` &&
+    test -f $session/session.json &&
+    grep "^import refs/heads/master" $session/input &&
+    grep "^commit refs/hg/origin" $session/output &&
+
+    cd hg_repo &&
+    make_hg_commit c test_file &&
+    cd .. &&
+    replay --json $session > report &&
+    grep "\"commits\": 2," report &&
+    grep "\"phase\": \"import\"" report &&
+    replay --sink null $session | grep "^commits: *2 " &&
+    rm report
+'
+
+test_expect_success 'replay a push without touching the clone' '
+    test_when_finished "rm -rf hg_repo git_clone sessions" &&
+
+    make_hg_repo &&
+    clone_repo &&
+    make_git_commit b test_file &&
+    GITIFYHG_RECORD="$PWD/../sessions" git push &&
+    cd .. &&
+    session=`ls -d sessions/session-*` &&
+    replay $session > report &&
+    grep "^export: .* 1 commits" report &&
+    test "`hg log -R git_clone/.git/hg/*/clone --template "{desc}\n"`" = "b${NL}a" &&
+    rm report
+'
+
+test_done
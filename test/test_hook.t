@@ -0,0 +1,83 @@
+#!/bin/sh
+
+test_description='Test updating git mirrors from Mercurial hooks'
+
+. ./test-lib.sh
+
+export PYTHONPATH="$SHARNESS_BUILD_DIRECTORY"
+
+make_hooked_repo() {
+    hg init hg_server &&
+    echo "[hooks]" >> hg_server/.hg/hgrc &&
+    echo "changegroup.gitifyhg = python:gitifyhg.hook.mirror" >> hg_server/.hg/hgrc &&
+    echo "pushkey.gitifyhg = python:gitifyhg.hook.mirror" >> hg_server/.hg/hgrc &&
+    echo "[gitifyhg]" >> hg_server/.hg/hgrc &&
+    echo "mirrors = ../mirror.git" >> hg_server/.hg/hgrc &&
+    echo "scheme = testgitifyhg" >> hg_server/.hg/hgrc &&
+    hg clone hg_server hg_work &&
+    cd hg_work
+}
+
+test_expect_success 'pushes update the mirror' '
+    test_when_finished "rm -rf hg_server hg_work mirror.git" &&
+
+    make_hooked_repo &&
+    make_hg_commit a test_file &&
+    hg push &&
+    test `git --git-dir=../mirror.git rev-list --count master` -eq 1 &&
+
+    make_hg_commit b test_file &&
+    hg bookmark feature &&
+    hg push -B feature &&
+    test `git --git-dir=../mirror.git rev-list --count master` -eq 2 &&
+    test "`git --git-dir=../mirror.git rev-parse feature`" = \
+        "`git --git-dir=../mirror.git rev-parse master`" &&
+
+    hg bookmark -d feature &&
+    test_expect_code 1 hg push -B feature &&
+    test_must_fail git --git-dir=../mirror.git rev-parse --verify feature &&
+    test_must_fail git --git-dir=../mirror.git rev-parse --verify \
+        refs/hg/origin/bookmarks/feature &&
+
+    cd ..
+'
+
+test_expect_success 'fetching the mirror after a push finds nothing new' '
+    test_when_finished "rm -rf hg_server hg_work mirror.git" &&
+
+    make_hooked_repo &&
+    make_hg_commit a test_file &&
+    hg push &&
+    make_hg_commit b test_file &&
+    hg tag --user="$HG_USER" v1 &&
+    hg push &&
+    cd .. &&
+    git --git-dir=mirror.git tag | grep v1 &&
+    test `git --git-dir=mirror.git rev-list --count master` -eq 3 &&
+    git --git-dir=mirror.git for-each-ref > before &&
+    git --git-dir=mirror.git fetch origin &&
+    git --git-dir=mirror.git for-each-ref > after &&
+    test_cmp before after &&
+    rm before after
+'
+
+test_expect_success 'concurrent updates set up a new mirror once' '
+    test_when_finished "rm -rf hg_repo mirror.git" &&
+
+    make_hg_repo &&
+    cd .. &&
+    for i in 1 2 3; do
+        python -c "
+from mercurial.ui import ui
+from gitifyhg.mirror import MirrorJob
+from gitifyhg.hook import update_mirror
+update_mirror(ui(), MirrorJob(u\"hg_repo\", \"mirror.git\"), \"testgitifyhg\", [])
+" &
+    done &&
+    wait &&
+    test `git --git-dir=mirror.git config --get-all remote.origin.url | wc -l` -eq 1 &&
+    test `git --git-dir=mirror.git config --get-all remote.origin.fetch | wc -l` -eq 2 &&
+    test `git --git-dir=mirror.git rev-list --count master` -eq 1
+'
+
+test_done
@@ -0,0 +1,124 @@
+#!/bin/sh
+
+test_description='Test gitifyhg with large files'
+
+. ./test-lib.sh
+
+LF="--config extensions.largefiles="
+
+make_lf_repo() {
+    hg init hg_repo &&
+    cd hg_repo &&
+    echo a > test_file &&
+    echo large > big_file &&
+    hg $LF add test_file &&
+    hg $LF add --large big_file &&
+    hg $LF commit --message="a" --user="$HG_USER"
+}
+
+test_expect_success 'clone largefiles repo' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_lf_repo &&
+    clone_repo &&
+    test "`cat big_file`" = "large" &&
+    test ! -d .hglf &&
+
+    cd ..
+'
+
+test_expect_success 'pull modified largefile' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_lf_repo &&
+    clone_repo &&
+    cd ../hg_repo &&
+    echo larger >> big_file &&
+    hg $LF commit -m "b" --user="$HG_USER" &&
+    cd ../git_clone &&
+    git pull &&
+    test "`cat big_file`" = "large${NL}larger" &&
+    test ! -d .hglf &&
+
+    cd ..
+'
+
+test_expect_success 'pull removed largefile' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_lf_repo &&
+    clone_repo &&
+    cd ../hg_repo &&
+    hg $LF rm big_file &&
+    hg $LF commit -m "b" --user="$HG_USER" &&
+    cd ../git_clone &&
+    git pull &&
+    test ! -f big_file &&
+
+    cd ..
+'
+
+test_expect_success 'push largefile' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_lf_repo &&
+    clone_repo &&
+    make_git_commit b big_file &&
+    git push &&
+
+    cd ../hg_repo &&
+    hg $LF update &&
+    test "`hg $LF cat -r tip .hglf/big_file`" = "`sha1sum big_file | cut -d\" \" -f1`" &&
+    test_cmp ../git_clone/big_file big_file &&
+
+    cd ..
+'
+
+test_expect_success 'push merge of a file that is a largefile on one branch' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_lf_repo &&
+    clone_repo &&
+    hgrc=`echo .git/hg/*/clone/.hg/hgrc` &&
+    printf "[largefiles]\nminsize = 0.001\n" >> $hgrc &&
+    git checkout -b branches/feature &&
+    make_git_commit feature merged_file &&
+    git push --set-upstream origin branches/feature &&
+    git checkout master &&
+    dd if=/dev/zero bs=1024 count=2 2>/dev/null | tr "\000" x > merged_file &&
+    git add merged_file &&
+    git commit -m large &&
+    make_git_commit larger big_file &&
+    git merge -X theirs -m Merge branches/feature &&
+    git push origin master &&
+
+    cd ../hg_repo &&
+    hg $LF verify &&
+    test "`hg $LF log --template "{desc}\n"`" = "Merge${NL}larger${NL}large${NL}feature${NL}a" &&
+    hg $LF update tip &&
+    test_cmp ../git_clone/merged_file merged_file &&
+    test_cmp ../git_clone/big_file big_file &&
+    test "`hg $LF cat -r tip .hglf/merged_file`" = "`sha1sum merged_file | cut -d\" \" -f1`" &&
+
+    cd ..
+'
+
+test_expect_success 'push blob larger than spool size' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    clone_repo &&
+    dd if=/dev/zero bs=1024 count=5000 2>/dev/null | tr "\000" x > huge_file &&
+    git add huge_file &&
+    git commit -m b &&
+    git push &&
+    test ! -d .git/hg/*/spool &&
+
+    cd ../hg_repo &&
+    hg update &&
+    test_cmp ../git_clone/huge_file huge_file &&
+
+    cd ..
+'
+
+test_done
@@ -0,0 +1,325 @@
+#!/bin/sh
+
+test_description='Test the marks files kept for each remote'
+
+. ./test-lib.sh
+
+map() {
+    PYTHONPATH="$SHARNESS_BUILD_DIRECTORY" python -m gitifyhg.cli map "$@"
+}
+
+# Print marks-hg with its keys sorted, so two versions can be compared
+dump_marks() {
+    python -c "import json, sys
+print json.dumps(json.load(open(sys.argv[1])), indent=0, sort_keys=True)" \
+        .git/hg/*/marks-hg
+}
+
+# Rewrite marks-hg the way the first versions of gitifyhg stored it, with
+# revision numbers instead of hashes and tips without the remote prefix
+downgrade_marks() {
+    hg log -R .git/hg/*/clone --template "{node} {rev}\n" > revs &&
+    python - .git/hg/*/marks-hg revs <<'EOF'
+import json, sys
+revs = dict(line.split() for line in open(sys.argv[2]))
+marks = json.load(open(sys.argv[1]))
+marks['revisions_to_marks'] = dict((revs[node], mark)
+    for node, mark in marks['revisions_to_marks'].items())
+marks['tips'] = dict((ref.split('/', 3)[3], tip)
+    for ref, tip in marks['tips'].items())
+del marks['marks-version']
+json.dump(marks, open(sys.argv[1], 'w'))
+EOF
+    rm revs
+}
+
+test_expect_success 'fetch and push as marks-git grows' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_cloned_repo &&
+    make_hg_commit b test_file &&
+    cd ../git_clone &&
+    git pull &&
+    make_git_commit c test_file &&
+    git push &&
+    test -f .git/hg/*/marks-git.idx &&
+    cd ../hg_repo &&
+    hg update &&
+    make_hg_commit d test_file &&
+    cd ../git_clone &&
+    git pull &&
+    test "`git log --pretty=format:%s`" = "d${NL}c${NL}b${NL}a" &&
+    make_git_commit e test_file &&
+    git push &&
+    cd ../hg_repo &&
+    assert_hg_messages "e${NL}d${NL}c${NL}b${NL}a" &&
+
+    cd ..
+'
+
+test_expect_success 'a corrupted marks-git index does not break fetch and push' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_cloned_repo &&
+    cd ../git_clone &&
+    make_git_commit b test_file &&
+    git push &&
+    printf XXXX | dd of=`echo .git/hg/*/marks-git.idx` conv=notrunc &&
+    make_git_commit c test_file &&
+    git push &&
+    cd ../hg_repo &&
+    assert_hg_messages "c${NL}b${NL}a" &&
+    hg update &&
+    make_hg_commit d test_file &&
+    cd ../git_clone &&
+    printf XXXX | dd of=`echo .git/hg/*/marks-git.idx` conv=notrunc &&
+    git pull &&
+    test "`git log --pretty=format:%s`" = "d${NL}c${NL}b${NL}a" &&
+
+    cd ..
+'
+
+test_expect_success 'a missing marks-git index does not break fetch and push' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_cloned_repo &&
+    cd ../git_clone &&
+    make_git_commit b test_file &&
+    git push &&
+    rm .git/hg/*/marks-git.idx &&
+    make_git_commit c test_file &&
+    git push &&
+    cd ../hg_repo &&
+    assert_hg_messages "c${NL}b${NL}a" &&
+
+    cd ..
+'
+
+test_expect_success 'push after a rejected push' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_cloned_repo &&
+    make_hg_commit b test_file &&
+    cd ../git_clone &&
+    make_git_commit c c_file &&
+    test_must_fail git push &&
+    git pull --no-rebase --no-edit &&
+    git push &&
+    cd ../hg_repo &&
+    assert_hg_count 4 &&
+    test "`hg log -r "p2(tip)" --template "{desc}"`" = "b" &&
+
+    cd ..
+'
+
+test_expect_success 'fetching appends to the marks-git index' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    clone_repo &&
+    map `git rev-parse HEAD` 2> error &&
+    grep "Rebuilding the index of marks-git" error &&
+    cd ../hg_repo &&
+    make_hg_commit b test_file &&
+    cd ../git_clone &&
+    git fetch &&
+    hg_tip=`cd ../hg_repo && hg log -r tip --template "{node}"` &&
+    test "`map --to-git $hg_tip 2> error`" = "$hg_tip `git rev-parse origin/master`" &&
+    grep "Appending 2 marks to the index of marks-git" error &&
+    ! grep "Rebuilding the index of marks-git" error &&
+
+    cd ..
+'
+
+test_expect_success 'a corrupted marks-git index is rebuilt' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    clone_repo &&
+    map `git rev-parse HEAD` &&
+    printf XXXX | dd of=`echo .git/hg/*/marks-git.idx` conv=notrunc &&
+    make_git_commit c test_file &&
+    git push 2> error &&
+    grep "Rebuilding the index of marks-git" error &&
+    hg_tip=`cd ../hg_repo && hg log -r tip --template "{node}"` &&
+    test "`map $hg_tip`" = "$hg_tip `git rev-parse HEAD`" &&
+    git_parent=`git rev-parse HEAD^` &&
+    test "`map $git_parent`" = "$git_parent `cd ../hg_repo && hg log -r 1 --template "{node}"`" &&
+
+    cd ..
+'
+
+test_expect_success 'a truncated marks-git index is rebuilt' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    make_hg_commit c test_file &&
+    clone_repo &&
+    hg_tip=`cd ../hg_repo && hg log -r tip --template "{node}"` &&
+    map `git rev-parse HEAD` &&
+    index=`echo .git/hg/*/marks-git.idx` &&
+    size=`wc -c < $index` &&
+    truncate -s $(($size - 44)) $index &&
+    test "`map --to-git $hg_tip 2> error`" = "$hg_tip `git rev-parse HEAD`" &&
+    grep "Rebuilding the index of marks-git" error &&
+
+    truncate -s 10 $index &&
+    test "`map --to-git $hg_tip 2> error`" = "$hg_tip `git rev-parse HEAD`" &&
+    grep "Rebuilding the index of marks-git" error &&
+
+    cd ..
+'
+
+test_expect_success 'the marks-git index is rebuilt when marks-git is rewritten' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    clone_repo &&
+    map `git rev-parse HEAD` &&
+    marks=`echo .git/hg/*/marks-git` &&
+    git_first=`git rev-parse HEAD^` &&
+    git_tip=`git rev-parse HEAD` &&
+    sed -e "s/$git_first/$git_tip/" $marks > marks &&
+    cat marks > $marks &&
+    rm marks &&
+    map `git rev-parse HEAD` 2> error &&
+    grep "Rebuilding the index of marks-git" error &&
+
+    cd ..
+'
+
+test_expect_success 'marks of a rejected push are removed from marks-git' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_cloned_repo &&
+    make_hg_commit b test_file &&
+    cd ../git_clone &&
+    make_git_commit c c_file &&
+    test_must_fail git push 2> error &&
+    grep "non-fast-forward" error &&
+    git ls-remote origin &&
+    marks=`echo .git/hg/*/marks-git` &&
+    git_tip=`git rev-parse HEAD` &&
+    ! grep $git_tip $marks &&
+    test_expect_code 1 map $git_tip 2> error &&
+    ! grep "Rebuilding the index of marks-git" error &&
+
+    # git may move the marks of the push into place after the helper
+    # removed them
+    echo ":9 $git_tip" >> $marks &&
+    git ls-remote origin 2> error &&
+    grep "Removing 1 marks of a rejected push from marks-git" error &&
+    ! grep $git_tip $marks &&
+    test_expect_code 1 map $git_tip 2> error &&
+    ! grep "Rebuilding the index of marks-git" error &&
+
+    git pull --no-rebase --no-edit &&
+    git push &&
+    git_tip=`git rev-parse HEAD` &&
+    test "`map $git_tip`" = "$git_tip `cd ../hg_repo && hg log -r tip --template "{node}"`" &&
+    cd ../hg_repo &&
+    assert_hg_count 4 &&
+    test "`hg log -r "p2(tip)" --template "{desc}"`" = "b" &&
+
+    cd ..
+'
+
+test_expect_success 'marks-hg in the first layout is upgraded' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    clone_repo &&
+    dump_marks > expected &&
+    git_tip=`git rev-parse HEAD` &&
+    downgrade_marks &&
+    ! grep "\"marks-version\"" .git/hg/*/marks-hg &&
+    test_expect_code 1 map $git_tip 2> error &&
+    grep "run git fetch origin to upgrade it" error &&
+
+    git fetch 2> error &&
+    grep "Upgrading marks-hg from hg sequence number to SHA1" error &&
+    grep "Upgrading marks-hg tips" error &&
+    dump_marks > actual &&
+    test_cmp expected actual &&
+    test "`git rev-parse origin/master`" = "$git_tip" &&
+
+    cd ../hg_repo &&
+    make_hg_commit c test_file &&
+    cd ../git_clone &&
+    git pull &&
+    assert_git_messages "c${NL}b${NL}a" &&
+    test "`git rev-parse HEAD^`" = "$git_tip" &&
+    make_git_commit d test_file &&
+    git push &&
+
+    cd ../hg_repo &&
+    assert_hg_messages "d${NL}c${NL}b${NL}a" &&
+
+    cd ..
+'
+
+test_expect_success 'aliases of filtered out changesets are kept' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    make_hg_commit b docs &&
+    cd .. &&
+    git clone -c remote.origin.hgExclude=docs "testgitifyhg::hg_repo" git_clone &&
+    cd git_clone &&
+    git config user.email $GIT_AUTHOR_EMAIL &&
+    git config user.name "$GIT_USER" &&
+    assert_git_messages "a" &&
+    git_first=`git rev-parse HEAD` &&
+
+    cd ../hg_repo &&
+    make_hg_commit c docs &&
+    hg_b=`hg log -r 1 --template "{node}"` &&
+    hg_c=`hg log -r 2 --template "{node}"` &&
+    cd ../git_clone &&
+    git pull &&
+    assert_git_messages "a" &&
+    test "`map --to-git $hg_b $hg_c`" = "$hg_b $git_first${NL}$hg_c $git_first" &&
+    test "`map --to-hg $git_first`" = "$git_first `cd ../hg_repo && hg log -r 0 --template "{node}"`" &&
+    dump_marks > expected &&
+    git fetch &&
+    dump_marks > actual &&
+    test_cmp expected actual &&
+
+    make_git_commit d test_file &&
+    git push &&
+    cd ../hg_repo &&
+    assert_hg_messages "d${NL}c${NL}b${NL}a" &&
+    test "`hg log -r "p1(tip)" --template "{node}"`" = "$hg_c" &&
+
+    cd ..
+'
+
+test_expect_success 'a rejected push leaves marks-hg as it was' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_cloned_repo &&
+    make_hg_commit b test_file &&
+    cd ../git_clone &&
+    dump_marks > expected &&
+    make_git_commit c c_file &&
+    make_git_commit d c_file &&
+    test_must_fail git push 2> error &&
+    ! grep Traceback error &&
+    dump_marks > actual &&
+    test_cmp expected actual &&
+
+    git pull --rebase &&
+    git push &&
+    git_tip=`git rev-parse HEAD` &&
+    test "`map $git_tip`" = "$git_tip `cd ../hg_repo && hg log -r tip --template "{node}"`" &&
+    cd ../hg_repo &&
+    assert_hg_messages "d${NL}c${NL}b${NL}a" &&
+
+    cd ..
+'
+
+test_done
@@ -0,0 +1,58 @@
+#!/bin/sh
+
+test_description='Test mirroring several repositories with gitifyhg-mirror'
+
+. ./test-lib.sh
+
+mirror() {
+    PYTHONPATH="$SHARNESS_BUILD_DIRECTORY" python -m gitifyhg.mirror \
+        --scheme testgitifyhg "$@"
+}
+
+make_mirrored_repos() {
+    hg init hg_one &&
+    (cd hg_one && make_hg_commit a test_file) &&
+    hg init hg_two &&
+    (cd hg_two && make_hg_commit a test_file && make_hg_commit b test_file) &&
+    echo "# mirrors" > mirrors &&
+    echo "hg_one one.git" >> mirrors &&
+    echo "hg_two two.git" >> mirrors
+}
+
+test_expect_success 'mirror new repositories' '
+    test_when_finished "rm -rf hg_one hg_two one.git two.git mirrors summary" &&
+
+    make_mirrored_repos &&
+    mirror --jobs 2 --summary summary mirrors > output &&
+    grep "^ok .* 1 imported .*hg_one$" output &&
+    grep "^ok .* 2 imported .*hg_two$" output &&
+    grep "2 mirrored, 0 failed" output &&
+    grep "\"ok\": 2," summary &&
+    test `git --git-dir=one.git rev-list --count master` -eq 1 &&
+    test `git --git-dir=two.git rev-list --count master` -eq 2 &&
+
+    cd hg_one &&
+    make_hg_commit b test_file &&
+    hg tag --user="$HG_USER" v1 &&
+    cd .. &&
+    mirror --order size mirrors > output &&
+    grep "^ok .* 2 imported .*hg_one$" output &&
+    grep "^ok .* 0 imported .*hg_two$" output &&
+    test `git --git-dir=one.git rev-list --count master` -eq 3 &&
+    git --git-dir=one.git tag | grep v1 &&
+    rm output
+'
+
+test_expect_success 'mirror reports failed repositories' '
+    test_when_finished "rm -rf hg_one hg_two one.git two.git mirrors output" &&
+
+    make_mirrored_repos &&
+    echo "hg_missing missing.git" >> mirrors &&
+    test_expect_code 1 mirror mirrors > output &&
+    grep "^failed .*hg_missing$" output &&
+    grep "^    abort: repository .*hg_missing not found" output &&
+    grep "2 mirrored, 1 failed" output &&
+    git --git-dir=one.git rev-parse master
+'
+
+test_done
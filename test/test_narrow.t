@@ -0,0 +1,92 @@
+#!/bin/sh
+
+test_description='Test gitifyhg path filters'
+
+. ./test-lib.sh
+
+make_tree_repo() {
+    hg init hg_repo &&
+    cd hg_repo &&
+    mkdir src docs &&
+    echo a > test_file &&
+    echo a > src/code &&
+    hg add test_file src/code &&
+    hg commit --message="a" --user="$HG_USER" &&
+    make_hg_commit b docs/doc &&
+    make_hg_commit c src/code
+}
+
+narrow_clone() {
+    cd .. &&
+    git clone -c remote.origin.hgInclude=src "testgitifyhg::hg_repo" git_clone &&
+    cd git_clone &&
+    git config user.email $GIT_AUTHOR_EMAIL &&
+    git config user.name "$GIT_USER"
+}
+
+test_expect_success 'clone with include filter' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_tree_repo &&
+    narrow_clone &&
+    test -f src/code &&
+    test ! -f test_file &&
+    test ! -d docs &&
+    assert_git_messages "c${NL}a" &&
+
+    cd ..
+'
+
+test_expect_success 'push to filtered clone keeps hidden files' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_tree_repo &&
+    narrow_clone &&
+    cd ../hg_repo &&
+    make_hg_commit d docs/doc &&
+    cd ../git_clone &&
+    git pull &&
+    assert_git_messages "c${NL}a" &&
+    make_git_commit e src/code &&
+    git push &&
+
+    cd ../hg_repo &&
+    assert_hg_messages "e${NL}d${NL}c${NL}b${NL}a" &&
+    hg update &&
+    test -f test_file &&
+    test "`cat docs/doc`" = "b${NL}d" &&
+    test_cmp ../git_clone/src/code src/code &&
+
+    cd ..
+'
+
+test_expect_success 'push outside of filter fails' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_tree_repo &&
+    narrow_clone &&
+    make_git_commit e outside &&
+    test_expect_code 1 git push &&
+
+    cd ../hg_repo &&
+    assert_hg_messages "c${NL}b${NL}a" &&
+
+    cd ..
+'
+
+test_expect_success 'exclude filter' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_tree_repo &&
+    cd .. &&
+    git clone -c remote.origin.hgExclude=docs "testgitifyhg::hg_repo" git_clone &&
+    cd git_clone &&
+    test -f src/code &&
+    test -f test_file &&
+    test ! -d docs &&
+    assert_git_messages "c${NL}a" &&
+
+    cd ..
+'
+
+test_done
@@ -0,0 +1,100 @@
+#!/bin/sh
+
+test_description='Test prefetching commits ahead of git fetch'
+
+. ./test-lib.sh
+
+prefetch() {
+    PYTHONPATH="$SHARNESS_BUILD_DIRECTORY" python -m gitifyhg.cli prefetch "$@"
+}
+
+test_expect_success 'fetch sends prefetched commits' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_cloned_repo &&
+    make_hg_commit b test_file &&
+    hg branch feature &&
+    make_hg_commit c feature_file &&
+    cd ../git_clone &&
+    git config remote.origin.hgProgressInterval 0 &&
+    prefetch > output &&
+    grep "prefetched 2 commits of 2 refs" output &&
+    test -f .git/hg/*/prefetch.json &&
+    gzip -dc .git/hg/*/prefetch-*.gz > segment &&
+    test `grep -c "^commit refs/hg/origin/" segment` -eq 2 &&
+    ! grep "^progress" segment &&
+
+    cd ../hg_repo &&
+    hg update default &&
+    make_hg_commit d test_file &&
+    cd ../git_clone &&
+    prefetch > output &&
+    grep "prefetched 3 commits" output &&
+
+    cd ../hg_repo &&
+    make_hg_commit e test_file &&
+    hgsha1s=`hg log -b default --template "{node}\n"` &&
+    cd ../git_clone &&
+    git pull 2> error &&
+    grep -q "Replayed 3 prefetched commits" error &&
+    test ! -f .git/hg/*/prefetch.json &&
+    assert_git_messages "e${NL}d${NL}b${NL}a" &&
+    test "`git log --format=%s origin/branches/feature`" = "c${NL}b${NL}a" &&
+    assert_git_notes "$hgsha1s" &&
+
+    cd ..
+'
+
+test_expect_success 'fetch renders stale prefetched commits again' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_cloned_repo &&
+    make_hg_commit b test_file &&
+    cd ../git_clone &&
+    prefetch &&
+    PYTHONPATH="$SHARNESS_BUILD_DIRECTORY" python -c "
+import json, sys
+path = sys.argv[1]
+index = json.load(open(path))
+index[\"base-mark\"] += 1
+json.dump(index, open(path, \"w\"))
+" .git/hg/*/prefetch.json &&
+    git pull 2> error &&
+    grep -q "Prefetched commits are stale" error &&
+    test ! -f .git/hg/*/prefetch.json &&
+    assert_git_messages "b${NL}a" &&
+
+    cd ..
+'
+
+test_expect_success 'fetch leaves the commits of a running prefetch alone' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_cloned_repo &&
+    make_hg_commit b test_file &&
+    cd ../git_clone &&
+    prefetch &&
+    python -c "
+import fcntl, subprocess, sys
+lock = open(sys.argv[1], \"w\")
+fcntl.flock(lock, fcntl.LOCK_EX)
+sys.exit(subprocess.call([\"git\", \"pull\"]))
+" `echo .git/hg/*/prefetch.lock` 2> error &&
+    grep -q "Skipping the prefetched commits, a prefetch is running" error &&
+    ! grep -q "Replayed" error &&
+    test -f .git/hg/*/prefetch.json &&
+    assert_git_messages "b${NL}a" &&
+
+    cd ../hg_repo &&
+    make_hg_commit c test_file &&
+    cd ../git_clone &&
+    git pull 2> error &&
+    grep -q "Prefetched commits are stale" error &&
+    test ! -f .git/hg/*/prefetch.json &&
+    test ! -f .git/hg/*/prefetch-*.gz &&
+    assert_git_messages "c${NL}b${NL}a" &&
+
+    cd ..
+'
+
+test_done
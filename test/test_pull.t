@@ -116,4 +116,128 @@ test_expect_success 'pull tags' '
     cd ..
 '
 
+test_expect_success 'pull new refs pointing at imported commits' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_cloned_repo &&
+    make_hg_commit b test_file &&
+    cd ../git_clone &&
+    git pull &&
+    first=`git rev-parse HEAD^` &&
+    cd ../hg_repo &&
+    hg bookmark -r 0 old_bookmark &&
+    hg tag --user="$HG_USER" -r 0 old_tag &&
+    hg update 0 &&
+    hg branch side &&
+    make_hg_commit c test_file &&
+    cd ../git_clone &&
+    git fetch &&
+    test "`git rev-parse origin/old_bookmark`" = "$first" &&
+    test "`git rev-parse old_tag^{commit}`" = "$first" &&
+    test "`git rev-parse origin/branches/side^`" = "$first" &&
+    test "`git rev-parse origin/master^^`" = "$first" &&
+    test `git rev-list --remotes --count` -eq 4 &&
+
+    cd ..
+'
+
+test_expect_success 'pull updates the caches of the clone' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_cloned_repo &&
+    hg branch feature &&
+    make_hg_commit b test_file &&
+    hg tag --user="$HG_USER" tag1 &&
+    tip=`hg log -r tip --template "{node}"` &&
+    cd ../git_clone &&
+    git fetch &&
+    git branch -r | grep branches/feature &&
+    git tag | grep tag1 &&
+    grep -q "^$tip" .git/hg/*/clone/.hg/cache/branch2-served &&
+    test -f .git/hg/*/clone/.hg/cache/tags2-visible &&
+    test -f .git/hg/*/clone/.hg/cache/rbc-revs-v1 &&
+
+    cd ..
+'
+
+test_expect_success 'pull prefetches the new manifest revisions' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    hg branch feature &&
+    hg commit -m "open feature" --user="$HG_USER" &&
+    clone_repo &&
+    cd ../hg_repo &&
+    make_hg_commit b test_file &&
+    cd ../git_clone &&
+    git fetch 2> error &&
+    grep "Prefetching 00changelog.i from revision 2" error &&
+    grep "Prefetching 00manifest.i from revision 1" error &&
+
+    cd ..
+'
+
+test_expect_success 'clone leaves the caches of a new clone alone' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    hg branch feature &&
+    make_hg_commit b test_file &&
+    cd .. &&
+    git clone "testgitifyhg::hg_repo" git_clone 2> error &&
+    ! grep "Prefetching" error &&
+    cd git_clone &&
+    git branch -r | grep branches/feature &&
+
+    cd ..
+'
+
+test_expect_success 'pull leaves out obsolete changesets' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    echo "[experimental]" >> .hg/hgrc &&
+    echo "evolution = all" >> .hg/hgrc &&
+    echo "[phases]" >> .hg/hgrc &&
+    echo "publish = False" >> .hg/hgrc &&
+    make_hg_commit b test_file &&
+    clone_repo &&
+    cd ../hg_repo &&
+    echo amended >> test_file &&
+    hg commit --amend --message="b amended" --user="$HG_USER" &&
+    cd ../git_clone &&
+    git fetch 2> error &&
+    ! grep "more than one head" error &&
+    test "`git log --format=%s origin/master`" = "b amended${NL}a" &&
+    hg -R .git/hg/*/clone log --hidden -r "obsolete()" --template "{desc}\n" > obsolete &&
+    grep -x b obsolete &&
+
+    git config remote.origin.hgRepoView served &&
+    git fetch &&
+    git config remote.origin.hgRepoView all &&
+    test_must_fail git fetch &&
+
+    cd ..
+'
+
+test_expect_success 'pull reads the remote configuration once' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    mkdir docs &&
+    make_hg_commit b docs/doc &&
+    cd .. &&
+    git clone -c remote.origin.HGEXCLUDE=docs "testgitifyhg::hg_repo" git_clone &&
+    cd git_clone &&
+    test ! -d docs &&
+    cd ../hg_repo &&
+    make_hg_commit c test_file &&
+    cd ../git_clone &&
+    GIT_TRACE=1 git fetch 2> error &&
+    test "`grep -c "built-in: git config" error`" -eq 1 &&
+    test "`git log --format=%s origin/master`" = "c${NL}a" &&
+
+    cd ..
+'
+
 test_done
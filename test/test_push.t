@@ -75,6 +75,25 @@ test_expect_success 'push conflict default' '
     test_expect_code 1 git push &&
     # test it again because we were having issues with it succeeding the second time
     test_expect_code 1 git push &&
+    # the failed exports must have been rolled back in the local clone
+    test "`hg log -R .git/hg/*/clone --template=\"{desc}\n\"`" = "b${NL}a" &&
+
+    cd ..
+'
+
+test_expect_success 'push commits the export before pushing it' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    clone_repo &&
+    clone=`cd .git/hg/*/clone && pwd` &&
+    echo "[hooks]" >> ../hg_repo/.hg/hgrc &&
+    echo "pretxnchangegroup = test ! -e \"$clone/.hg/store/journal\"" >> ../hg_repo/.hg/hgrc &&
+    make_git_commit b test_file &&
+    git push &&
+
+    cd ../hg_repo &&
+    assert_hg_messages "b${NL}a" &&
 
     cd ..
 '
@@ -296,4 +315,214 @@ test_expect_success 'handle paths with quotes' '
     cd ..
 '
 
+test_expect_success 'push large commits with several threads' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+    make_hg_repo &&
+    clone_repo &&
+    git config remote.origin.hgExportThreads 4 &&
+    for i in `seq 100`; do seq $i > file_$i; done &&
+    git add . &&
+    git commit -m "add files" &&
+    for i in `seq 100`; do echo changed >> file_$i; done &&
+    git commit -a -m "change files" &&
+    git push &&
+
+    cd ../hg_repo &&
+    assert_hg_messages "change files${NL}add files${NL}a" &&
+    hg verify &&
+    hg update &&
+    for i in `seq 100`; do test_cmp ../git_clone/file_$i file_$i || return 1; done &&
+
+    cd ..
+'
+
+test_expect_success 'push merge of a previously pushed named branch' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+    make_hg_repo &&
+    clone_repo &&
+    git checkout -b branches/feature &&
+    make_git_commit feature feature_file &&
+    git push --set-upstream origin branches/feature &&
+    git checkout master &&
+    make_git_commit b test_file &&
+    git merge -m Merge branches/feature &&
+    git push origin master &&
+    grep -q " feature_file\$" .git/hg/*/blob-index &&
+
+    cd ../hg_repo &&
+    hg verify &&
+    test "`hg log -r "p2(tip)" --template "{desc}"`" = "feature" &&
+    test "`hg manifest --debug -r tip | grep feature_file`" = \
+        "`hg manifest --debug -r "p2(tip)" | grep feature_file`" &&
+
+    cd ..
+'
+
+test_expect_success 'push merge that takes a file from a diverged branch' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+    make_hg_repo &&
+    clone_repo &&
+    git checkout -b branches/feature &&
+    make_git_commit feature test_file &&
+    git push --set-upstream origin branches/feature &&
+    git checkout master &&
+    make_git_commit b test_file &&
+    git merge -X theirs -m Merge branches/feature &&
+    git push origin master &&
+
+    cd ../hg_repo &&
+    hg verify &&
+    test "`hg cat -r tip test_file`" = "`hg cat -r "p2(tip)" test_file`" &&
+    hg update tip &&
+    hg log -f --template "{desc}\n" test_file > actual &&
+    echo "Merge${NL}b${NL}feature${NL}a" > expected &&
+    test_cmp expected actual &&
+
+    cd ..
+'
+
+test_expect_success 'push revert of a pushed file' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+    make_hg_repo &&
+    clone_repo &&
+    make_git_commit b test_file &&
+    git push &&
+    git revert --no-edit HEAD &&
+    git push &&
+
+    cd ../hg_repo &&
+    hg verify &&
+    test "`hg cat -r tip test_file`" = "`hg cat -r 0 test_file`" &&
+    test "`hg log -r tip --template "{files}"`" = "test_file" &&
+    hg update tip &&
+    hg log -f --template "{desc|firstline}\n" test_file > actual &&
+    echo "Revert \"b\"${NL}b${NL}a" > expected &&
+    test_cmp expected actual &&
+
+    cd ..
+'
+
+test_expect_success 'push merge of branches that changed many files' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+    make_hg_repo &&
+    clone_repo &&
+    for i in `seq 20`; do echo $i > file_$i; done &&
+    git add . &&
+    git commit -m "add files" &&
+    git push &&
+    git checkout -b branches/feature &&
+    for i in `seq 11 20`; do echo feature >> file_$i; done &&
+    git commit -a -m "change feature files" &&
+    git push --set-upstream origin branches/feature &&
+    git checkout master &&
+    for i in `seq 10`; do echo master >> file_$i; done &&
+    git commit -a -m "change master files" &&
+    git merge -m Merge branches/feature &&
+    git push origin master &&
+
+    cd ../hg_repo &&
+    hg verify &&
+    assert_hg_messages "Merge${NL}change master files${NL}change feature files${NL}add files${NL}a" &&
+    hg update tip &&
+    for i in `seq 20`; do test_cmp ../git_clone/file_$i file_$i || return 1; done &&
+
+    cd ..
+'
+
+test_expect_success 'push mode change of a previously pushed blob' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+    make_hg_repo &&
+    clone_repo &&
+    make_git_commit b test_file &&
+    git push &&
+    chmod +x test_file &&
+    git commit -a -m "make executable" &&
+    git push &&
+
+    cd ../hg_repo &&
+    hg update &&
+    test -x test_file &&
+    test_cmp ../git_clone/test_file test_file &&
+
+    cd ..
+'
+
+test_expect_success 'push within a memory budget' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+    make_hg_repo &&
+    clone_repo &&
+    git config remote.origin.hgMemoryBudget 1m &&
+    git config remote.origin.hgMetricsLog true &&
+    seq 100000 > big_file &&
+    for i in `seq 10`; do seq $i > file_$i; done &&
+    git add . &&
+    git commit -m "add files" &&
+    echo changed >> big_file &&
+    git commit -a -m "change big file" &&
+    git push &&
+    grep "\"phase\": \"export\"" .git/hg/*/metrics.jsonl > export &&
+    grep -q "\"peak_rss\": [1-9]" export &&
+    grep -q "\"evictions\": [12][,}]" export &&
+    test ! -d .git/hg/*/spool &&
+
+    cd ../hg_repo &&
+    assert_hg_messages "change big file${NL}add files${NL}a" &&
+    hg verify &&
+    hg update &&
+    test_cmp ../git_clone/big_file big_file &&
+    for i in `seq 10`; do test_cmp ../git_clone/file_$i file_$i || return 1; done &&
+
+    cd ..
+'
+
+test_expect_success 'push on top of an obsolete changeset' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    echo "[experimental]" >> .hg/hgrc &&
+    echo "evolution = all" >> .hg/hgrc &&
+    echo "[phases]" >> .hg/hgrc &&
+    echo "publish = False" >> .hg/hgrc &&
+    make_hg_commit b test_file &&
+    clone_repo &&
+    cd ../hg_repo &&
+    echo amended >> test_file &&
+    hg commit --amend --message="b amended" --user="$HG_USER" &&
+    cd ../git_clone &&
+    make_git_commit c test_file &&
+    test_must_fail git push 2> error &&
+    grep "is obsolete or hidden in Mercurial" error &&
+    ! grep Traceback error &&
+    test "`cd ../hg_repo && hg log --template "{desc}\n"`" = "b amended${NL}a" &&
+
+    cd ..
+'
+
+test_expect_success 'push leaves obsolescence markers out' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    echo "[experimental]" >> .hg/hgrc &&
+    echo "evolution = all" >> .hg/hgrc &&
+    echo "[phases]" >> .hg/hgrc &&
+    echo "publish = False" >> .hg/hgrc &&
+    make_hg_commit b test_file &&
+    clone_repo &&
+    cd ../hg_repo &&
+    echo amended >> test_file &&
+    hg commit --amend --message="b amended" --user="$HG_USER" &&
+    cd ../git_clone &&
+    git fetch &&
+    git reset --hard origin/master &&
+    test -s .git/hg/*/clone/.hg/store/obsstore &&
+    rm ../hg_repo/.hg/store/obsstore &&
+    make_git_commit c test_file &&
+    git push &&
+    test ! -e ../hg_repo/.hg/store/obsstore &&
+    cd ../hg_repo &&
+    test "`hg log -r "parents(tip)" --template "{desc}"`" = "b amended" &&
+
+    cd ..
+'
+
 test_done
@@ -49,6 +49,26 @@ test_expect_success 'lightweight tag sets hg username' '
     cd ..
 '
 
+test_expect_success 'push several tags in one commit' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    clone_repo &&
+    make_git_commit b test_file &&
+    git tag second_tag &&
+    git tag first_tag HEAD^ &&
+    git push origin HEAD --tags &&
+
+    cd ../hg_repo &&
+    hg tags | grep first_tag &&
+    hg tags | grep second_tag &&
+    assert_hg_count 3 &&
+    test "`hg cat -r tip .hgtags | grep -c _tag`" -eq 2 &&
+    assert_hg_messages "Added tag first_tag for changeset $(hg id --id -r 0)${NL}Added tag second_tag for changeset $(hg id --id -r 1)" tip &&
+
+    cd ..
+'
+
 test_expect_success 'push tag with subsequent commits' '
     test_when_finished "rm -rf hg_repo git_clone" &&
 
@@ -0,0 +1,75 @@
+#!/bin/sh
+
+test_description='Test gitifyhg ref filters'
+
+. ./test-lib.sh
+
+make_tagged_repo() {
+    make_hg_repo &&
+    hg tag --user="$HG_USER" old_1 &&
+    hg tag --user="$HG_USER" old_2 &&
+    hg tag --user="$HG_USER" v1
+}
+
+test_expect_success 'clone with tag exclude pattern' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_tagged_repo &&
+    cd .. &&
+    git clone -c remote.origin.hgTagExclude="old_*" "testgitifyhg::hg_repo" git_clone &&
+    cd git_clone &&
+    test "`git tag`" = "v1" &&
+
+    cd ..
+'
+
+test_expect_success 'clone with branch and bookmark include patterns' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    hg branch feature_a &&
+    make_hg_commit b test_file &&
+    hg update default &&
+    hg branch other &&
+    make_hg_commit c test_file &&
+    hg bookmark keep_me &&
+    hg bookmark drop_me &&
+    hg update default &&
+    cd .. &&
+    git clone -c remote.origin.hgBranchInclude="feature_*" \
+        -c remote.origin.hgBookmarkInclude="keep_*" \
+        "testgitifyhg::hg_repo" git_clone &&
+    cd git_clone &&
+    git branch -r > branches &&
+    grep -q "origin/master" branches &&
+    grep -q "origin/branches/feature_a" branches &&
+    grep -q "origin/keep_me" branches &&
+    test_must_fail grep -q "other" branches &&
+    test_must_fail grep -q "drop_me" branches &&
+
+    cd ..
+'
+
+test_expect_success 'fetch with tag age cutoff' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    echo b >> test_file &&
+    hg commit --message="b" --user="$HG_USER" --date="2000-01-01 00:00" &&
+    hg tag --user="$HG_USER" --rev 1 ancient &&
+    cd .. &&
+    git clone -c remote.origin.hgTagMaxAge=30 "testgitifyhg::hg_repo" git_clone &&
+    cd git_clone &&
+    test -z "`git tag`" &&
+    test -f .git/hg/*/ref-dates &&
+
+    cd ../hg_repo &&
+    hg tag --user="$HG_USER" recent &&
+    cd ../git_clone &&
+    git fetch &&
+    test "`git tag`" = "recent" &&
+
+    cd ..
+'
+
+test_done
@@ -0,0 +1,59 @@
+#!/bin/sh
+
+test_description='Test gitifyhg stream cache'
+
+. ./test-lib.sh
+
+cache_clone() {
+    git clone -c remote.origin.hgStreamCache="$PWD/cache" "testgitifyhg::hg_repo" $1
+}
+
+count_segments() {
+    ls cache/*/segment-*.gz | wc -l
+}
+
+test_expect_success 'fresh clones reuse the stream cache' '
+    test_when_finished "rm -rf hg_repo git_clone git_clone2 git_clone3 cache" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    hg branch feature &&
+    make_hg_commit c test_file &&
+    cd .. &&
+
+    cache_clone git_clone &&
+    test `count_segments` -eq 1 &&
+
+    cache_clone git_clone2 &&
+    test `count_segments` -eq 1 &&
+    test "`git -C git_clone rev-parse origin/master origin/branches/feature`" = \
+        "`git -C git_clone2 rev-parse origin/master origin/branches/feature`" &&
+
+    cd hg_repo &&
+    hg update default &&
+    make_hg_commit d test_file &&
+    cd .. &&
+    cache_clone git_clone3 &&
+    test `count_segments` -eq 2 &&
+    cd git_clone3 &&
+    assert_git_messages "d${NL}b${NL}a" &&
+    cd .. &&
+    test "`git -C git_clone rev-parse origin/branches/feature`" = \
+        "`git -C git_clone3 rev-parse origin/branches/feature`"
+'
+
+test_expect_success 'stream cache with notes' '
+    test_when_finished "rm -rf hg_repo git_clone git_clone2 cache" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    cd .. &&
+    cache_clone git_clone &&
+    cache_clone git_clone2 &&
+    cd git_clone2 &&
+    assert_git_notes "`cd ../hg_repo && hg log --template={node}\\\\n`" &&
+
+    cd ..
+'
+
+test_done
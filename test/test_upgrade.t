@@ -0,0 +1,111 @@
+#!/bin/sh
+
+test_description='Test upgrading the store format of the local clone'
+
+. ./test-lib.sh
+
+upgrade() {
+    PYTHONPATH="$SHARNESS_BUILD_DIRECTORY" python -m gitifyhg.cli upgrade "$@"
+}
+
+test_expect_success 'new clones use generaldelta' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    clone_repo &&
+    grep -x generaldelta .git/hg/*/clone/.hg/requires &&
+    upgrade > output &&
+    grep "uses the fastest store format" output &&
+    grep "^before: " output &&
+    test_must_fail grep "^after: " output &&
+
+    cd ..
+'
+
+test_expect_success 'upgrade an old clone in place' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    hg bookmark feature &&
+    make_hg_commit c test_file &&
+    clone_repo &&
+    clone=`echo .git/hg/*/clone` &&
+    hg --config format.usegeneraldelta=false clone -U --pull $clone old &&
+    rm -rf $clone &&
+    mv old $clone &&
+    test_must_fail grep -x generaldelta $clone/.hg/requires &&
+
+    upgrade --check > output &&
+    grep "does not use the generaldelta store format" output &&
+    test_must_fail grep -x generaldelta $clone/.hg/requires &&
+
+    upgrade > output &&
+    grep "Upgraded the clone to generaldelta" output &&
+    grep "^after: " output &&
+    grep -x generaldelta $clone/.hg/requires &&
+    hg -R $clone verify &&
+    test "`hg -R $clone bookmarks -T "{bookmark} {rev}\n"`" = "feature 2" &&
+    test ! -d $clone/.hg/upgrade &&
+    test ! -d $clone/.hg/store.old &&
+
+    cd ../hg_repo &&
+    make_hg_commit d test_file &&
+    cd ../git_clone &&
+    git pull &&
+    test_cmp ../hg_repo/test_file test_file &&
+    test "`git log --pretty=%s -1`" = "d" &&
+
+    cd ..
+'
+
+test_expect_success 'an upgrade interrupted while swapping stores is recovered' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    clone_repo &&
+    clone=`echo .git/hg/*/clone` &&
+    hg --config format.usegeneraldelta=false clone -U --pull $clone old &&
+    rm -rf $clone &&
+    mv old $clone &&
+    hg clone -U --pull $clone new &&
+    grep -x generaldelta new/.hg/requires &&
+
+    # Interrupted after moving the old store away
+    mv $clone/.hg/store $clone/.hg/store.old &&
+    cp new/.hg/requires $clone/.hg/requires.upgrade &&
+    cd ../hg_repo &&
+    make_hg_commit c test_file &&
+    cd ../git_clone &&
+    git pull 2> error &&
+    grep "Restoring the store of an interrupted upgrade" error &&
+    test "`git log --pretty=%s -1`" = "c" &&
+    test ! -d $clone/.hg/store.old &&
+    test ! -f $clone/.hg/requires.upgrade &&
+    test_must_fail grep -x generaldelta $clone/.hg/requires &&
+    hg -R $clone verify &&
+
+    # Interrupted after moving the new store into place
+    rm -rf new &&
+    hg clone -U --pull $clone new &&
+    mv $clone/.hg/store $clone/.hg/store.old &&
+    mv new/.hg/store $clone/.hg/store &&
+    cp new/.hg/requires $clone/.hg/requires.upgrade &&
+    upgrade --check > output 2> error &&
+    grep "Completing an interrupted upgrade" error &&
+    grep "uses the fastest store format" output &&
+    grep -x generaldelta $clone/.hg/requires &&
+    test ! -d $clone/.hg/store.old &&
+    test ! -f $clone/.hg/requires.upgrade &&
+    hg -R $clone verify &&
+    cd ../hg_repo &&
+    make_hg_commit d test_file &&
+    cd ../git_clone &&
+    git pull &&
+    test "`git log --pretty=%s -1`" = "d" &&
+
+    cd ..
+'
+
+test_done
@@ -0,0 +1,94 @@
+#!/bin/sh
+
+test_description='Test verifying git commits against hg changesets'
+
+. ./test-lib.sh
+
+verify() {
+    PYTHONPATH="$SHARNESS_BUILD_DIRECTORY" python -m gitifyhg.cli verify "$@"
+}
+
+test_expect_success 'verify only new commits' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    echo c > script &&
+    chmod +x script &&
+    hg add script &&
+    hg commit -m "add script" &&
+    clone_repo &&
+    verify > output &&
+    test "`tail -n 1 output`" = "3 verified, 0 failed, 0 verified before" &&
+    test -f .git/hg/*/verify.db &&
+
+    cd ../hg_repo &&
+    make_hg_commit d test_file &&
+    cd ../git_clone &&
+    git pull &&
+    verify -j 1 > output &&
+    test "`tail -n 1 output`" = "1 verified, 0 failed, 3 verified before" &&
+    verify --force --rev "tip" > output &&
+    test "`tail -n 1 output`" = "1 verified, 0 failed, 0 verified before" &&
+
+    cd ..
+'
+
+test_expect_success 'verify reports commits that differ' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    make_hg_commit b test_file &&
+    clone_repo &&
+    first=`git rev-parse HEAD^` &&
+    tip=`git rev-parse HEAD` &&
+    sed -i "s/$tip/$first/" .git/hg/*/marks-git &&
+    test_expect_code 1 verify > output &&
+    grep "$first: test_file differs" output &&
+    test "`tail -n 1 output`" = "1 verified, 1 failed, 0 verified before" &&
+    test_expect_code 1 verify > output &&
+    test "`tail -n 1 output`" = "0 verified, 1 failed, 1 verified before" &&
+
+    cd ..
+'
+
+test_expect_success 'verify a largefiles remote' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    clone_repo &&
+    cd ../hg_repo &&
+    echo large > big_file &&
+    hg --config extensions.largefiles= add --large big_file &&
+    hg --config extensions.largefiles= commit -m b --user="$HG_USER" &&
+    cd ../git_clone &&
+    git pull &&
+    test "`cat big_file`" = "large" &&
+    grep -x largefiles .git/hg/*/clone/.hg/requires &&
+    verify > output &&
+    test "`tail -n 1 output`" = "2 verified, 0 failed, 0 verified before" &&
+
+    cd ..
+'
+
+test_expect_success 'verify counts only cached commits as verified before' '
+    test_when_finished "rm -rf hg_repo git_clone" &&
+
+    make_hg_repo &&
+    mkdir docs &&
+    echo hidden > docs/file &&
+    hg add docs/file &&
+    hg commit -m docs --user="$HG_USER" &&
+    make_hg_commit b test_file &&
+    cd .. &&
+    git clone -c remote.origin.hgExclude=docs "testgitifyhg::hg_repo" git_clone &&
+    cd git_clone &&
+    verify > output &&
+    test "`tail -n 1 output`" = "2 verified, 0 failed, 0 verified before" &&
+    verify > output &&
+    test "`tail -n 1 output`" = "0 verified, 0 failed, 2 verified before" &&
+
+    cd ..
+'
+
+test_done